@@ -6,7 +6,7 @@ against loss.  Very handy for backing up "[Gmail]/All Mail" from your
 Gmail account, to snag all your archived mail.  Re-running it on a regular
 basis will update only the stuff it needs to.
 
-Once I need to, I'll write a restore script ;-)
+To put it all back, run "imap2maildir [options] restore".
 
 Ryan Tucker <rtucker@gmail.com>
 
@@ -22,8 +22,10 @@ try:
 except ImportError:
     from configparser import ConfigParser
 
+import collections
 import email
-import getpass
+import email.header
+import errno
 import hashlib
 import logging
 import mailbox
@@ -32,15 +34,19 @@ import os
 import re
 
 try:
-    import rfc822
+    import queue
 except ImportError:
-    import rfc822py3 as rfc822
+    import Queue as queue
 
 import simpleimap
 import sqlite3
 import sys
+import threading
 import time
 
+# getpass, json, multiprocessing and shutil aren't needed to get going,
+# so they're imported where they're used, to keep startup quick.
+
 # Handler for logging/debugging/output
 log = logging.getLogger(__name__)
 console = logging.StreamHandler()
@@ -61,8 +67,47 @@ defaults = {
             'type': 'maildir',
             'mboxdash': False,
             'search': 'SEEN',
+            'order': 'oldest',
+            'compress': True,
+            'daemon': False,
+            'pollinterval': 60,
+            'largesize': 10*1024*1024,
+            'maxbytespersec': 0,
+            'maxcommandspersec': 0,
+            'maxhostbytespersec': 0,
+            'maxhostcommandspersec': 0,
+            'mirrordeletes': False,
+            'mirrortrash': False,
+            'mirrorthreshold': 10,
+            'verifyserver': False,
+            'verifyslice': 0,
+            'restorefolder': False,
+            'restoreconnections': 4,
+            'index': False,
+            'syncflags': False,
+            'allfolders': False,
+            'maxbodysize': 0,
+            'fillstubs': False,
             }
 
+# Things main() knows how to do; the first is the default
+commands = ['sync', 'verify', 'restore', 'search', 'reindex']
+
+# Maildir info flags, and mbox Status/X-Status letters, as IMAP flags.
+# (Trashed/deleted messages are restored without \Deleted, lest they get
+# expunged all over again.)
+maildirflags = {'D': '\\Draft', 'F': '\\Flagged', 'R': '\\Answered',
+                'S': '\\Seen'}
+imapflags = dict([(v.lower(), k) for k, v in maildirflags.items()] +
+                 [('\\deleted', 'T')])
+# ...and the maildir flags that sync_flags keeps in step with the server
+syncedflags = set(imapflags.values())
+mboxflags = {'R': '\\Seen', 'A': '\\Answered', 'F': '\\Flagged',
+             'T': '\\Draft'}
+
+# A header's continuation lines
+HeaderFold = re.compile(r'\r?\n[ \t]+')
+
 class SeenMessagesCache(object):
     """ Cache for seen message UIDs and Hashes
     """
@@ -72,6 +117,744 @@ class SeenMessagesCache(object):
 
         self.uids = None
         self.hashes = None
+        self.gmmsgids = None
+        self.uidset = None
+        self.loader = None
+        # With more than one IMAP folder, the uids are the ones from this
+        # folder (see select()); None is all of them.
+        self.remotefolder = None
+
+    def load(self, filename):
+        """ Fills the caches from the database in filename, in one pass,
+        on a connection of its own
+        """
+
+        log.debug("Populating seen cache...")
+        hashes = {}
+        uids = {}
+        gmmsgids = {}
+        conn = sqlite3.connect(filename)
+        try:
+            c = conn.execute('select hash, uid, gmmsgid, folder, mailfile, '
+                             'remotefolder from seenmessages')
+            for msghash, uid, gmmsgid, folder, mailfile, remotefolder in c:
+                hashes[str(msghash)] = (folder, mailfile)
+                if uid is not None and self.remotefolder in (None,
+                                                             remotefolder):
+                    uids[str(uid)] = (folder, mailfile)
+                if gmmsgid is not None:
+                    gmmsgids[int(gmmsgid)] = (folder, mailfile)
+        finally:
+            conn.close()
+        self.hashes = hashes
+        self.uids = uids
+        self.gmmsgids = gmmsgids
+        self.uidset = simpleimap.UidSet(int(uid) for uid in uids)
+        log.debug("Seen cache: %i hashes, %i uids, %i gmmsgids" %
+                  (len(hashes), len(uids), len(gmmsgids)))
+
+    def start_loading(self, conn):
+        """ Starts loading the caches in the background from conn's
+        database, e.g. while we're logging in.  Anything that uses them
+        calls wait() first.
+        """
+
+        filename = [row[2] for row in conn.execute('pragma database_list')
+                    if row[1] == 'main'][0]
+        if not filename:
+            return
+        self.loader = threading.Thread(target=self.__load, args=(filename,),
+                                       name='seencache')
+        self.loader.daemon = True
+        self.loader.start()
+
+    def __load(self, filename):
+        """ load(), for the loader thread
+        """
+
+        try:
+            self.load(filename)
+        except Exception:
+            log.exception('Could not load the seen cache in the background; '
+                          'it will be loaded when needed')
+
+    def wait(self):
+        """ Waits for start_loading() to finish, if it's running
+        """
+
+        if self.loader is not None:
+            self.loader.join()
+            self.loader = None
+
+    def select(self, remotefolder):
+        """ Narrows the uid caches down to the uids from remotefolder, since
+        every folder has a uid 1; they're reloaded when next needed
+        """
+
+        self.wait()
+        if remotefolder != self.remotefolder:
+            self.remotefolder = remotefolder
+            self.uids = None
+            self.uidset = None
+
+    def add(self, hash, uid, folder, mailfile, gmmsgid=None):
+        """ Records a newly stored message, so long-running processes
+        don't have to go back to the database for it
+        """
+
+        self.wait()
+        if self.hashes is not None:
+            self.hashes[str(hash)] = (folder, mailfile)
+        if self.uids is not None and uid is not None:
+            self.uids[str(uid)] = (folder, mailfile)
+        if self.uidset is not None and uid is not None:
+            self.uidset.add(int(uid))
+        if self.gmmsgids is not None and gmmsgid:
+            self.gmmsgids[int(gmmsgid)] = (folder, mailfile)
+
+
+class SummaryCache(object):
+    """ Keeps the summaries fetched from a folder in the database, by
+    folder, UIDVALIDITY and uid, so that after an interrupted run (or one
+    cut short by --max-messages) the messages still to be copied don't
+    need their summaries fetched again.  For FolderClass.__summarycache__.
+    Summaries of messages we've since stored, or that have gone from the
+    server, are dropped by purge().
+    """
+
+    def __init__(self, conn, folder, uidvalidity, batchsize=50):
+        """ Constructor; loads what's cached for the folder
+        """
+
+        self.conn = conn
+        self.folder = folder
+        self.uidvalidity = uidvalidity or 0
+        self.batchsize = batchsize
+        self.pending = 0
+        self.hits = 0
+
+        import json
+        self.purge()
+        self.summaries = {}
+        c = conn.cursor()
+        c.execute('select uid, hash, size, date, msgid, envfrom, envdate, '
+                  'gmmsgid, gmthrid, labels, envelope from summaries '
+                  'where folder = ?', (folder,))
+        for row in c:
+            summary = dict(zip(('uid', 'hash', 'size', 'date', 'msgid',
+                                'envfrom', 'envdate'), row[:7]))
+            if row[7] is not None:
+                summary['gmmsgid'] = row[7]
+                summary['gmthrid'] = row[8]
+                summary['labels'] = json.loads(row[9] or '[]')
+            self.summaries[row[0]] = (summary, row[10])
+        log.debug('Summary cache: %i summaries for %s' %
+                  (len(self.summaries), folder))
+
+    def purge(self, serveruids=None):
+        """ Drops the summaries of messages we've stored since, and any from
+        before a change of UIDVALIDITY, and commits.  Given the UidSet of
+        the folder's uids on the server, also drops those no longer in it.
+        """
+
+        self.conn.execute('delete from summaries where folder = ? and '
+            '(uidvalidity != ? or uid in (select uid from seenmessages '
+            'where remotefolder = ? and uid is not null))',
+            (self.folder, self.uidvalidity, self.folder))
+        if serveruids is not None:
+            gone = [uid for uid in self.summaries if uid not in serveruids]
+            self.conn.executemany('delete from summaries where folder = ? '
+                                  'and uid = ?',
+                                  [(self.folder, uid) for uid in gone])
+            for uid in gone:
+                del self.summaries[uid]
+        self.conn.commit()
+        self.pending = 0
+
+    def get(self, uid, envelope=True):
+        """ Returns the cached summary for uid, if there is one (and it has
+        the ENVELOPE, if that's wanted)
+        """
+
+        summary, hadenvelope = self.summaries.get(int(uid), (None, False))
+        if summary is None or (envelope and not hadenvelope):
+            return None
+        self.hits += 1
+        return dict(summary)
+
+    def put(self, summary, envelope=True):
+        """ Caches a summary fetched from the server (adding its hash)
+        """
+
+        import json
+        summary['hash'] = summary_hash(summary)
+        labels = summary.get('labels')
+        self.conn.execute('insert or replace into summaries (folder, '
+            'uidvalidity, uid, hash, size, date, msgid, envfrom, envdate, '
+            'gmmsgid, gmthrid, labels, envelope) '
+            'values (?,?,?,?,?,?,?,?,?,?,?,?,?)',
+            (self.folder, self.uidvalidity, summary['uid'], summary['hash'],
+             summary['size'], summary['date'], summary['msgid'],
+             summary['envfrom'], summary['envdate'], summary.get('gmmsgid'),
+             summary.get('gmthrid'),
+             labels is not None and json.dumps(labels) or None,
+             int(bool(envelope))))
+        self.pending += 1
+        if self.pending >= self.batchsize:
+            self.conn.commit()
+            self.pending = 0
+
+
+class Journal(object):
+    """ A write-ahead journal of the messages being added to the mailbox,
+    so that dying between writing a message and committing it to the
+    database costs neither a duplicate nor a re-download.  Before a
+    message is written, an I (intent) record says where it's going and
+    what to put in seenmessages; once it's there, a W (written) record
+    gives its key.  The database is only committed every batchsize
+    messages, at which point the journal is emptied.  recover() sorts out
+    whatever was in flight the last time.
+    """
+
+    def __init__(self, filename, conn, batchsize=100):
+        """ Constructor
+        """
+
+        self.filename = filename
+        self.conn = conn
+        self.batchsize = batchsize
+        self.pending = 0
+        self.fileobj = None
+
+    def __write(self, record):
+        """ Appends a record.  It's flushed, not fsynced: it only has to
+        outlive us, not the machine.
+        """
+
+        import json
+        if self.fileobj is None:
+            self.fileobj = open(self.filename, 'a')
+        self.fileobj.write(json.dumps(record) + '\n')
+        self.fileobj.flush()
+
+    def __publish(self, tmp, dest):
+        """ Moves a message from tmp/ into place as Maildir.add does: by
+        linking it, so that a name clash fails rather than overwriting
+        another message, and renaming only where links aren't to be had.
+        """
+
+        try:
+            try:
+                os.link(tmp, dest)
+            except AttributeError:
+                os.rename(tmp, dest)
+            except OSError as e:
+                if e.errno not in (errno.EPERM, errno.EACCES):
+                    raise
+                os.rename(tmp, dest)
+            else:
+                os.remove(tmp)
+        except OSError as e:
+            os.remove(tmp)
+            if e.errno == errno.EEXIST:
+                raise mailbox.ExternalClashError(
+                    'Name clash with existing message: %s' % dest)
+            raise
+
+    def add(self, mbox, message, record):
+        """ Adds message to mbox, journalled.  record is a dict of
+        store_hash's arguments (hash, uid, gmmsgid, labels, remotefolder,
+        internaldate, localfolder, stub); mbox is the localfolder's.  As
+        with Maildir.add, a MaildirMessage keeps its subdir and flags.
+        Returns the new key.
+        """
+
+        record = dict(record, op='I')
+        if isinstance(mbox, mailbox.Maildir):
+            # What Maildir.add does, but we need to know the names first
+            tmpfile = mbox._create_tmp()
+            uniq = os.path.basename(tmpfile.name).split(mbox.colon)[0]
+            subdir, suffix = 'new', ''
+            if isinstance(message, mailbox.MaildirMessage):
+                subdir = message.get_subdir()
+                if message.get_info():
+                    suffix = mbox.colon + message.get_info()
+            record['tmp'] = os.path.relpath(tmpfile.name, mbox._path)
+            record['new'] = os.path.join(subdir, uniq + suffix)
+            self.__write(record)
+            try:
+                mbox._dump_message(message, tmpfile)
+            except BaseException:
+                tmpfile.close()
+                os.remove(tmpfile.name)
+                raise
+            mailbox._sync_close(tmpfile)
+            if isinstance(message, mailbox.MaildirMessage):
+                os.utime(tmpfile.name, (os.path.getatime(tmpfile.name),
+                                        message.get_date()))
+            self.__publish(tmpfile.name,
+                           os.path.join(mbox._path, record['new']))
+            key = uniq
+        else:
+            mbox._file.seek(0, 2)
+            record['offset'] = mbox._file.tell()
+            self.__write(record)
+            key = mbox.add(message)
+        self.__write({'op': 'W', 'hash': record['hash'], 'mailfile': key})
+        return key
+
+    def done(self):
+        """ Counts a message as recorded (but not committed) in the
+        database, committing if it's time
+        """
+
+        self.pending += 1
+        if self.pending >= self.batchsize:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """ Commits the database and empties the journal
+        """
+
+        self.conn.commit()
+        if self.fileobj is not None:
+            self.fileobj.seek(0)
+            self.fileobj.truncate()
+        self.pending = 0
+
+    def close(self):
+        """ Checkpoints, and gets rid of the journal file
+        """
+
+        self.checkpoint()
+        if self.fileobj is not None:
+            self.fileobj.close()
+            self.fileobj = None
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def recover(self, mbox):
+        """ Sorts out whatever was in flight when we last stopped: messages
+        that made it into the mailbox are recorded in the database, and
+        anything half-written is removed.  Returns (recorded, removed).
+        """
+
+        import json
+        if not os.path.exists(self.filename):
+            return 0, 0
+
+        intents = []
+        written = {}
+        fileobj = open(self.filename)
+        try:
+            for line in fileobj:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Torn write as we died
+                    continue
+                if record['op'] == 'I':
+                    intents.append(record)
+                elif record['op'] == 'W':
+                    written[record['hash']] = record['mailfile']
+        finally:
+            fileobj.close()
+
+        recorded = removed = 0
+        truncate = None
+        c = self.conn.cursor()
+        for record in intents:
+            c.execute('select 1 from seenmessages where hash = ?',
+                      (record['hash'],))
+            if c.fetchone():
+                continue
+            fmbox = mbox
+            if record.get('localfolder'):
+                fmbox = mbox.get_folder(record['localfolder'])
+            mailfile = written.get(record['hash'])
+            if mailfile is None and 'new' in record and \
+                    os.path.exists(os.path.join(fmbox._path, record['new'])):
+                # Moved into place, but we died before saying so
+                mailfile = os.path.basename(record['new']).split(fmbox.colon)[0]
+            if mailfile is not None and 'tmp' in record:
+                # ...perhaps between linking it and removing it from tmp/
+                path = os.path.join(fmbox._path, record['tmp'])
+                if os.path.exists(path):
+                    os.remove(path)
+            if mailfile is not None:
+                store_hash(self.conn, record['hash'], mailfile, record['uid'],
+                           gmmsgid=record.get('gmmsgid'),
+                           labels=record.get('labels'),
+                           remotefolder=record.get('remotefolder'),
+                           internaldate=record.get('internaldate'),
+                           commit=False,
+                           localfolder=record.get('localfolder'),
+                           stub=record.get('stub'))
+                log.info('RECOVERED: %s (uid %s)' % (mailfile, record['uid']))
+                recorded += 1
+            elif 'tmp' in record:
+                path = os.path.join(fmbox._path, record['tmp'])
+                if os.path.exists(path):
+                    log.warning('Removing half-written %s' % path)
+                    os.remove(path)
+                    removed += 1
+            elif truncate is None or record['offset'] < truncate:
+                truncate = record['offset']
+
+        if truncate is not None:
+            mbox._file.seek(0, 2)
+            if mbox._file.tell() > truncate:
+                log.warning('Truncating half-written message at %i of %s' %
+                            (truncate, mbox._path))
+                mbox._file.truncate(truncate)
+                mbox._file.flush()
+                mbox._toc = None
+                removed += 1
+
+        self.checkpoint()
+        return recorded, removed
+
+
+class RestoreWorker(threading.Thread):
+    """ Uploads batches of messages on a connection of its own.  Jobs are
+    (folder, [(path, content, flags, internaldate), ...]); if content is
+    None, the message is read from path.  Messages whose Message-ID and
+    size are in present[folder] are skipped, and those uploaded are added
+    to it, so a message the mailbox has twice only goes up once.  present
+    is shared between the workers, under lock.
+    """
+
+    def __init__(self, server, jobs, present, lock=None):
+        """ Constructor
+        """
+
+        threading.Thread.__init__(self, name='restore')
+        self.daemon = True
+        self.server = server
+        self.jobs = jobs
+        self.present = present
+        self.lock = lock or threading.Lock()
+        self.outdict = {'restored': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+
+    def prepare(self, folder, path, content, internaldate):
+        """ Reads a message (if content is None), and works out its
+        INTERNALDATE (if None) from its Date header.  Returns (content,
+        internaldate, (Message-ID, size)), or None if it's in present[folder]
+        already.  The (Message-ID, size) is None if there's no Message-ID.
+        """
+
+        if content is None:
+            content = read_message_file(path, raw=True)
+        content = re.sub(b'\r?\n', b'\r\n', content)
+        headers = simpleimap._str(content.split(b'\r\n\r\n', 1)[0])
+        msgid = simpleimap.MessageIdHeader.search(headers)
+        key = msgid and (msgid.group('msgid'), len(content)) or None
+        if key:
+            self.lock.acquire()
+            try:
+                present = self.present.setdefault(folder, set())
+                if key in present:
+                    return None
+                present.add(key)
+            finally:
+                self.lock.release()
+        if internaldate is None:
+            date = re.search(r'^Date:[ \t]*(.*)$', headers,
+                             re.IGNORECASE | re.MULTILINE)
+            date = date and email.utils.parsedate_tz(date.group(1))
+            internaldate = date and email.utils.mktime_tz(date)
+        return content, internaldate, key
+
+    def forget(self, folder, keys):
+        """ Takes the (Message-ID, size)s of messages that didn't make it
+        back out of present[folder]
+        """
+
+        self.lock.acquire()
+        try:
+            for key in keys:
+                if key:
+                    self.present[folder].discard(key)
+        finally:
+            self.lock.release()
+
+    def run(self):
+        """ Works through the jobs queue until it gets a None
+        """
+
+        try:
+            server = self.server.Clone()
+        except Exception:
+            log.exception('Could not open a connection for restoring')
+            server = None
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            folder, items = job
+            if server is None:
+                self.outdict['failed'] += len(items)
+                continue
+
+            messages = []
+            keys = []
+            for path, content, flags, internaldate in items:
+                try:
+                    prepared = self.prepare(folder, path, content,
+                                            internaldate)
+                except Exception:
+                    log.exception('Could not read %s' % path)
+                    self.outdict['failed'] += 1
+                    continue
+                if prepared is None:
+                    self.outdict['skipped'] += 1
+                    continue
+                content, internaldate, key = prepared
+                messages.append((flags, internaldate, content))
+                keys.append(key)
+            if not messages:
+                continue
+
+            try:
+                server.Get().append_messages(folder, messages)
+                self.outdict['restored'] += len(messages)
+                self.outdict['bytes'] += sum([len(m[2]) for m in messages])
+            except simpleimap.ConnectionErrors:
+                log.exception('Lost connection restoring to %s' % folder)
+                self.outdict['failed'] += len(messages)
+                self.forget(folder, keys)
+                try:
+                    server.Reconnect()
+                except Exception:
+                    server = None
+            except Exception:
+                log.exception('Could not restore to %s' % folder)
+                self.outdict['failed'] += len(messages)
+                self.forget(folder, keys)
+
+        if server is not None:
+            try:
+                server.Get().logout()
+            except Exception:
+                pass
+
+
+class IndexWorker(threading.Thread):
+    """ Adds messages to the full-text index in the background, on a
+    sqlite connection of its own, so indexing doesn't hold up fetching.
+    """
+
+    def __init__(self, filename):
+        """ Constructor
+        """
+
+        threading.Thread.__init__(self, name='index')
+        self.daemon = True
+        self.filename = filename
+        self.jobs = queue.Queue(1000)
+
+    def submit(self, msghash, folder, mailfile, message):
+        """ Queues a message for indexing
+        """
+
+        self.jobs.put((msghash, folder, mailfile, message))
+
+    def close(self):
+        """ Finishes indexing whatever is queued, and stops
+        """
+
+        self.jobs.put(None)
+        self.join()
+
+    def run(self):
+        """ Works through the jobs queue until it gets a None, committing
+        every hundred messages or when things go quiet
+        """
+
+        conn = open_index(self.filename)
+        pending = 0
+        while True:
+            try:
+                job = self.jobs.get(True, 5)
+            except queue.Empty:
+                if pending:
+                    conn.commit()
+                    pending = 0
+                continue
+            if job is None:
+                break
+            msghash, folder, mailfile, message = job
+            try:
+                store_index(conn, msghash, folder, mailfile,
+                            index_fields(message))
+            except Exception:
+                log.exception('Could not index %s' % msghash)
+                continue
+            pending += 1
+            if pending >= 100:
+                conn.commit()
+                pending = 0
+        conn.commit()
+        conn.close()
+
+
+class HeaderMessage(object):
+    """ A message as a lazyMaildir factory: the headers are read in one go
+    and only picked apart when asked for, and the body is only read if
+    get_body() is called.  Much cheaper than rfc822.Message or the email
+    package when all we want is to know the message is there, or what its
+    Subject is.
+    """
+
+    # How much to read at a time looking for the end of the headers
+    headersize = 8192
+
+    # Compiled patterns for the headers asked for so far, by name
+    _patterns = {}
+
+    def __init__(self, fp):
+        """ Reads the headers from fp, a file opened in binary mode
+        """
+
+        self.fp = fp
+        # (on Python 3, mailbox hands us a _ProxyFile wrapping the file)
+        self.path = getattr(getattr(fp, '_file', fp), 'name', None)
+        data = fp.read(self.headersize)
+        start = 0
+        while True:
+            end = self._find_end(data, start)
+            if end:
+                break
+            more = fp.read(self.headersize)
+            if not more:
+                break
+            start = max(0, len(data) - 2)
+            data += more
+        if end:
+            self._raw, self._rest = data[:end[0]], data[end[1]:]
+            self.startofbody = end[1]
+        else:
+            self._raw, self._rest = data, b''
+            self.startofbody = len(data)
+        self._text = None
+        self._headers = None
+
+    def _find_end(self, data, start):
+        """ Returns (end of headers, start of body) if the blank line
+        between them is in data (from start on), or None
+        """
+
+        if start == 0:
+            for blank in (b'\n', b'\r\n'):
+                if data.startswith(blank):
+                    return 0, len(blank)
+        ends = []
+        for blank in (b'\n\n', b'\n\r\n'):
+            i = data.find(blank, start)
+            if i >= 0:
+                ends.append((i, i + len(blank)))
+        return ends and min(ends) or None
+
+    def __nonzero__(self):
+        """ A message is a message, even if it has no headers
+        """
+
+        return True
+
+    __bool__ = __nonzero__
+
+    def headers(self):
+        """ Returns [(name, value), ...], unfolded, in order
+        """
+
+        if self._headers is None:
+            self._headers = []
+            for line in self.text().splitlines():
+                if line[:1] in (' ', '\t'):
+                    if self._headers:
+                        name, value = self._headers[-1]
+                        self._headers[-1] = (name, value + ' ' + line.strip())
+                    continue
+                name, colon, value = line.partition(':')
+                if colon and name and ' ' not in name:
+                    self._headers.append((name, value.strip()))
+        return self._headers
+
+    def text(self):
+        """ Returns the headers as they are, as a string
+        """
+
+        if self._text is None:
+            self._text = simpleimap._str(self._raw)
+        return self._text
+
+    def get(self, name, default=None):
+        """ Returns the first header called name, or default
+        """
+
+        values = self.get_all(name, 1)
+        return values and values[0] or default
+
+    getheader = get
+
+    def get_all(self, name, count=0):
+        """ Returns every header called name (or the first count), unfolded.
+        Rather than parsing all of them, this just looks for the one.
+        """
+
+        name = name.lower()
+        pattern = self._patterns.get(name)
+        if pattern is None:
+            pattern = self._patterns[name] = re.compile(
+                r'^%s:[ \t]*(.*(?:\r?\n[ \t].*)*)' % re.escape(name),
+                re.IGNORECASE | re.MULTILINE)
+        values = []
+        for mo in pattern.finditer(self.text()):
+            values.append(HeaderFold.sub(' ', mo.group(1)).strip())
+            if len(values) == count:
+                break
+        return values
+
+    def __getitem__(self, name):
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.headers())
+
+    def keys(self):
+        return [key for key, value in self.headers()]
+
+    def items(self):
+        return list(self.headers())
+
+    def get_body(self):
+        """ Reads and returns the body (as bytes)
+        """
+
+        # (Python 2's _ProxyFile has no closed, but loses _file on close)
+        closed = getattr(self.fp, 'closed', None)
+        if closed is None:
+            closed = not hasattr(self.fp, '_file')
+        if not closed:
+            return self._rest + self.fp.read()
+        if self.path is None:
+            raise IOError('the message file has been closed')
+        f = open(self.path, 'rb')
+        try:
+            f.seek(self.startofbody)
+            return f.read()
+        finally:
+            f.close()
 
 
 class lazyMaildir(mailbox.Maildir):
@@ -80,10 +863,37 @@ class lazyMaildir(mailbox.Maildir):
     by A.M. Kuchling, 2009-05-02
     """
 
-    def __init__(self, dirname, factory=rfc822.Message, create=True):
+    # How many subfolder handles to keep around
+    foldercachesize = 64
+
+    def __init__(self, dirname, factory=HeaderMessage, create=True):
         """Initialize a lazy Maildir instance."""
         mailbox.Maildir.__init__(self, dirname, factory, create)
         self._last_read = None  # Records the last time we read cur/new
+        self._folders = collections.OrderedDict()
+
+    def get_folder(self, folder):
+        """Return a lazyMaildir instance for the named folder.  These are
+        cached (the least recently used go first), so each keeps its table
+        of contents between lookups instead of listing cur/new every time."""
+        fmbox = self._folders.pop(folder, None)
+        if fmbox is None:
+            fmbox = lazyMaildir(os.path.join(self._path, '.' + folder),
+                                factory=self._factory, create=False)
+        self._folders[folder] = fmbox
+        while len(self._folders) > self.foldercachesize:
+            self._folders.popitem(last=False)
+        return fmbox
+
+    def add_folder(self, folder):
+        """Create a folder and return a lazyMaildir instance for it."""
+        mailbox.Maildir.add_folder(self, folder)
+        return self.get_folder(folder)
+
+    def remove_folder(self, folder):
+        """Delete the named folder, which must be empty."""
+        self._folders.pop(folder, None)
+        mailbox.Maildir.remove_folder(self, folder)
 
     def _refresh(self):
         """Update table of contents mapping."""
@@ -120,10 +930,182 @@ class lazyMaildir(mailbox.Maildir):
         self._last_read = time.time() - 1
 
 
+class LargeMessageLane(threading.Thread):
+    """ Fetches big messages on a connection of its own, a chunk at a time,
+    into partial files in tmpdir, so they don't hold up the small ones.
+    A partial file is kept if something goes wrong, and picked up where it
+    left off the next time that message comes around.
+    """
+
+    def __init__(self, server, foldername, uidvalidity, tmpdir,
+                 chunksize=None):
+        """ Constructor (chunksize None lets the folder pick, as it goes)
+        """
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = server
+        self.foldername = foldername
+        self.uidvalidity = uidvalidity
+        self.tmpdir = tmpdir
+        self.chunksize = chunksize
+        self.jobs = queue.Queue()
+        self.done = queue.Queue()
+        self.hashes = set()
+
+    def partfile(self, uid):
+        """ Where the message with the given uid is being downloaded to
+        """
+
+        return os.path.join(self.tmpdir, 'imap2maildir-%s-%i.part' %
+                            (self.uidvalidity, uid))
+
+    def submit(self, summary, msghash):
+        """ Queues a message for fetching, starting the lane if needed.
+        Returns False (and queues nothing) if a message with the same hash
+        was queued already, so copies of a message are only fetched once.
+        """
+
+        if msghash in self.hashes:
+            return False
+        self.hashes.add(msghash)
+        if not self.is_alive():
+            self.start()
+        self.jobs.put((summary, msghash))
+        return True
+
+    def completed(self, wait=False):
+        """ Yields (summary, msghash, path) for each finished message; path
+        is None if it couldn't be fetched.  With wait=True, waits for
+        everything submitted so far, and then stops the lane.
+        """
+
+        if wait and self.is_alive():
+            self.jobs.put(None)
+            self.join()
+        while True:
+            try:
+                yield self.done.get_nowait()
+            except queue.Empty:
+                return
+
+    def run(self):
+        """ Works through the jobs queue until it gets a None
+        """
+
+        try:
+            server = self.server.Clone()
+            folder = server.Get().Folder(self.foldername)
+            folder.__reconnector__(server.Reconnect)
+            server.StartKeepalive()
+            folder.uidvalidity = self.uidvalidity
+            folder.Select()
+        except Exception:
+            log.exception('Could not open a connection for large messages')
+            folder = None
+
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            summary, msghash = job
+            path = self.partfile(summary['uid'])
+            if folder is None:
+                self.done.put((summary, msghash, None))
+                continue
+            try:
+                fileobj = open(path, 'ab')
+                try:
+                    size = folder.MessageToFile(summary['uid'], fileobj,
+                                                self.chunksize)
+                finally:
+                    fileobj.close()
+                log.debug(' LARGE: fetched uid %i, %i bytes (chunks of %i)' %
+                          (summary['uid'], size,
+                           self.chunksize or folder.chunksizer.size))
+                self.done.put((summary, msghash, path))
+            except Exception:
+                log.exception('ERROR: Could not retrieve large message: %s' %
+                              repr(summary))
+                self.done.put((summary, msghash, None))
+
+        if folder is not None:
+            server.StopKeepalive()
+            try:
+                server.Get().logout()
+            except Exception:
+                pass
+
+
 def make_hash(size, date, msgid):
     """ Returns a hash of a message given the size, date, and msgid thingies.
     """
-    return hashlib.sha1('%i::%s::%s' % (size, date, msgid)).hexdigest()
+    return hashlib.sha1(simpleimap._bytes('%i::%s::%s' % (size, date, msgid))
+                        ).hexdigest()
+
+
+def summary_hash(summary):
+    """ Returns the hash for a summary from FolderClass.Summaries, going by
+    the X-GM-MSGID if there's no Message-ID (gmail, without ENVELOPEs)
+    """
+
+    if 'hash' in summary:
+        return summary['hash']
+    gmmsgid = summary.get('gmmsgid')
+    if summary['msgid'] is None and gmmsgid:
+        return make_hash(summary['size'], summary['date'],
+                         'X-GM-MSGID:%i' % gmmsgid)
+    return make_hash(summary['size'], summary['date'], summary['msgid'])
+
+
+def folder_hash(msghash, localfolder):
+    """ The hash a message is stored under in a maildir subfolder (with
+    --all-folders), so that copies of it in two folders are two messages.
+    The maildir's own messages keep theirs.
+    """
+
+    if not localfolder:
+        return msghash
+    return hashlib.sha1(simpleimap._bytes('%s::%s' % (localfolder, msghash))
+                        ).hexdigest()
+
+
+def copy_hash(msghash, remotefolder):
+    """ The hash another copy of a message, in remotefolder, is recorded
+    under when it shares the file of one we already have (see
+    store_gmail_copy)
+    """
+
+    return hashlib.sha1(simpleimap._bytes('copy::%s::%s' %
+                                          (remotefolder, msghash))
+                        ).hexdigest()
+
+
+def maildir_folder_name(remotefolder, delimiter):
+    """ The Maildir++ subfolder an IMAP folder is copied to with
+    --all-folders: INBOX is the maildir itself (''), and the rest are
+    their names on the server, with the hierarchy delimiter turned into
+    '.' (and any '.' or '/' within a level into '_').
+    """
+
+    if remotefolder.upper() == 'INBOX':
+        return ''
+    parts = [remotefolder]
+    if delimiter:
+        parts = remotefolder.split(delimiter)
+    return '.'.join([part.replace('.', '_').replace('/', '_')
+                     for part in parts])
+
+
+def folder_mailbox(mbox, localfolder):
+    """ The mailbox for a maildir subfolder (see maildir_folder_name), or
+    mbox itself for ''.  (Not "localfolder and ... or mbox": an empty
+    subfolder is falsy, which would land its messages in mbox.)
+    """
+
+    if localfolder:
+        return mbox.get_folder(localfolder)
+    return mbox
 
 
 def open_sql_session(filename):
@@ -140,7 +1122,9 @@ def open_sql_session(filename):
     if columns == []:
         # need to create the seenmessages table
         c.execute("""create table seenmessages
-            (hash text not null unique, mailfile text not null, uid integer, folder text)""")
+            (hash text not null unique, mailfile text not null, uid integer, folder text,
+             gmmsgid integer, labels text, remotefolder text, internaldate integer,
+             stub integer)""")
     else:
         if not 'uid' in columns:
             # old db; need to add a column for uid
@@ -148,17 +1132,55 @@ def open_sql_session(filename):
         if not 'folder' in columns:
             # need to add a column for folder
             c.execute("""alter table seenmessages add column folder text""")
+        if not 'gmmsgid' in columns:
+            # need to add columns for gmail's X-GM-MSGID and X-GM-LABELS
+            c.execute("""alter table seenmessages add column gmmsgid integer""")
+            c.execute("""alter table seenmessages add column labels text""")
+        if not 'remotefolder' in columns:
+            # need to add a column for the IMAP folder the uid belongs to
+            c.execute("""alter table seenmessages add column remotefolder text""")
+        if not 'internaldate' in columns:
+            # need to add a column for the INTERNALDATE, for restoring
+            c.execute("""alter table seenmessages add column internaldate integer""")
+        if not 'stub' in columns:
+            # need to add a column for how much --max-body-size left out
+            c.execute("""alter table seenmessages add column stub integer""")
+
+    c.execute("""create index if not exists seenmessages_gmmsgid
+        on seenmessages (gmmsgid)""")
+    c.execute("""create index if not exists seenmessages_uid
+        on seenmessages (uid)""")
+    c.execute("""create index if not exists seenmessages_remotefolder
+        on seenmessages (remotefolder, uid)""")
+    c.execute("""create table if not exists folderstate
+        (folder text primary key, uidvalidity integer, highestmodseq integer,
+         messages integer, uidnext integer, statusmodseq integer)""")
+    c.execute('pragma table_info(folderstate)')
+    columns = [i[1] for i in c.fetchall()]
+    # highestmodseq is for --sync-flags; messages, uidnext and statusmodseq
+    # are the STATUS as of the last complete pass, for --all-folders
+    for column in ('highestmodseq', 'messages', 'uidnext', 'statusmodseq'):
+        if not column in columns:
+            c.execute('alter table folderstate add column %s integer' % column)
+    c.execute("""create table if not exists verifystate
+        (name text primary key, value integer)""")
+    c.execute("""create table if not exists summaries
+        (folder text, uidvalidity integer, uid integer, hash text,
+         size integer, date text, msgid text, envfrom text, envdate text,
+         gmmsgid integer, gmthrid integer, labels text, envelope integer,
+         primary key (folder, uidvalidity, uid))""")
 
     conn.commit()
     return conn
 
 
-def check_message(conn, mbox, hash=None, uid=None, seencache=None):
+def check_message(conn, mbox, hash=None, uid=None, seencache=None, gmmsgid=None):
     """ Checks to see if a given message exists.
     """
 
     c = conn.cursor()
     if seencache:
+        seencache.wait()
         if seencache.hashes is None:
             # Populate the hash cache
             log.debug("Populating hash cache...")
@@ -171,12 +1193,35 @@ def check_message(conn, mbox, hash=None, uid=None, seencache=None):
             # Populate the uid cache
             log.debug("Populating uid cache...")
             seencache.uids = {}
-            c.execute('select uid,folder,mailfile from seenmessages')
+            if seencache.remotefolder is None:
+                c.execute('select uid,folder,mailfile from seenmessages')
+            else:
+                c.execute('select uid,folder,mailfile from seenmessages '
+                          'where remotefolder = ?', (seencache.remotefolder,))
             for result in c:
                 seencache.uids[str(result[0])] = (result[1], result[2])
             log.debug("Uid cache: %i uids" % len(seencache.uids))
+        if seencache.gmmsgids is None:
+            # Populate the gmail message id cache
+            log.debug("Populating gmmsgid cache...")
+            seencache.gmmsgids = {}
+            c.execute('select gmmsgid,folder,mailfile from seenmessages where gmmsgid is not null')
+            for result in c:
+                seencache.gmmsgids[int(result[0])] = (result[1], result[2])
+            log.debug("Gmmsgid cache: %i gmmsgids" % len(seencache.gmmsgids))
 
-    if hash:
+    if gmmsgid:
+        if seencache and int(gmmsgid) in seencache.gmmsgids:
+            folder, mailfile = seencache.gmmsgids[int(gmmsgid)]
+        else:
+            c.execute('select folder,mailfile from seenmessages where gmmsgid=?', (gmmsgid,))
+            row = c.fetchone()
+            if row:
+                log.debug("Cache miss on gmmsgid %s", gmmsgid)
+                folder, mailfile = row
+            else:
+                return False
+    elif hash:
         if str(hash) in seencache.hashes:
             folder, mailfile = seencache.hashes[hash]
         else:
@@ -191,7 +1236,11 @@ def check_message(conn, mbox, hash=None, uid=None, seencache=None):
         if str(uid) in seencache.uids:
             folder, mailfile = seencache.uids[str(uid)]
         else:
-            c.execute('select folder,mailfile from seenmessages where uid=?', (uid,))
+            if seencache.remotefolder is None:
+                c.execute('select folder,mailfile from seenmessages where uid=?', (uid,))
+            else:
+                c.execute('select folder,mailfile from seenmessages where uid=? '
+                          'and remotefolder=?', (uid, seencache.remotefolder))
             row = c.fetchone()
             if row:
                 log.debug("Cache miss on uid %s" % uid)
@@ -221,9 +1270,41 @@ def check_message(conn, mbox, hash=None, uid=None, seencache=None):
         return mailfile in mbox
 
 
-def store_hash(conn, hash, mailfile, uid):
-    """ Given a database connection, hash, mailfile, and uid,
-    stashes it in the database
+def known_uids(conn, seencache=None):
+    """ Returns a simpleimap.UidSet of every uid in the database (or just
+    the seencache's remotefolder's)
+    """
+
+    remotefolder = None
+    if seencache:
+        seencache.wait()
+        if seencache.uidset is not None:
+            return seencache.uidset
+        remotefolder = seencache.remotefolder
+
+    c = conn.cursor()
+    if remotefolder is None:
+        c.execute('select uid from seenmessages where uid is not null order by uid')
+    else:
+        c.execute('select uid from seenmessages where uid is not null '
+                  'and remotefolder = ? order by uid', (remotefolder,))
+    uidset = simpleimap.UidSet.from_sorted(int(row[0]) for row in c)
+    log.debug("Known uids: %i in %i ranges" % (len(uidset), len(uidset.starts)))
+    if seencache:
+        seencache.uidset = uidset
+    return uidset
+
+
+def store_hash(conn, hash, mailfile, uid, seencache=None, gmmsgid=None,
+               labels=None, remotefolder=None, internaldate=None, commit=True,
+               localfolder=None, stub=None):
+    """ Given a database connection, hash, mailfile, and uid (and, for
+    gmail, the X-GM-MSGID and X-GM-LABELS, and the IMAP folder the uid
+    belongs to and the message's INTERNALDATE in seconds since the epoch,
+    and the maildir subfolder mailfile is in, and, if mailfile is only a
+    stub, how many bytes were left out), stashes it in the database (and
+    the seencache, if given).  Without commit, it's up to the caller
+    (i.e. a Journal) to commit.
     """
 
     c = conn.cursor()
@@ -231,18 +1312,915 @@ def store_hash(conn, hash, mailfile, uid):
     cur = c.execute('delete from seenmessages where hash = ?', (hash, ))
     if cur.rowcount > 0:
         log.debug('!!! Nuked duplicate hash %s' % hash)
-    c.execute('insert into seenmessages values (?,?,?,?)', (hash, mailfile, uid, ''))
+    if labels is not None:
+        import json
+        labels = json.dumps(labels)
+    c.execute('insert into seenmessages (hash, mailfile, uid, folder, gmmsgid, labels, '
+              'remotefolder, internaldate, stub) values (?,?,?,?,?,?,?,?,?)',
+              (hash, mailfile, uid, localfolder or '', gmmsgid, labels,
+               remotefolder, internaldate, stub))
+    if commit:
+        conn.commit()
+    if seencache:
+        seencache.add(hash, uid, localfolder or '', mailfile, gmmsgid)
+
+
+def add_uid_to_hash(conn, hash, uid, seencache=None, remotefolder=None):
+    """ Adds a uid (and the IMAP folder it belongs to) to a hash that's
+    missing its uid
+    """
+
+    c = conn.cursor()
+    c.execute('update seenmessages set uid = ?, remotefolder = ? where hash = ?',
+              (uid, remotefolder, hash))
+    conn.commit()
+    if seencache and seencache.hashes and str(hash) in seencache.hashes:
+        folder, mailfile = seencache.hashes[str(hash)]
+        seencache.add(hash, uid, folder, mailfile)
+
+
+def store_gmail_info(conn, gmmsgid, labels, hash=None, seencache=None):
+    """ Records the gmail labels for a message.  If hash is given, also
+    sets the X-GM-MSGID on that hash (for rows from before we knew it)
+    """
+
+    import json
+    c = conn.cursor()
+    if hash:
+        c.execute('update seenmessages set gmmsgid = ?, labels = ? where hash = ?',
+                  (gmmsgid, json.dumps(labels), hash))
+        if seencache and seencache.hashes and str(hash) in seencache.hashes:
+            folder, mailfile = seencache.hashes[str(hash)]
+            seencache.add(hash, None, folder, mailfile, gmmsgid)
+    else:
+        c.execute('update seenmessages set labels = ? where gmmsgid = ?',
+                  (json.dumps(labels), gmmsgid))
+    conn.commit()
+
+
+def store_gmail_copy(conn, gmmsgid, hash, uid, seencache=None,
+                     remotefolder=None):
+    """ Records uid in remotefolder as another copy (another label) of the
+    message we already have under gmmsgid, sharing its file, so that it
+    counts as known in that folder too (see known_uids).  The copy's row
+    has a hash of its own (see copy_hash), as the message's hash is
+    likely the same in both folders, and store_hash would replace the
+    original's row with it.
+    """
+
+    c = conn.cursor()
+    c.execute('select 1 from seenmessages where remotefolder = ? and uid = ?',
+              (remotefolder, uid))
+    if c.fetchone():
+        return
+    c.execute('select folder, mailfile, labels, internaldate, stub '
+              'from seenmessages where gmmsgid = ?', (gmmsgid,))
+    row = c.fetchone()
+    if row is None:
+        return
+    localfolder, mailfile, labels, internaldate, stub = row
+    import json
+    store_hash(conn, copy_hash(hash, remotefolder), mailfile, uid, seencache,
+               gmmsgid, labels is not None and json.loads(labels) or None,
+               remotefolder, internaldate, localfolder=localfolder, stub=stub)
+
+
+def backfill_gmail_msgids(conn, folder):
+    """ Databases from before we knew about X-GM-MSGID have rows without
+    one, and matching those up needs the ENVELOPE-based hash.  Ask the
+    server for the X-GM-MSGIDs of all the uids we know about, in bulk.
+    Returns True if no rows are left without one.
+    """
+
+    c = conn.cursor()
+    c.execute("select uid from seenmessages where gmmsgid is null "
+              "and uid is not null and mailfile not like 'POISON-%'")
+    uids = [int(row[0]) for row in c.fetchall()]
+    if not uids:
+        return True
+
+    log.info('Looking up gmail message ids for %i known messages...' % len(uids))
+    gmmsgids = folder.GmailMsgids(uids)
+    c.executemany('update seenmessages set gmmsgid = ? where uid = ? and gmmsgid is null',
+                  [(gmmsgid, uid) for uid, gmmsgid in gmmsgids.items()])
+    conn.commit()
+    log.info('Found %i of them; %i are no longer on the server' %
+             (len(gmmsgids), len(uids) - len(gmmsgids)))
+    return len(gmmsgids) == len(uids)
+
+
+def open_index(filename):
+    """ Opens the full-text index, creating it if need be.  Returns None
+    if this sqlite wasn't built with FTS5.
+    """
+
+    conn = sqlite3.connect(filename)
+    try:
+        conn.execute("""create virtual table if not exists messages using fts5
+            (folder unindexed, mailfile unindexed, sender, recipients, subject,
+             date unindexed, body)""")
+    except sqlite3.OperationalError:
+        log.warning('This sqlite has no FTS5, so there is no full-text index')
+        conn.close()
+        return None
+    return conn
+
+
+def start_index(filename):
+    """ Returns a running IndexWorker for the index in filename, or None if
+    we can't index
+    """
+
+    conn = open_index(filename)
+    if conn is None:
+        return None
+    conn.close()
+    index = IndexWorker(filename)
+    index.start()
+    return index
+
+
+def decode_header_value(value):
+    """ Turns a (possibly RFC 2047 encoded) header into text
+    """
+
+    if not value:
+        return ''
+    words = []
+    for text, charset in email.header.decode_header(value):
+        if isinstance(text, bytes):
+            try:
+                text = text.decode(charset or 'latin-1', 'replace')
+            except LookupError:
+                text = text.decode('latin-1')
+        words.append(text)
+    return ' '.join(words)
+
+
+def message_text(message, limit=256*1024):
+    """ Returns the decoded text/plain parts of a message (or its text/html
+    parts, minus the tags, if that's all it has), up to limit characters
+    """
+
+    plain = []
+    html = []
+    for part in message.walk():
+        ctype = part.get_content_type()
+        if ctype not in ('text/plain', 'text/html') or part.get_filename():
+            continue
+        payload = part.get_payload(decode=True) or b''
+        try:
+            text = payload.decode(part.get_content_charset() or 'latin-1',
+                                  'replace')
+        except LookupError:
+            text = payload.decode('latin-1')
+        if ctype == 'text/plain':
+            plain.append(text)
+        else:
+            html.append(re.sub(r'<[^>]*>', ' ', text))
+    return '\n'.join(plain or html)[:limit]
+
+
+def index_fields(message):
+    """ Returns (sender, recipients, subject, date, body) to index for a
+    message
+    """
+
+    recipients = ' '.join([decode_header_value(message.get(h))
+                           for h in ('To', 'Cc')])
+    return (decode_header_value(message.get('From')), recipients,
+            decode_header_value(message.get('Subject')),
+            message.get('Date', ''), message_text(message))
+
+
+def store_index(conn, msghash, folder, mailfile, fields):
+    """ Adds a message to the full-text index (replacing it, if it's
+    already there).  The rowid comes from the hash, so we don't need an
+    index of our own to find it again.  Doesn't commit.
+    """
+
+    conn.execute('insert or replace into messages (rowid, folder, mailfile, '
+                 'sender, recipients, subject, date, body) '
+                 'values (?,?,?,?,?,?,?,?)',
+                 (int(msghash[:15], 16), folder, mailfile) + tuple(fields))
+
+
+def index_job(job):
+    """ reindex()'s worker: reads and parses one message, and returns its
+    fields (None if it couldn't)
+    """
+
+    msghash, folder, mailfile, path, content = job
+    try:
+        if content is None:
+            message = read_message_file(path)
+        elif hasattr(email, 'message_from_bytes'):
+            message = email.message_from_bytes(content)
+        else:
+            message = email.message_from_string(content)
+        return msghash, folder, mailfile, index_fields(message)
+    except Exception:
+        return msghash, folder, mailfile, None
+
+
+def reindex(conn, mbox, filename, processes=None, chunksize=1000):
+    """ Rebuilds the full-text index from the messages in the mailbox,
+    parsing them in a pool of processes.  Returns the number indexed.
+    """
+
+    import multiprocessing
+
+    index = open_index(filename)
+    if index is None:
+        return 0
+    index.execute('delete from messages')
+
+    count = 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        c = conn.cursor()
+        c.execute('select min(hash), folder, mailfile from seenmessages '
+                  'group by folder, mailfile')
+        while True:
+            rows = c.fetchmany(chunksize)
+            if not rows:
+                break
+            jobs = []
+            for msghash, localfolder, mailfile in rows:
+                if str(mailfile).startswith('POISON-'):
+                    continue
+                try:
+                    if isinstance(mbox, mailbox.mbox):
+                        jobs.append((msghash, localfolder, mailfile, None,
+                                     mbox.get_file(int(mailfile)).read()))
+                        continue
+                    fmbox = folder_mailbox(mbox, localfolder)
+                    jobs.append((msghash, localfolder, mailfile,
+                                 os.path.join(fmbox._path,
+                                              fmbox._lookup(mailfile)), None))
+                except KeyError:
+                    log.warning('MISSING: %s' % mailfile)
+
+            for msghash, localfolder, mailfile, fields in \
+                    pool.imap_unordered(index_job, jobs, 16):
+                if fields is None:
+                    log.warning('Could not index %s' % mailfile)
+                    continue
+                store_index(index, msghash, localfolder, mailfile, fields)
+                count += 1
+            index.commit()
+            log.info('Indexed %i messages' % count)
+    finally:
+        pool.close()
+        pool.join()
+        index.close()
+    return count
+
+
+def search(mbox, filename, query):
+    """ Yields the paths (or, for an mbox, path:key) of the messages
+    matching query, best first.  query uses FTS5's syntax, e.g.
+    'subject:invoice AND sender:bob'.
+    """
+
+    index = open_index(filename)
+    if index is None:
+        return
+    try:
+        c = index.execute('select folder, mailfile from messages '
+                          'where messages match ? order by rank', (query,))
+        for localfolder, mailfile in c:
+            if isinstance(mbox, mailbox.mbox):
+                yield '%s:%s' % (mbox._path, mailfile)
+                continue
+            fmbox = folder_mailbox(mbox, localfolder)
+            try:
+                yield os.path.join(fmbox._path, fmbox._lookup(mailfile))
+            except KeyError:
+                log.debug('%s is in the index, but not on disk' % mailfile)
+    finally:
+        index.close()
+
+
+def check_uidvalidity(conn, folder, seencache=None):
+    """ Makes sure the uids we have for a (selected) folder still mean
+    something: if its UIDVALIDITY has changed since last time, they don't,
+    so forget them.  (The hashes will match them up again.)
+    """
+
+    c = conn.cursor()
+    c.execute('select uidvalidity from folderstate where folder = ?',
+              (folder.folder,))
+    row = c.fetchone()
+    if row is None:
+        c.execute('insert into folderstate (folder, uidvalidity) '
+                  'values (?, ?)', (folder.folder, folder.uidvalidity))
+    elif row[0] != folder.uidvalidity:
+        log.warning('UIDVALIDITY of %s changed from %s to %s; forgetting '
+                    'its uids' % (folder.folder, row[0], folder.uidvalidity))
+        c.execute('update seenmessages set uid = null where remotefolder = ?',
+                  (folder.folder,))
+        c.execute('update folderstate set uidvalidity = ?, highestmodseq = null '
+                  'where folder = ?', (folder.uidvalidity, folder.folder))
+        if seencache:
+            seencache.wait()
+            seencache.uids = None
+            seencache.uidset = None
+    conn.commit()
+
+
+def folder_unchanged(conn, remotefolder, status):
+    """ Says whether a folder's STATUS (from get_folder_status) is the same
+    as at the end of its last complete pass, so there's nothing to do
+    """
+
+    c = conn.cursor()
+    c.execute('select uidvalidity, messages, uidnext, statusmodseq '
+              'from folderstate where folder = ?', (remotefolder,))
+    row = c.fetchone()
+    return row is not None and row[1] is not None and \
+        tuple(row) == (status.get('UIDVALIDITY'), status.get('MESSAGES'),
+                       status.get('UIDNEXT'), status.get('HIGHESTMODSEQ'))
+
+
+def store_folder_status(conn, remotefolder, status):
+    """ Remembers a folder's STATUS, once a pass over it is complete
+    """
+
+    c = conn.cursor()
+    c.execute('update folderstate set messages = ?, uidnext = ?, '
+              'statusmodseq = ? where folder = ? and uidvalidity = ?',
+              (status.get('MESSAGES'), status.get('UIDNEXT'),
+               status.get('HIGHESTMODSEQ'), remotefolder,
+               status.get('UIDVALIDITY')))
+    conn.commit()
+
+
+def sync_flags(conn, folder, mbox):
+    """ Brings the maildir flags (the :2,FRS bit of the file name) of the
+    messages from folder into line with the server's, moving them into
+    cur/.  Only files whose flags have changed are renamed, and flags
+    IMAP has no word for (e.g. P, passed) are left as they are.  With
+    CONDSTORE, only messages changed since last time are asked about.
+    Returns the number of files renamed.
+    """
+
+    c = conn.cursor()
+    c.execute('select highestmodseq from folderstate where folder = ?',
+              (folder.folder,))
+    row = c.fetchone()
+    flags, modseq = folder.Flags(row and row[0] or None)
+
+    # Where the messages are, in one go rather than a query per uid
+    files = {}
+    if flags:
+        c.execute('select uid, folder, mailfile from seenmessages '
+                  'where remotefolder = ? and uid is not null', (folder.folder,))
+        for uid, localfolder, mailfile in c:
+            if uid in flags:
+                files.setdefault(uid, []).append((localfolder, mailfile))
+
+    renamed = 0
+    for uid in sorted(files):
+        for localfolder, mailfile in files[uid]:
+            if str(mailfile).startswith('POISON-'):
+                continue
+            fmbox = folder_mailbox(mbox, localfolder)
+            try:
+                subpath = fmbox._lookup(mailfile)
+            except KeyError:
+                continue
+
+            subdir, name = os.path.split(subpath)
+            oldinfo = None
+            if fmbox.colon + '2,' in name:
+                oldinfo = name.split(fmbox.colon + '2,')[-1]
+            info = ''.join(sorted(set([imapflags[f.lower()] for f in flags[uid]
+                                       if f.lower() in imapflags] +
+                                      [f for f in oldinfo or ''
+                                       if f not in syncedflags])))
+            if (subdir == 'cur' and oldinfo == info) or \
+               (subdir == 'new' and not info):
+                continue
+            newsubpath = os.path.join('cur', mailfile + fmbox.colon + '2,' + info)
+            os.rename(os.path.join(fmbox._path, subpath),
+                      os.path.join(fmbox._path, newsubpath))
+            fmbox._toc[mailfile] = newsubpath
+            renamed += 1
+
+    c.execute('update folderstate set highestmodseq = ? where folder = ?',
+              (modseq, folder.folder))
+    conn.commit()
+    log.debug('Flags: %i changed on the server, %i files renamed' %
+              (len(flags), renamed))
+    return renamed
+
+
+def pending_stubs(conn, remotefolder):
+    """ Returns how many of the messages from remotefolder are stubs
+    still to be filled in (see fill_stubs)
+    """
+
+    c = conn.cursor()
+    c.execute('select count(*) from seenmessages where remotefolder = ? '
+              'and stub is not null and uid is not null', (remotefolder,))
+    return c.fetchone()[0]
+
+
+def fill_stubs(conn, folder, mbox, index=None):
+    """ Replaces the stubs saved by --max-body-size for messages from
+    folder with the whole messages, fetched in chunks.  They're replaced
+    in place: a maildir file keeps its name (and so its flags), and an
+    mbox message its From line, flags and position.  A stub is only
+    replaced once all RFC822.SIZE bytes of its message have arrived; if
+    the message has gone from the server, the stub is all we'll ever
+    have, so it's kept.  Returns the number of stubs filled in.
+    """
+
+    c = conn.cursor()
+    c.execute('select hash, folder, mailfile, uid from seenmessages '
+              'where remotefolder = ? and stub is not null '
+              'and uid is not null order by uid', (folder.folder,))
+    rows = c.fetchall()
+    if not rows:
+        return 0
+
+    if isinstance(mbox, mailbox.Maildir):
+        tmpdir = os.path.join(mbox._path, 'tmp')
+    else:
+        tmpdir = mbox._path + '.partial'
+        if not os.path.isdir(tmpdir):
+            os.mkdir(tmpdir)
+
+    log.info('Filling in %i stubs from %s...' % (len(rows), folder.folder))
+    sizes = folder.Sizes(simpleimap.UidSet.from_sorted(row[3] for row in rows))
+    filled = []
+    for msghash, localfolder, mailfile, uid in rows:
+        # Named as LargeMessageLane.partfile, so either can pick up what
+        # the other left off
+        path = os.path.join(tmpdir, 'imap2maildir-%s-%i.part' %
+                            (folder.uidvalidity, uid))
+        if uid not in sizes:
+            log.warning('uid %i is gone from %s; keeping its stub, %s' %
+                        (uid, folder.folder, mailfile))
+            if os.path.exists(path):
+                os.unlink(path)
+            continue
+        try:
+            fileobj = open(path, 'ab')
+            try:
+                size = folder.MessageToFile(uid, fileobj)
+            finally:
+                fileobj.close()
+        except simpleimap.UidValidityError:
+            raise
+        except Exception:
+            log.exception('ERROR: Could not fill in the stub of uid %i' % uid)
+            continue
+        if not size or size < sizes[uid]:
+            log.warning('Got %i of the %i bytes of uid %i; keeping its stub, '
+                        '%s' % (size, sizes[uid], uid, mailfile))
+            os.unlink(path)
+            continue
+
+        message = read_message_file(path)
+        try:
+            if isinstance(mbox, mailbox.Maildir):
+                fmbox = folder_mailbox(mbox, localfolder)
+                subpath = fmbox._lookup(mailfile)
+                tmpfile = fmbox._create_tmp()
+                try:
+                    fmbox._dump_message(message, tmpfile)
+                except BaseException:
+                    tmpfile.close()
+                    os.remove(tmpfile.name)
+                    raise
+                mailbox._sync_close(tmpfile)
+                os.rename(tmpfile.name, os.path.join(fmbox._path, subpath))
+            else:
+                old = mbox.get_message(int(mailfile))
+                message = mailbox.mboxMessage(message)
+                message.set_from(old.get_from())
+                message.set_flags(old.get_flags())
+                mbox[int(mailfile)] = message
+        except KeyError:
+            log.warning('MISSING: %s' % mailfile)
+            continue
+        os.unlink(path)
+        if index:
+            index.submit(msghash, localfolder or '', mailfile, message)
+        log.debug(' FILLED: uid %i, %s' % (uid, mailfile))
+        # ...for every folder the file is shared with (gmail labels)
+        filled.append((localfolder, mailfile))
+
+    if filled and isinstance(mbox, mailbox.mbox):
+        mbox.flush()
+    c.executemany('update seenmessages set stub = null where folder = ? '
+                  'and mailfile = ?', filled)
+    conn.commit()
+    log.info('Filled in %i of %i stubs from %s' %
+             (len(filled), len(rows), folder.folder))
+    return len(filled)
+
+
+def mirror_deletes(conn, folder, mbox, trash=None, threshold=10,
+                   seencache=None):
+    """ Removes local copies of messages that have gone from the folder on
+    the server, moving them to the trash maildir if given.  Only messages
+    recorded with the folder's name (and current UIDVALIDITY) are
+    considered.  If more than threshold percent of them would go, nothing
+    is removed.  A message the server has more than one copy of is only
+    recorded under one of their uids, so if that one goes, the others
+    are looked for, and the message is kept (under one of theirs) if any
+    of them is still there.  A file shared with a copy in another folder
+    (gmail labels; see store_gmail_copy) stays until that copy goes too.
+    Returns the number of messages removed.
+    """
+
+    c = conn.cursor()
+    c.execute('select uid from seenmessages where remotefolder = ? '
+              'and uid is not null order by uid', (folder.folder,))
+    known = simpleimap.UidSet.from_sorted(int(row[0]) for row in c)
+    if len(known) == 0:
+        return 0
+
+    serveruids = folder.UidSet('ALL')
+    vanished = known.difference(serveruids)
+    if len(vanished) == 0:
+        return 0
+    if len(vanished) * 100.0 > threshold * len(known):
+        log.error('%i of %i messages from %s are gone from the server, more '
+                  'than --mirror-threshold (%i%%); not removing anything' %
+                  (len(vanished), len(known), folder.folder, threshold))
+        return 0
+
+    import shutil
+
+    # What we have under the vanished uids, asked for a chunk at a time
+    # (SQLite allows 999 parameters)
+    vanished = list(vanished)
+    rows = []
+    for i in range(0, len(vanished), 500):
+        chunk = vanished[i:i + 500]
+        c.execute('select uid, hash, folder, mailfile from seenmessages '
+                  'where remotefolder = ? and uid in (%s) order by uid' %
+                  ','.join('?' * len(chunk)), [folder.folder] + chunk)
+        rows.extend(c.fetchall())
+    if not rows:
+        return 0
+
+    # The uids the server has that we don't know are new messages, or
+    # other copies of ones we have
+    others = serveruids.difference(known)
+    if len(others):
+        others = [(summary_hash(summ), summ['uid']) for summ in
+                  folder.Summaries(search='UID %s' % others)]
+    survivors = {}
+
+    hashes = set()
+    doomed = []
+    for uid, msghash, localfolder, mailfile in rows:
+        if localfolder not in survivors:
+            survivors[localfolder] = dict([
+                (folder_hash(otherhash, localfolder), otheruid)
+                for otherhash, otheruid in others])
+        if msghash in survivors[localfolder]:
+            otheruid = survivors[localfolder][msghash]
+            log.debug(' KEPT: uid %i, %s, still there as uid %i' %
+                      (uid, mailfile, otheruid))
+            c.execute('update seenmessages set uid = ? where hash = ?',
+                      (otheruid, msghash))
+            continue
+        hashes.add(msghash)
+        if not str(mailfile).startswith('POISON-'):
+            doomed.append((uid, localfolder, mailfile))
+
+    # Files still used by a row that isn't going (copies in other folders)
+    shared = set()
+    mailfiles = list(set(mailfile for uid, localfolder, mailfile in doomed))
+    for i in range(0, len(mailfiles), 500):
+        chunk = mailfiles[i:i + 500]
+        c.execute('select hash, folder, mailfile from seenmessages '
+                  'where mailfile in (%s)' % ','.join('?' * len(chunk)),
+                  chunk)
+        shared.update((localfolder, mailfile)
+                      for msghash, localfolder, mailfile in c
+                      if msghash not in hashes)
+
+    for uid, localfolder, mailfile in doomed:
+        if (localfolder, mailfile) in shared:
+            log.debug(' GONE: uid %i, %s (kept for another folder)' %
+                      (uid, mailfile))
+            continue
+        fmbox = folder_mailbox(mbox, localfolder)
+        try:
+            if trash is None:
+                fmbox.remove(mailfile)
+            else:
+                subpath = fmbox._lookup(mailfile)
+                shutil.move(os.path.join(fmbox._path, subpath),
+                            os.path.join(trash._path, subpath))
+                del fmbox._toc[mailfile]
+        except KeyError:
+            log.debug('uid %i (%s) was already gone locally' %
+                      (uid, mailfile))
+        log.debug(' GONE: uid %i, %s' % (uid, mailfile))
+
+    c.executemany('delete from seenmessages where hash = ?',
+                  [(msghash,) for msghash in hashes])
     conn.commit()
+    if seencache:
+        seencache.wait()
+        seencache.hashes = seencache.uids = seencache.uidset = None
+    log.info('Removed %i messages that are gone from %s' %
+             (len(hashes), folder.folder))
+    return len(hashes)
+
 
+def stat_message_file(path):
+    """ Returns the size of the file at path, or None if it isn't there
+    """
 
-def add_uid_to_hash(conn, hash, uid):
-    """ Adds a uid to a hash that's missing its uid
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+
+def verify(conn, mbox, folder=None, slicesize=0, threads=8):
+    """ Cross-checks seenmessages against the mailbox on disk and, if a
+    folder is given, against the uids on the server.  With a slicesize,
+    only that many rows are checked per run, carrying on from where the
+    last run left off; orphans (in the maildir and all its subfolders, or
+    the mbox) and the server are checked once the last slice is done.
+    The size check only catches empty files: a message isn't stored
+    byte for byte as the server sent it, so there's no size to hold a
+    short one up against.
+
+    Returns: {'checked': rows checked this run,
+              'missing': rows whose message isn't on disk,
+              'empty': rows whose message file is empty,
+              'poison': POISON- rows,
+              'complete': True if this run finished a full pass,
+              'orphans': messages on disk that aren't in the database,
+              'notonserver': uids we have that the server doesn't (if
+                             folder given),
+              'notdownloaded': uids the server has that we don't (if
+                               folder given)}
     """
 
+    import multiprocessing.pool
+
+    outdict = {'checked': 0, 'missing': 0, 'empty': 0, 'poison': 0,
+               'orphans': 0}
     c = conn.cursor()
-    c.execute('update seenmessages set uid = ? where hash = ?', (uid, hash))
+    c.execute("select value from verifystate where name = 'lastrowid'")
+    row = c.fetchone()
+    lastrowid = row and row[0] or 0
+
+    query = ('select rowid, hash, folder, mailfile from seenmessages '
+             'where rowid > ? order by rowid')
+    if slicesize > 0:
+        c.execute(query + ' limit ?', (lastrowid, slicesize))
+    else:
+        c.execute(query, (lastrowid,))
+    rows = c.fetchall()
+    outdict['checked'] = len(rows)
+    outdict['complete'] = slicesize <= 0 or len(rows) < slicesize
+
+    # Work out where everything should be, then stat it all in parallel
+    paths = []
+    for rowid, msghash, localfolder, mailfile in rows:
+        if str(mailfile).startswith('POISON-'):
+            log.warning('POISON: %s' % msghash)
+            outdict['poison'] += 1
+        elif isinstance(mbox, mailbox.mbox):
+            if int(mailfile) not in mbox:
+                log.warning('MISSING: %s (%s)' % (msghash, mailfile))
+                outdict['missing'] += 1
+        else:
+            fmbox = folder_mailbox(mbox, localfolder)
+            try:
+                paths.append((msghash, os.path.join(fmbox._path,
+                                                    fmbox._lookup(mailfile))))
+            except KeyError:
+                log.warning('MISSING: %s (%s)' % (msghash, mailfile))
+                outdict['missing'] += 1
+
+    pool = multiprocessing.pool.ThreadPool(threads)
+    try:
+        sizes = pool.map(stat_message_file, [p[1] for p in paths], 64)
+    finally:
+        pool.close()
+        pool.join()
+    for (msghash, path), size in zip(paths, sizes):
+        if size is None:
+            log.warning('MISSING: %s (%s)' % (msghash, path))
+            outdict['missing'] += 1
+        elif size == 0:
+            log.warning('EMPTY: %s (%s)' % (msghash, path))
+            outdict['empty'] += 1
+
+    if rows:
+        lastrowid = rows[-1][0]
+    if outdict['complete']:
+        lastrowid = 0
+    c.execute("insert or replace into verifystate (name, value) "
+              "values ('lastrowid', ?)", (lastrowid,))
     conn.commit()
 
+    if not outdict['complete']:
+        return outdict
+
+    # Anything on disk we don't know about?
+    known = {'': set()}
+    if isinstance(mbox, mailbox.Maildir):
+        for localfolder in mbox.list_folders():
+            known[localfolder] = set()
+    c.execute('select folder, mailfile from seenmessages')
+    for localfolder, mailfile in c:
+        known.setdefault(localfolder or '', set()).add(str(mailfile))
+    for localfolder in known:
+        fmbox = folder_mailbox(mbox, localfolder)
+        for key in fmbox.keys():
+            if str(key) not in known[localfolder]:
+                log.warning('ORPHAN: %s in %s' % (key, fmbox._path))
+                outdict['orphans'] += 1
+
+    # And how about the server?
+    if folder is not None:
+        len(folder)
+        c.execute('select uidvalidity from folderstate where folder = ?',
+                  (folder.folder,))
+        row = c.fetchone()
+        if row and row[0] != folder.uidvalidity:
+            log.warning('UIDVALIDITY of %s has changed since the last sync; '
+                        'not comparing uids' % folder.folder)
+        else:
+            c.execute('select uid from seenmessages where remotefolder = ? '
+                      'and uid is not null order by uid', (folder.folder,))
+            localuids = simpleimap.UidSet.from_sorted(int(row[0]) for row in c)
+            serveruids = folder.UidSet('ALL')
+            outdict['notonserver'] = len(localuids.difference(serveruids))
+            outdict['notdownloaded'] = len(serveruids.difference(localuids))
+
+    return outdict
+
+
+def restore(conn, mbox, server, defaultfolder, folder=None, connections=4,
+            batchsize=50):
+    """ Uploads the messages in the mailbox to the server, each to the
+    folder it was downloaded from (or defaultfolder, if we don't know),
+    or all of them to folder.  Flags and INTERNALDATE are kept, messages
+    already there (same Message-ID and size) are skipped, and batches of
+    batchsize messages are uploaded over several connections at once.
+
+    Returns: {'restored': messages uploaded,
+              'skipped': messages already there (or uploaded already,
+                         from another copy in the mailbox),
+              'failed': messages that couldn't be read or uploaded
+                        (or are only stubs),
+              'bytes': bytes uploaded}
+    """
+
+    c = conn.cursor()
+    if folder:
+        targets = [folder]
+    else:
+        c.execute('select distinct remotefolder from seenmessages')
+        targets = [row[0] or defaultfolder for row in c.fetchall()]
+
+    # What's there already?
+    imap = server.Get()
+    present = {}
+    for target in set(targets):
+        imap.create(simpleimap.quote_mailbox(target))
+        present[target] = imap.get_msgids_and_sizes_by_folder(target)
+        log.info('Restoring to %s, which has %i messages already' %
+                 (target, len(present[target])))
+
+    jobs = queue.Queue(connections * 2)
+    lock = threading.Lock()
+    workers = [RestoreWorker(server, jobs, present, lock)
+               for i in range(connections)]
+    for worker in workers:
+        worker.start()
+
+    failed = 0
+    batches = {}
+    c.execute('select folder, mailfile, remotefolder, internaldate, stub '
+              'from seenmessages order by rowid')
+    for localfolder, mailfile, remotefolder, internaldate, stub in c:
+        if str(mailfile).startswith('POISON-'):
+            continue
+        if stub is not None:
+            # Uploading it would put a stub where the message was
+            log.warning('STUB: %s; run a sync with --fill-stubs first' %
+                        mailfile)
+            failed += 1
+            continue
+        target = folder or remotefolder or defaultfolder
+        try:
+            if isinstance(mbox, mailbox.mbox):
+                path = None
+                content = mbox.get_file(int(mailfile)).read()
+                status = re.findall(r'^(?:X-)?Status:[ \t]*(.*)$',
+                    simpleimap._str(content.split(b'\n\n', 1)[0]),
+                    re.IGNORECASE | re.MULTILINE)
+                flags = [mboxflags[f] for f in sorted(set(''.join(status)))
+                         if f in mboxflags]
+            else:
+                fmbox = folder_mailbox(mbox, localfolder)
+                subpath = fmbox._lookup(mailfile)
+                path = os.path.join(fmbox._path, subpath)
+                content = None
+                info = ':2,' in subpath and subpath.split(':2,')[-1] or ''
+                flags = [maildirflags[f] for f in info if f in maildirflags]
+        except KeyError:
+            log.warning('MISSING: %s' % mailfile)
+            failed += 1
+            continue
+
+        batch = batches.setdefault(target, [])
+        batch.append((path, content, ' '.join(flags), internaldate))
+        if len(batch) >= batchsize:
+            jobs.put((target, batch))
+            batches[target] = []
+
+    for target in batches:
+        if batches[target]:
+            jobs.put((target, batches[target]))
+    for worker in workers:
+        jobs.put(None)
+    for worker in workers:
+        worker.join()
+
+    outdict = {'restored': 0, 'skipped': 0, 'failed': failed, 'bytes': 0}
+    for worker in workers:
+        for key in outdict:
+            outdict[key] += worker.outdict[key]
+    return outdict
+
+
+def read_message_file(path, raw=False):
+    """ Reads a message from a file, e.g. one fetched in chunks (as bytes,
+    if raw)
+    """
+
+    fileobj = open(path, 'rb')
+    try:
+        if raw:
+            return fileobj.read()
+        if hasattr(email, 'message_from_binary_file'):
+            return email.message_from_binary_file(fileobj)
+        return email.message_from_file(fileobj)
+    finally:
+        fileobj.close()
+
+
+def write_message(db, imap, mbox, message, summary, msghash, mboxdash=False,
+                  seencache=None, remotefolder=None, index=None, journal=None,
+                  localfolder=None, stub=None):
+    """ Adds a message fetched from the server to the mailbox (or its
+    localfolder subfolder), and records it in the database (and, if given
+    an IndexWorker, the full-text index).  With a Journal, the write is
+    journalled and the commit left to it.  If message is a stub, stub is
+    how many bytes it leaves out.  Returns the new key.
+    """
+
+    if mboxdash:
+        envfrom = '-'
+    elif summary['envfrom']:
+        envfrom = summary['envfrom']
+    else:
+        # No ENVELOPE (gmail); dig it out of the message instead
+        envfrom = email.utils.parseaddr(message.get('From', ''))[1] or 'MAILER-DAEMON'
+    message.set_unixfrom("From %s %s" % (envfrom,
+                    time.asctime(imap.parseInternalDate(summary['date']))))
+    record = {'hash': msghash, 'uid': summary['uid'],
+              'gmmsgid': summary.get('gmmsgid'),
+              'labels': summary.get('labels'),
+              'remotefolder': remotefolder,
+              'internaldate': simpleimap.internaldate_to_epoch(summary['date']),
+              'localfolder': localfolder,
+              'stub': stub}
+    fmbox = folder_mailbox(mbox, localfolder)
+    if journal:
+        msgfile = journal.add(fmbox, message, record)
+    else:
+        msgfile = fmbox.add(message)
+    store_hash(db, msghash, msgfile, summary['uid'], seencache,
+               gmmsgid=record['gmmsgid'], labels=record['labels'],
+               remotefolder=remotefolder,
+               internaldate=record['internaldate'], commit=journal is None,
+               localfolder=localfolder, stub=stub)
+    if journal:
+        journal.done()
+    if index:
+        index.submit(msghash, localfolder or '', msgfile, message)
+    log.debug(' NEW: ' + repr(summary))
+    return msgfile
+
 
 def open_mailbox_maildir(directory, create=False):
     """ There is a mailbox here.
@@ -340,7 +2318,7 @@ def parse_options(defaults):
         defaults, configfile=firstoptions.configfile)
 
     # Parse command line options
-    usage = "usage: %prog [options]"
+    usage = "usage: %prog [options] [" + '|'.join(commands) + "] [QUERY]"
     description =  "A script to copy a remote IMAP folder to a local mail "
     description += "storage area.  Ideal for incremental backups of mail "
     description += "from free webmail providers, or perhaps as an "
@@ -366,7 +2344,12 @@ def parse_options(defaults):
         iname = i[0]
         if i[1] == 'False': ivalue = False
         elif i[1] == 'True': ivalue = True
-        elif i[0] in ['port', 'debug', 'maxmessages']: ivalue = int(i[1])
+        elif i[0] in ['port', 'debug', 'maxmessages', 'pollinterval',
+                      'largesize', 'maxbytespersec', 'maxcommandspersec',
+                      'maxhostbytespersec', 'maxhostcommandspersec',
+                      'mirrorthreshold', 'verifyslice',
+                      'restoreconnections', 'maxbodysize']:
+            ivalue = int(i[1])
         else: ivalue = i[1]
         parser.set_default(iname, ivalue)
 
@@ -391,6 +2374,11 @@ def parse_options(defaults):
     optional.add_option("-r", "--remote-folder", dest="remotefolder",
         help="Remote IMAP folder.  Default: %default",
         metavar="FOLDERNAME")
+    optional.add_option("--all-folders", dest="allfolders",
+        action="store_true",
+        help="Copy every folder on the server, each to a Maildir++ " +
+             "subfolder (INBOX to the maildir itself), skipping folders " +
+             "that haven't changed (maildir only).  Default: %default")
     optional.add_option("-s", "--search", dest="search",
         help="IMAP4 search criteria to use.  Default: %default",
         metavar="CRITERIA")
@@ -403,6 +2391,10 @@ def parse_options(defaults):
         help="How many messages to process in one run (0=infinite). " +
              "Default: %default",
         metavar="MAX", type="int")
+    optional.add_option("--order", dest="order", action="store",
+        help="Which messages to copy first.  Choice of: oldest, newest, " +
+             "smallest.  Default: %default",
+        choices=['oldest', 'newest', 'smallest'])
     optional.add_option("-c", "--config-file", dest="configfile",
         help="Configuration file to use.  Default: %default")
     optional.add_option("-S", "--ssl", dest="ssl",
@@ -413,14 +2405,95 @@ def parse_options(defaults):
     optional.add_option("--mboxdash", dest="mboxdash", action="store_true",
         help="Use - in the mbox From line instead of sender's address. " +
              "Default: %default")
+    optional.add_option("--no-compress", dest="compress",
+        help="Don't use COMPRESS=DEFLATE, even if the server offers it.  " +
+             "Default: compress %default",
+        action="store_false")
+    optional.add_option("--daemon", dest="daemon", action="store_true",
+        help="Keep running, and copy new messages as they arrive.  " +
+             "Default: %default")
+    optional.add_option("--poll-interval", dest="pollinterval", type="int",
+        help="In --daemon mode, seconds between checks if the server " +
+             "doesn't support IDLE.  Default: %default", metavar="SECONDS")
+    optional.add_option("--large-message-size", dest="largesize", type="int",
+        help="Fetch messages at least this big in chunks, on a second " +
+             "connection (0=never).  Default: %default", metavar="BYTES")
+    optional.add_option("--max-body-size", dest="maxbodysize", type="int",
+        help="Save messages bigger than this as stubs: the headers and " +
+             "text, with the attachments left on the server (0=never).  " +
+             "Default: %default", metavar="BYTES")
+    optional.add_option("--fill-stubs", dest="fillstubs", action="store_true",
+        help="Fetch the whole of messages saved as stubs by " +
+             "--max-body-size.  Default: %default")
+    optional.add_option("--max-bytes-per-sec", dest="maxbytespersec",
+        type="int", metavar="BYTES",
+        help="Bandwidth cap for each connection (0=none).  Default: %default")
+    optional.add_option("--max-commands-per-sec", dest="maxcommandspersec",
+        type="int", metavar="COMMANDS",
+        help="Command rate cap for each connection (0=none).  " +
+             "Default: %default")
+    optional.add_option("--max-host-bytes-per-sec", dest="maxhostbytespersec",
+        type="int", metavar="BYTES",
+        help="Bandwidth cap for all connections to the server together " +
+             "(0=none).  Default: %default")
+    optional.add_option("--max-host-commands-per-sec",
+        dest="maxhostcommandspersec", type="int", metavar="COMMANDS",
+        help="Command rate cap for all connections to the server together " +
+             "(0=none).  Default: %default")
+    optional.add_option("--mirror-deletes", dest="mirrordeletes",
+        action="store_true",
+        help="Remove local copies of messages deleted from the server " +
+             "(maildir only).  Default: %default")
+    optional.add_option("--mirror-trash", dest="mirrortrash", metavar="PATH",
+        help="With --mirror-deletes, move messages to this maildir " +
+             "instead of deleting them.  Default: %default")
+    optional.add_option("--mirror-threshold", dest="mirrorthreshold",
+        type="int", metavar="PERCENT",
+        help="With --mirror-deletes, remove nothing if more than this " +
+             "percentage of messages would go.  Default: %default")
+    optional.add_option("--verify-server", dest="verifyserver",
+        action="store_true",
+        help="With verify, compare uids with the server's too.  " +
+             "Default: %default")
+    optional.add_option("--verify-slice", dest="verifyslice", type="int",
+        metavar="ROWS",
+        help="With verify, check this many messages per run, carrying on " +
+             "from the last run (0=all).  Default: %default")
+    optional.add_option("--restore-folder", dest="restorefolder",
+        metavar="FOLDERNAME",
+        help="With restore, upload everything to this folder, instead of " +
+             "the folders it came from.  Default: %default")
+    optional.add_option("--restore-connections", dest="restoreconnections",
+        type="int", metavar="N",
+        help="With restore, upload over this many connections at once.  " +
+             "Default: %default")
+    optional.add_option("--index", dest="index", action="store_true",
+        help="Add new messages to the full-text index, for search.  " +
+             "Default: %default")
+    optional.add_option("--sync-flags", dest="syncflags", action="store_true",
+        help="Keep the maildir flags (seen, flagged, replied...) in step " +
+             "with the server's (maildir only).  Default: %default")
 
     # Parse
     parser.add_option_group(required)
     parser.add_option_group(optional)
     (options, args) = parser.parse_args()
 
+    # What are we doing?
+    if args and args[0] not in commands:
+        parser.error("Command must be one of: %s" % ', '.join(commands))
+    options.command = args and args[0] or commands[0]
+    options.query = ' '.join(args[1:])
+    if options.command == 'search':
+        if not options.query:
+            parser.error("What should I search for?")
+    elif len(args) > 1:
+        parser.error("Only search takes more arguments.")
+    needserver = (options.command in ('sync', 'restore') or
+                  (options.command == 'verify' and options.verifyserver))
+
     # Check for required options
-    if not options.username:
+    if needserver and not options.username:
         parser.error("Must specify a username (-u/--username).")
     if not options.destination:
         parser.error("Must specify a destination directory (-d/--destination).")
@@ -434,7 +2507,16 @@ def parse_options(defaults):
           and not smells_like_maildir(options.destination)):
         parser.error("Directory '%s' exists, but it isn't a maildir."
                      % options.destination)
-    if not options.password:
+    if options.mirrordeletes and options.type != 'maildir':
+        parser.error("--mirror-deletes only works with maildirs.")
+    if options.syncflags and options.type != 'maildir':
+        parser.error("--sync-flags only works with maildirs.")
+    if options.allfolders and options.type != 'maildir':
+        parser.error("--all-folders only works with maildirs.")
+    if options.order not in ['oldest', 'newest', 'smallest']:
+        parser.error("--order must be one of: oldest, newest, smallest.")
+    if needserver and not options.password:
+        import getpass
         options.password = getpass.getpass()
 
     # Set up debugging
@@ -449,7 +2531,10 @@ def parse_options(defaults):
 
 
 def copy_messages_by_folder(folder, db, imap, mbox, limit=0, turbo=False,
-                            mboxdash=False, search=None, seencache=None):
+                            mboxdash=False, search=None, seencache=None,
+                            server=None, largesize=0, index=None,
+                            journal=None, order='oldest', localfolder=None,
+                            maxbodysize=0):
     """Copies any messages that haven't yet been seen from imap to mbox.
 
     copy_messages_by_folder(folder=simpleimap.SimpleImapSSL().Folder(),
@@ -461,68 +2546,169 @@ def copy_messages_by_folder(folder, db, imap, mbox, limit=0, turbo=False,
                             mboxdash=use '-' for mbox From line email?,
                             search=imap criteria (string),
                             seencache=an object to cache seen messages,
+                            server=simpleimap.Server(), to clone for the
+                                   large message lane,
+                            largesize=messages this big or bigger go to the
+                                      large message lane (0 = no lane),
+                            index=an IndexWorker, to index new messages,
+                            journal=a Journal, to journal writes and batch
+                                    commits,
+                            order=which messages to copy first: 'oldest',
+                                  'newest' or 'smallest',
+                            localfolder=maildir subfolder to copy to
+                                        (None = the maildir itself),
+                            maxbodysize=save messages bigger than this as
+                                        stubs, without their attachments
+                                        (0 = never),
 
     Returns: {'total': total length of folder,
               'handled': total messages handled,
               'copied': total messages copied,
               'copiedbytes': size of total messages copied,
-              'lastuid': last UID seen}
+              'stubbed': how many of those were saved as stubs,
+              'stubbedbytes': bytes the stubs left on the server,
+              'lastuid': last UID seen,
+              'complete': False if we stopped short (limit, errors),
+              'bytespersec': recent transfer rate (if server given),
+              'throttles': times the server throttled us (if server given)}
     """
 
-    outdict = {'turbo': 0, 'handled': 0, 'copied': 0, 'copiedbytes': 0, 'lastuid': 0}
+    outdict = {'turbo': 0, 'handled': 0, 'copied': 0, 'copiedbytes': 0, 'lastuid': 0,
+               'complete': True, 'stubbed': 0, 'stubbedbytes': 0}
     outdict['total'] = len(folder)
-    log.info("Synchronizing %i messages from %s:%s to %s..." % (outdict['total'], folder.host, folder.folder, mbox._path))
+    check_uidvalidity(db, folder, seencache)
+    summarycache = SummaryCache(db, folder.folder, folder.uidvalidity)
+    folder.__summarycache__(summarycache)
+    log.info("Synchronizing %i messages from %s:%s to %s..." % (outdict['total'], folder.host, folder.folder,
+             folder_mailbox(mbox, localfolder)._path))
+
+    # Big messages get fetched in chunks on a separate connection, so they
+    # don't hold up everything else.
+    lane = None
+    if server and largesize > 0:
+        if isinstance(mbox, mailbox.Maildir):
+            tmpdir = os.path.join(mbox._path, 'tmp')
+        else:
+            tmpdir = mbox._path + '.partial'
+            if not os.path.isdir(tmpdir):
+                os.mkdir(tmpdir)
 
-    msgpath = os.path.join(mbox._path, 'new')
+    def store_large_messages(wait=False):
+        """ Stores whatever the large message lane has finished
+        """
+
+        if lane is None:
+            return
+        for summary, msghash, path in lane.completed(wait):
+            if path is None:
+                # Already logged; the partial file will be resumed next run
+                outdict['complete'] = False
+                continue
+            write_message(db, imap, mbox, read_message_file(path), summary,
+                          msghash, mboxdash, seencache, folder.folder, index,
+                          journal, localfolder)
+            os.unlink(path)
+            outdict['copied'] += 1
+            outdict['copiedbytes'] += summary['size']
 
     if turbo:
-        # This will pass the check_message function and some useful cargo
-        # along to the Summaries() function in the FolderClass.  It will
-        # use this to check the local cache for the message before hitting
-        # the outside world.  (TODO: Make this less suckful.)
+        # Hand the uids we already know about to the Summaries() function
+        # in the FolderClass, which takes them out of the server's uid
+        # list in one pass, so we only ever hear about the new ones.
         log.debug('TURBO MODE ENGAGED!')
-        folder.__turbo__(lambda uid: check_message(db, mbox, uid=str(uid), seencache=seencache))
+        folder.__turbo__(known_uids(db, seencache))
     else:
         log.debug('Not using turbo mode...')
         folder.__turbo__(None)
 
+    # On gmail, X-GM-MSGID identifies a message across all folders (labels),
+    # so we can dedup on it and skip fetching the ENVELOPE.  Once every row
+    # in the database has one, that is.
+    envelope = True
+    if folder.IsGmail():
+        envelope = not backfill_gmail_msgids(db, folder)
+        log.debug('Gmail detected; %s ENVELOPEs' %
+                  (envelope and 'still fetching' or 'not fetching'))
+
     # Iterate through the message summary dicts for the folder.
-    for i in folder.Summaries(search=search):
+    for i in folder.Summaries(search=search, envelope=envelope, order=order):
         # i = {'uid': , 'msgid': , 'size': , 'date': }
+        # (plus 'gmmsgid': , 'gmthrid': , 'labels': on gmail)
         # Seen it yet?
-        msghash = make_hash(i['size'], i['date'], i['msgid'])
-
-        if not check_message(db, mbox, hash=msghash, seencache=seencache):
-            # Hash not found, copy it.
+        gmmsgid = i.get('gmmsgid')
+        msghash = folder_hash(summary_hash(i), localfolder)
+        stubbed = maxbodysize > 0 and i['size'] > maxbodysize
+
+        if gmmsgid and check_message(db, mbox, gmmsgid=gmmsgid, seencache=seencache):
+            # Already have it, perhaps from another label.
+            log.debug('Already have gmmsgid %i; updating labels', gmmsgid)
+            store_gmail_info(db, gmmsgid, i['labels'])
+            store_gmail_copy(db, gmmsgid, msghash, i['uid'], seencache,
+                             folder.folder)
+        elif (server and largesize > 0 and i['size'] >= largesize and
+              not stubbed and
+              not check_message(db, mbox, hash=msghash, seencache=seencache)):
+            # Hash not found, and it's a big one: off to the large lane.
+            if lane is None:
+                lane = LargeMessageLane(server, folder.folder,
+                                        folder.uidvalidity, tmpdir)
+            if lane.submit(i, msghash):
+                log.debug(' LARGE: queueing ' + repr(i))
+            else:
+                # Another copy on the server; it'll be stored once fetched
+                log.debug(' LARGE: uid %i is already queued as another uid'
+                          % i['uid'])
+        elif not check_message(db, mbox, hash=msghash, seencache=seencache):
+            # Hash not found, copy it (or, if it's too big, a stub of it).
+            message = stub = None
+            if stubbed:
+                try:
+                    message, stub = (folder.MessageStub(i['uid'], maxbodysize)
+                                     or (None, None))
+                except simpleimap.UidValidityError:
+                    raise
+                except Exception:
+                    log.warning('Could not make a stub of uid %i; fetching '
+                                'all of it' % i['uid'], exc_info=True)
             try:
-                message = imap.get_message_by_uid(i['uid'])
+                if message is None:
+                    message = folder.Message(i['uid'])
+            except simpleimap.UidValidityError:
+                raise
             except Exception:
                 log.exception('ERROR: Could not retrieve message: %s' % repr(i))
                 if outdict['handled'] < 1:
                     log.error("Adding message hash %s to seencache, to avoid "
                               "future problems...", msghash)
-                    store_hash(db, msghash, 'POISON-%s' % msghash, i['uid'])
-                    add_uid_to_hash(db, msghash, i['uid'])
+                    store_hash(db, msghash, 'POISON-%s' % msghash, i['uid'],
+                               remotefolder=folder.folder,
+                               localfolder=localfolder)
+                outdict['complete'] = False
                 break
 
-            if mboxdash:
-                envfrom = '-'
-            else:
-                envfrom = i['envfrom']
-            message.set_unixfrom("From %s %s" % (envfrom,
-                            time.asctime(imap.parseInternalDate(i['date']))))
-            msgfile = mbox.add(message)
-            store_hash(db, msghash, msgfile, i['uid'])
-            log.debug(' NEW: ' + repr(i))
+            write_message(db, imap, mbox, message, i, msghash, mboxdash,
+                          seencache, folder.folder, index, journal,
+                          localfolder, stub)
             outdict['copied'] += 1
-            outdict['copiedbytes'] += i['size']
+            outdict['copiedbytes'] += i['size'] - (stub or 0)
+            if stub:
+                log.debug(' STUB: uid %i, left %i bytes on the server' %
+                          (i['uid'], stub))
+                outdict['stubbed'] += 1
+                outdict['stubbedbytes'] += stub
+        elif gmmsgid:
+            # Hash is there, but from before we knew its X-GM-MSGID
+            log.debug('Adding gmmsgid %i to msghash %s', gmmsgid, msghash)
+            store_gmail_info(db, gmmsgid, i['labels'], hash=msghash, seencache=seencache)
         elif not check_message(db, mbox, uid=str(i['uid']), seencache=seencache):
             # UID is missing in the database (old version needs updated)
             log.debug('Adding uid %i to msghash %s', i['uid'], msghash)
-            add_uid_to_hash(db, msghash, i['uid'])
+            add_uid_to_hash(db, msghash, i['uid'], seencache, folder.folder)
         else:
             log.debug('Unexpected turbo mode on uid %i', i['uid'])
 
+        store_large_messages()
+
         # Update our counters.
         outdict['handled'] += 1
         outdict['turbo'] = folder.turbocounter()
@@ -532,16 +2718,268 @@ def copy_messages_by_folder(folder, db, imap, mbox, limit=0, turbo=False,
             log.info('Copied: %i, Turbo: %i, Seen: %i (%i%%, latest UID %i, date %s)' %
                      (outdict['copied'], outdict['turbo'], outdict['handled'],
                       percentage, i['uid'], i['date']))
+            if server:
+                log.debug('Rate: %(bytespersec)i bytes/s, %(commandspersec).1f '
+                          'commands/s, %(throttles)i throttles, pausing '
+                          '%(pause).1fs' % server.Stats())
         outdict['lastuid'] = i['uid']
         if (outdict['handled'] >= limit) and (limit > 0):
             log.info('Limit of %i messages reached' % limit)
+            outdict['complete'] = False
             break
 
+    # Wait for the large message lane to finish up
+    if lane is not None:
+        log.info('Waiting for large messages to finish downloading...')
+    store_large_messages(wait=True)
+    if journal:
+        journal.checkpoint()
+    # Only worth asking the server what's still there if we cached some
+    if summarycache.summaries:
+        summarycache.purge(folder.UidSet('ALL'))
+    else:
+        summarycache.purge()
+    if summarycache.hits:
+        log.debug('Summary cache: used %i summaries' % summarycache.hits)
+
     # Make sure this gets updated...
     outdict['turbo'] = folder.turbocounter()
+    if folder.missedcounter():
+        # Skipped without a summary; they'll be tried again next time
+        log.warning('Could not get summaries for %i messages' %
+                    folder.missedcounter())
+        outdict['complete'] = False
+    stats = folder.BatchStats()['summaries']
+    outdict['batchsize'] = stats['size']
+    outdict['batchrtt'] = stats['rtt']
+    if server:
+        stats = server.Stats()
+        outdict['bytespersec'] = stats['bytespersec']
+        outdict['throttles'] = stats['throttles']
     return outdict
 
 
+def log_result(result):
+    """ Print results.
+    """
+
+    log.info('FINISHED: Turboed %(turbo)i, handled %(handled)i, copied %(copied)i (%(copiedbytes)i bytes), last UID was %(lastuid)i' % result)
+    if result.get('stubbed'):
+        log.info('Saved %(stubbed)i as stubs, leaving %(stubbedbytes)i bytes on the server' % result)
+    if 'bytespersec' in result:
+        log.info('Transfer rate %(bytespersec)i bytes/s; throttled %(throttles)i times' % result)
+    if 'batchsize' in result:
+        log.debug('Summary batch size %(batchsize)i, round trip %(batchrtt).2fs' % result)
+
+
+def log_verify_result(result):
+    """ Print verify results.
+    """
+
+    log.info('VERIFIED: checked %(checked)i, missing %(missing)i, empty %(empty)i, poison %(poison)i' % result)
+    if result['complete']:
+        log.info('Orphans: %(orphans)i' % result)
+    else:
+        log.info('Not done yet; run verify again to carry on')
+    if 'notonserver' in result:
+        log.info('Not on server: %(notonserver)i, not downloaded: %(notdownloaded)i' % result)
+
+
+def log_restore_result(result):
+    """ Print restore results.
+    """
+
+    log.info('RESTORED: %(restored)i (%(bytes)i bytes), skipped %(skipped)i already there, failed %(failed)i' % result)
+
+
+def connect(options):
+    """ Connects to the IMAP server
+    """
+
+    return simpleimap.Server(hostname=options.hostname,
+                   username=options.username, password=options.password,
+                   port=options.port, ssl=options.ssl,
+                   compress=options.compress,
+                   limits={'bytespersec': options.maxbytespersec,
+                           'commandspersec': options.maxcommandspersec,
+                           'hostbytespersec': options.maxhostbytespersec,
+                           'hostcommandspersec':
+                               options.maxhostcommandspersec})
+
+
+def sync(options, db, mbox, imapserver, seencache=None, journal=None):
+    """ Copies new messages from the server, and keeps doing so in daemon
+    mode
+    """
+
+    index = None
+    if options.index:
+        index = start_index(options.indexfile)
+    try:
+        if options.allfolders:
+            sync_all_folders(options, db, mbox, imapserver, index, seencache,
+                             journal)
+        else:
+            sync_folder(options, db, mbox, imapserver, index, seencache,
+                        journal)
+    finally:
+        if index:
+            index.close()
+
+
+def sync_folder(options, db, mbox, imapserver, index=None, seencache=None,
+                journal=None):
+    """ sync(), once the index is sorted out
+    """
+
+    if seencache is None:
+        seencache = SeenMessagesCache()
+
+    trash = None
+    if options.mirrordeletes and options.mirrortrash:
+        trash = open_mailbox_maildir(options.mirrortrash, create=True)
+
+    imap = imapserver.Get()
+
+    # Instantiate a folder
+    folder = imap.Folder(folder=options.remotefolder)
+    folder.__reconnector__(imapserver.Reconnect)
+    imapserver.StartKeepalive()
+
+    sync_once(options, db, mbox, imap, folder, imapserver, trash, index,
+              seencache, journal)
+
+    # In daemon mode, keep the connection, database and seencache
+    # warm, and go again whenever the server tells us something changed.
+    while options.daemon:
+        log.debug('Waiting for changes to %s...' % options.remotefolder)
+        try:
+            changed = imapserver.Wait(interval=options.pollinterval)
+        except simpleimap.ConnectionErrors:
+            log.warning('Lost connection while waiting; reconnecting')
+            folder.Reconnect()
+            changed = True
+        if changed:
+            sync_once(options, db, mbox, imap, folder, imapserver, trash,
+                      index, seencache, journal)
+
+
+def sync_all_folders(options, db, mbox, imapserver, index=None,
+                     seencache=None, journal=None):
+    """ sync_folder(), for every folder on the server (--all-folders), each
+    to its Maildir++ subfolder (see maildir_folder_name).  The STATUS of
+    every folder is asked for at once, and folders that haven't changed
+    since their last complete pass are skipped without being SELECTed.
+    In daemon mode, a pass is made every pollinterval seconds.
+    """
+
+    if seencache is None:
+        seencache = SeenMessagesCache()
+
+    trash = None
+    if options.mirrordeletes and options.mirrortrash:
+        trash = open_mailbox_maildir(options.mirrortrash, create=True)
+
+    imapserver.StartKeepalive()
+    sizers = None
+    while True:
+        imap = imapserver.Get()
+        try:
+            listing = imap.get_folder_list()
+            statuses = imap.get_folder_status([name for name, delimiter
+                                               in listing])
+        except simpleimap.ConnectionErrors:
+            if not options.daemon:
+                raise
+            log.warning('Lost connection listing folders; reconnecting',
+                        exc_info=True)
+            imapserver.Reconnect()
+            continue
+
+        skipped = failed = 0
+        for name, delimiter in listing:
+            status = statuses.get(name)
+            if status is not None and folder_unchanged(db, name, status) \
+                    and not (options.fillstubs and pending_stubs(db, name)):
+                skipped += 1
+                continue
+
+            # One bad folder shouldn't cost us the rest of the pass; it
+            # keeps its old STATUS, so it's tried again next time.
+            try:
+                localfolder = maildir_folder_name(name, delimiter)
+                if localfolder and localfolder not in mbox.list_folders():
+                    log.info('Creating %s for %s' % (localfolder, name))
+                    mbox.add_folder(localfolder)
+
+                folder = imapserver.Get().Folder(folder=name)
+                folder.__reconnector__(imapserver.Reconnect)
+                if sizers is None:
+                    sizers = (folder.summarybatch, folder.chunksizer)
+                else:
+                    # Round trips take as long whichever folder they're for
+                    folder.summarybatch, folder.chunksizer = sizers
+                seencache.select(name)
+                result = sync_once(options, db, mbox, imapserver.Get(),
+                                   folder, imapserver, trash, index,
+                                   seencache, journal, localfolder)
+            except simpleimap.ConnectionErrors:
+                log.error('Lost connection syncing %s; reconnecting' % name,
+                          exc_info=True)
+                failed += 1
+                imapserver.Reconnect()
+                continue
+            except Exception:
+                log.error('Failed to sync %s' % name, exc_info=True)
+                failed += 1
+                continue
+            if status is not None and result['complete']:
+                store_folder_status(db, name, status)
+
+        log.info('Skipped %i of %i folders, unchanged since last time' %
+                 (skipped, len(listing)))
+        if failed:
+            log.warning('%i folders failed, and will be retried' % failed)
+        if not options.daemon:
+            break
+        log.debug('Waiting %i seconds...' % options.pollinterval)
+        time.sleep(options.pollinterval)
+
+
+def sync_once(options, db, mbox, imap, folder, imapserver, trash=None,
+              index=None, seencache=None, journal=None, localfolder=None):
+    """ One pass over a folder: copy, and then --mirror-deletes,
+    --fill-stubs and --sync-flags, if wanted.  Returns
+    copy_messages_by_folder's result.
+    """
+
+    result = copy_messages_by_folder(folder=folder,
+                                     db=db,
+                                     imap=imap,
+                                     mbox=mbox,
+                                     limit=options.maxmessages,
+                                     turbo=options.turbo,
+                                     mboxdash=options.mboxdash,
+                                     search=options.search,
+                                     seencache=seencache,
+                                     server=imapserver,
+                                     largesize=options.largesize,
+                                     index=index,
+                                     journal=journal,
+                                     order=options.order,
+                                     localfolder=localfolder,
+                                     maxbodysize=options.maxbodysize)
+    log_result(result)
+    if options.mirrordeletes:
+        mirror_deletes(db, folder, mbox, trash, options.mirrorthreshold,
+                       seencache)
+    if options.fillstubs:
+        fill_stubs(db, folder, mbox, index)
+    if options.syncflags:
+        sync_flags(db, folder, mbox)
+    return result
+
+
 def main():
     """ main loop
     """
@@ -555,52 +2993,88 @@ def main():
         raise ValueError("No valid mailbox type specified")
 
     # Open mailbox and database, and copy messages
+    imapserver = None
+    status = 0
     try:
         if options.type == 'maildir':
             mbox = open_mailbox_maildir(options.destination, options.create)
             db = open_sql_session(os.path.join(options.destination, '.imap2maildir.sqlite'))
+            options.indexfile = os.path.join(options.destination,
+                                             '.imap2maildir-index.sqlite')
+            options.journalfile = os.path.join(options.destination,
+                                               '.imap2maildir.journal')
         elif options.type == 'mbox':
             mbox = open_mailbox_mbox(options.destination, options.create)
             db = open_sql_session(options.destination + '.sqlite')
-
-        seencache = SeenMessagesCache()
-
-        # Connect to IMAP server
-        imapserver = simpleimap.Server(hostname=options.hostname,
-                       username=options.username, password=options.password,
-                       port=options.port, ssl=options.ssl)
-        imap = imapserver.Get()
-
-        # Instantiate a folder
-        folder = imap.Folder(folder=options.remotefolder)
-        folder.__keepaliver__(imapserver.Keepalive)
-
-        result = copy_messages_by_folder(folder=folder,
-                                         db=db,
-                                         imap=imap,
-                                         mbox=mbox,
-                                         limit=options.maxmessages,
-                                         turbo=options.turbo,
-                                         mboxdash=options.mboxdash,
-                                         search=options.search,
-                                         seencache=seencache)
+            options.indexfile = options.destination + '.index.sqlite'
+            options.journalfile = options.destination + '.journal'
+
+        # Finish off whatever we were writing when we last stopped
+        journal = Journal(options.journalfile, db)
+        recorded, removed = journal.recover(mbox)
+        if recorded or removed:
+            log.warning('Recovered from an interrupted run: recorded %i '
+                        'messages, removed %i half-written' %
+                        (recorded, removed))
+
+        if options.command == 'verify':
+            folder = None
+            if options.verifyserver:
+                imapserver = connect(options)
+                folder = imapserver.Get().Folder(folder=options.remotefolder)
+                folder.__reconnector__(imapserver.Reconnect)
+            result = verify(db, mbox, folder, options.verifyslice)
+            log_verify_result(result)
+            if result['missing'] or result['empty'] or result['orphans']:
+                status = 1
+        elif options.command == 'search':
+            try:
+                for path in search(mbox, options.indexfile, options.query):
+                    sys.stdout.write(path + '\n')
+            except sqlite3.OperationalError:
+                log.error('Bad search: %s' % sys.exc_info()[1])
+                status = 1
+        elif options.command == 'reindex':
+            log.info('FINISHED: indexed %i messages' %
+                     reindex(db, mbox, options.indexfile))
+        elif options.command == 'restore':
+            imapserver = connect(options)
+            result = restore(db, mbox, imapserver, options.remotefolder,
+                             options.restorefolder,
+                             options.restoreconnections)
+            log_restore_result(result)
+            if result['failed']:
+                status = 1
+        else:
+            # Load what we've seen already while we log in
+            seencache = SeenMessagesCache()
+            seencache.start_loading(db)
+            imapserver = connect(options)
+            sync(options, db, mbox, imapserver, seencache, journal)
     except (KeyboardInterrupt, SystemExit):
         log.warning('Caught interrupt; clearing locks and safing database.')
+        if imapserver:
+            imapserver.StopKeepalive()
         mbox.unlock()
+        # (the journal has what's written since the last commit; the next
+        # run picks it up)
         db.rollback()
         raise
     except:
         log.exception('Exception!  Clearing locks and safing database.')
+        if imapserver:
+            imapserver.StopKeepalive()
         mbox.unlock()
         db.rollback()
         raise
 
     # Unlock the mailbox if locked.
+    if imapserver:
+        imapserver.StopKeepalive()
+    journal.close()
     mbox.unlock()
-
-    # Print results.
-    log.info('FINISHED: Turboed %(turbo)i, handled %(handled)i, copied %(copied)i (%(copiedbytes)i bytes), last UID was %(lastuid)i' % result)
+    return status
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
 
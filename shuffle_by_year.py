@@ -6,7 +6,6 @@
 DIRPATH = "/stor0/backups/imapbak/rtucker/Fastmail-rey_fmgirl_com"
 
 import email
-import mailbox
 import imap2maildir
 import sys
 import time
@@ -14,7 +13,7 @@ import os
 
 def main():
     db = imap2maildir.open_sql_session(DIRPATH + "/.imap2maildir.sqlite")
-    mbox = mailbox.Maildir(DIRPATH, False)
+    mbox = imap2maildir.open_mailbox_maildir(DIRPATH)
 
     try:
 
@@ -3,17 +3,863 @@ Copyright (c) 2009 Timothy J Fontaine <tjfontaine@gmail.com>
 Copyright (c) 2009 Ryan S. Tucker <rtucker@gmail.com>
 """
 
+import bisect
+import calendar
 import email
 import imaplib
+import itertools
 import logging
-import platform
 import re
+import select
+import socket
+import sys
+import threading
 import time
+import zlib
+
+from array import array
+
+try:
+    from functools import lru_cache
+except ImportError:
+    lru_cache = None
+
+try:
+    import ssl
+except ImportError:
+    ssl = None
+
+log = logging.getLogger(__name__)
+
+# imaplib doesn't know about RFC 4978 or RFC 2177.
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+imaplib.Commands.setdefault('IDLE', ('SELECTED',))
+
+# Things that mean the connection has gone away and should be reopened.
+ConnectionErrors = (imaplib.IMAP4.abort, socket.error, EOFError)
+
+GmailMsgidResponse = re.compile(
+    r'\d+ \((?=.*\bUID (?P<uid>\d+))(?=.*\bX-GM-MSGID (?P<gmmsgid>\d+))')
+SizeResponse = re.compile(
+    r'\d+ \((?=.*\bUID (?P<uid>\d+))(?=.*\bRFC822\.SIZE (?P<size>\d+))')
+ListResponse = re.compile(
+    r'\((?P<flags>[^)]*)\) (?:"(?P<delimiter>(?:[^"\\]|\\.)*)"|NIL) ?(?P<name>.*)$')
+StatusItem = re.compile(r'([A-Za-z]+) (\d+)')
+Unquote = re.compile(r'\\(.)')
+FlagsResponse = re.compile(
+    r'\d+ \((?=.*\bUID (?P<uid>\d+))(?=.*\bFLAGS \((?P<flags>[^)]*)\))')
+ModseqItem = re.compile(r'\bMODSEQ \((?P<modseq>\d+)\)')
+Rfc822Size = re.compile(r'\bRFC822\.SIZE (?P<size>\d+)')
+MessageIdHeader = re.compile(r'^Message-ID:[ \t]*(?P<msgid><[^>]*>)',
+                             re.IGNORECASE | re.MULTILINE)
+ContentHeader = re.compile(
+    r'^(Content-(?:Type|Transfer-Encoding|Disposition)):',
+    re.IGNORECASE | re.MULTILINE)
+
+Mon2num = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+           'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
+InternalDate = re.compile(
+    r'(?P<day>[ 0123]?[0-9])-(?P<mon>[A-Z][a-z][a-z])-(?P<year>[0-9][0-9][0-9][0-9])'
+    r' (?P<hour>[0-9][0-9]):(?P<min>[0-9][0-9]):(?P<sec>[0-9][0-9])'
+    r' (?P<zonen>[-+])(?P<zoneh>[0-9][0-9])(?P<zonem>[0-9][0-9])'
+    )
+
+def _cached(maxsize):
+    """functools.lru_cache, or a simple stand-in where there isn't one.
+    The stand-in just forgets everything when it fills up."""
+    if lru_cache:
+        return lru_cache(maxsize=maxsize)
+
+    def decorator(function):
+        cache = {}
+        def wrapper(arg):
+            try:
+                return cache[arg]
+            except KeyError:
+                if len(cache) >= maxsize:
+                    cache.clear()
+                result = cache[arg] = function(arg)
+                return result
+        wrapper.__wrapped__ = function
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
+
+@_cached(maxsize=4096)
+def internaldate_to_epoch(resp):
+    """Takes an IMAP INTERNALDATE (e.g. '1-Jul-2015 17:30:49 +0200') and
+    returns seconds since the epoch, or None if it can't be parsed.  Falls
+    back to RFC 2822 date parsing for things that aren't INTERNALDATEs.
+    Results are cached, since the same dates turn up over and over."""
+
+    mo = InternalDate.match(resp)
+    if not mo:
+        parsed = email.utils.parsedate_tz(resp)
+        if parsed is None:
+            return None
+        return email.utils.mktime_tz(parsed)
+
+    zone = (int(mo.group('zoneh'))*60 + int(mo.group('zonem')))*60
+    if mo.group('zonen') == '-':
+        zone = -zone
+
+    return calendar.timegm((int(mo.group('year')), Mon2num[mo.group('mon')],
+                            int(mo.group('day')), int(mo.group('hour')),
+                            int(mo.group('min')), int(mo.group('sec')),
+                            0, 0, 0)) - zone
+
+class UidSet:
+    """A sorted set of UIDs, kept as ranges in a pair of array('L')s, so a
+    folder of millions of mostly-consecutive UIDs takes a few bytes rather
+    than a few hundred megabytes.  Iterates in ascending order; str() gives
+    an IMAP sequence set (e.g. '1:50000,50002')."""
+
+    def __init__(self, uids=()):
+        self.starts = array('L')
+        self.ends = array('L')
+        self.__len = 0
+        for uid in sorted(uids):
+            self.__append(uid, uid)
+
+    def __append(self, start, end):
+        """Adds the range start:end, which must not be below the last one."""
+        if self.ends and start <= self.ends[-1] + 1:
+            if end > self.ends[-1]:
+                self.__len += end - self.ends[-1]
+                self.ends[-1] = end
+            return
+        self.starts.append(start)
+        self.ends.append(end)
+        self.__len += end - start + 1
+
+    @classmethod
+    def from_sorted(cls, uids):
+        """Makes a UidSet from ascending uids, without sorting them again."""
+        uidset = cls()
+        for uid in uids:
+            uidset.__append(uid, uid)
+        return uidset
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        """Makes a UidSet from ascending (start, end) pairs."""
+        uidset = cls()
+        for start, end in ranges:
+            uidset.__append(start, end)
+        return uidset
+
+    @classmethod
+    def from_sequence_set(cls, text):
+        """Makes a UidSet from an IMAP sequence set, e.g. '1:5,7,9:12'."""
+        ranges = []
+        for part in _str(text).split(','):
+            if not part:
+                continue
+            if ':' in part:
+                start, end = part.split(':')
+                start, end = sorted((int(start), int(end)))
+            else:
+                start = end = int(part)
+            ranges.append((start, end))
+        ranges.sort()
+        return cls.from_ranges(ranges)
+
+    def add(self, uid):
+        """Adds a single uid."""
+        i = bisect.bisect_right(self.starts, uid) - 1
+        if i >= 0 and uid <= self.ends[i]:
+            return
+        self.__len += 1
+        joinleft = i >= 0 and self.ends[i] + 1 == uid
+        joinright = i + 1 < len(self.starts) and self.starts[i + 1] - 1 == uid
+        if joinleft and joinright:
+            self.ends[i] = self.ends[i + 1]
+            self.starts.pop(i + 1)
+            self.ends.pop(i + 1)
+        elif joinleft:
+            self.ends[i] = uid
+        elif joinright:
+            self.starts[i + 1] = uid
+        else:
+            self.starts.insert(i + 1, uid)
+            self.ends.insert(i + 1, uid)
+
+    def difference(self, other):
+        """Returns a new UidSet of the uids in self but not in other, in
+        one merge pass over the ranges of both."""
+        result = UidSet()
+        ostarts, oends = other.starts, other.ends
+        j, n = 0, len(ostarts)
+        for start, end in self.ranges():
+            while j < n and oends[j] < start:
+                j += 1
+            k = j
+            while start <= end:
+                if k >= n or ostarts[k] > end:
+                    result.__append(start, end)
+                    break
+                if ostarts[k] > start:
+                    result.__append(start, ostarts[k] - 1)
+                start = max(start, oends[k] + 1)
+                k += 1
+        return result
+
+    def ranges(self):
+        """Yields (start, end) pairs, ascending."""
+        for i in range(len(self.starts)):
+            yield self.starts[i], self.ends[i]
+
+    def __len__(self):
+        return int(self.__len)
+
+    def __iter__(self):
+        for start, end in self.ranges():
+            for uid in range(start, end + 1):
+                yield uid
+
+    def __reversed__(self):
+        for i in range(len(self.starts) - 1, -1, -1):
+            for uid in range(self.ends[i], self.starts[i] - 1, -1):
+                yield uid
+
+    def __contains__(self, uid):
+        i = bisect.bisect_right(self.starts, uid) - 1
+        return i >= 0 and uid <= self.ends[i]
+
+    def __eq__(self, other):
+        return (isinstance(other, UidSet) and self.starts == other.starts
+                and self.ends == other.ends)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return ','.join([start == end and str(start) or '%i:%i' % (start, end)
+                         for start, end in self.ranges()])
+
+    def __repr__(self):
+        return 'UidSet.from_sequence_set(%r)' % str(self)
+
+EsearchAll = re.compile(r'.*\bALL (?P<uids>[0-9:,]+)')
+
+def _str(value):
+    """imaplib hands back bytes on Python 3; we'd like a str.  latin-1
+    keeps one character per byte, so {literal} lengths still add up."""
+    if isinstance(value, bytes) and not isinstance(value, str):
+        return value.decode('latin-1')
+    return value
+
+def _bytes(value):
+    """The other way around: what we send has to be bytes on Python 3."""
+    if isinstance(value, bytes):
+        return value
+    return value.encode('latin-1')
+
+def quote_mailbox(mailbox):
+    """Returns mailbox as an IMAP quoted string."""
+    return '"%s"' % mailbox.replace('\\', '\\\\').replace('"', '\\"')
+
+def _param(params, name):
+    """Looks name up in a BODYSTRUCTURE parameter list, e.g.
+    ['CHARSET', 'us-ascii']."""
+    params = params or []
+    for i in range(0, len(params) - 1, 2):
+        if str(params[i]).upper() == name:
+            return params[i+1]
+    return None
+
+def multipart_children(structure):
+    """Returns the parts of a multipart BODYSTRUCTURE, or [] if it isn't
+    one."""
+    children = []
+    for item in structure:
+        if not isinstance(item, list):
+            break
+        children.append(item)
+    return children
+
+def body_part_info(part):
+    """Returns {'type', 'size', 'filename', 'attachment'} for a part of a
+    BODYSTRUCTURE that isn't a multipart.  (The disposition is after the
+    lines for text/*, and after the envelope, body and lines for
+    message/rfc822.)"""
+
+    mimetype = ('%s/%s' % (part[0], part[1])).lower()
+    disposition = 8
+    if mimetype.startswith('text/'):
+        disposition = 9
+    elif mimetype == 'message/rfc822':
+        disposition = 11
+    disposition = len(part) > disposition and part[disposition] or None
+    filename = None
+    if disposition:
+        filename = _param(disposition[1], 'FILENAME')
+    return {'type': mimetype,
+            'size': int(part[6] or 0),
+            'filename': filename or _param(part[2], 'NAME'),
+            'attachment': bool(disposition and
+                               str(disposition[0]).upper() == 'ATTACHMENT')}
+
+def stub_sections(structure, maxsize, number=''):
+    """Works out what to fetch for a stub of the message with the given
+    BODYSTRUCTURE: text parts that aren't attachments and are at most
+    maxsize bytes are kept, and everything else is left out.  Returns
+    (sections to fetch, [(part number, body_part_info), ...] left out).
+    A message that isn't a multipart is part 1."""
+
+    children = multipart_children(structure)
+    if not children:
+        info = body_part_info(structure)
+        if (info['type'].startswith('text/') and not info['attachment'] and
+                info['size'] <= maxsize):
+            return [number or '1'], []
+        return [], [(number or '1', info)]
+
+    sections = []
+    omitted = []
+    for i, child in enumerate(children):
+        childnumber = '%s%i' % (number and number + '.' or '', i + 1)
+        childsections, childomitted = stub_sections(child, maxsize,
+                                                    childnumber)
+        sections += [childnumber + '.MIME'] + childsections
+        omitted += childomitted
+    return sections, omitted
+
+def stub_note(number, info):
+    """What an omitted part is replaced with: a text/plain part saying
+    what it was."""
+
+    what = info['type']
+    if info['filename']:
+        what += ', %s' % info['filename']
+    return ('Content-Type: text/plain; charset=us-ascii\r\n'
+            'X-Imap2maildir-Omitted: %s; %s; %i bytes\r\n\r\n'
+            '[Part %s (%s, %i bytes) was left on the server; run '
+            'imap2maildir with --fill-stubs to fetch it.]\r\n' %
+            (number, info['type'], info['size'], number, what, info['size']))
+
+def stub_body(structure, sections, number=''):
+    """Puts a multipart back together from its fetched sections (see
+    stub_sections), with notes (see stub_note) for the parts left out.
+    Returns the body, without the headers of the multipart itself.
+    Raises ValueError if it has no boundary."""
+
+    boundary = _param(structure[len(multipart_children(structure)) + 1],
+                      'BOUNDARY')
+    if not boundary:
+        raise ValueError('multipart %s has no boundary' % (number or 'body'))
+
+    body = ''
+    for i, child in enumerate(multipart_children(structure)):
+        childnumber = '%s%i' % (number and number + '.' or '', i + 1)
+        body += '--%s\r\n' % boundary
+        if multipart_children(child):
+            body += (sections[childnumber + '.MIME'] +
+                     stub_body(child, sections, childnumber))
+        elif childnumber in sections:
+            body += sections[childnumber + '.MIME'] + sections[childnumber]
+        else:
+            body += stub_note(childnumber, body_part_info(child))
+        body += '\r\n'
+    return body + '--%s--\r\n' % boundary
+
+class UidValidityError(Exception):
+    """The folder's UIDVALIDITY changed, so its UIDs can't be trusted."""
+    pass
+
+class ThrottledError(imaplib.IMAP4.error):
+    """The server told us to slow down ([THROTTLED], [UNAVAILABLE])."""
+    pass
+
+class TokenBucket:
+    """Allows rate things per second, in bursts of up to burst (default:
+    one second's worth).  A rate of 0 means no limit.  Safe to share
+    between threads."""
+
+    def __init__(self, rate=0, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount, factor=1.0):
+        """Takes amount tokens, sleeping until the bucket can cover them;
+        factor scales the rate down.  Returns the number of seconds slept.
+        """
+        if self.rate <= 0:
+            return 0
+        self.lock.acquire()
+        try:
+            now = time.time()
+            rate = self.rate * factor
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * rate)
+            self.stamp = now
+            self.tokens -= amount
+            wait = max(-self.tokens / rate, 0)
+        finally:
+            self.lock.release()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+class HostGovernor:
+    """Limits, and throttling state, shared by every connection to a host.
+    Each throttling response halves the allowed rate and doubles a pause
+    before every command; each normal response claws back a bit of rate
+    and halves the pause."""
+
+    def __init__(self, bytespersec=0, commandspersec=0):
+        self.bytes = TokenBucket(bytespersec)
+        self.commands = TokenBucket(commandspersec)
+        self.factor = 1.0
+        self.pause = 0.0
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    def throttled(self):
+        """The server complained; back off."""
+        self.lock.acquire()
+        try:
+            self.throttles += 1
+            self.factor = max(self.factor / 2, 1 / 64.0)
+            self.pause = min(max(self.pause * 2, 1.0), 300.0)
+        finally:
+            self.lock.release()
+        log.warning('Throttled; now pausing %.1fs per command, at %i%% of '
+                    'the configured rates', self.pause, self.factor * 100)
+
+    def ok(self):
+        """A command went through fine; speed back up, gently."""
+        if self.factor < 1.0 or self.pause:
+            self.lock.acquire()
+            try:
+                self.factor = min(self.factor + 1 / 64.0, 1.0)
+                self.pause = self.pause > 0.1 and self.pause / 2 or 0.0
+            finally:
+                self.lock.release()
+
+HostGovernors = {}
+HostGovernorsLock = threading.Lock()
+
+def host_governor(host, bytespersec=0, commandspersec=0):
+    """Returns the HostGovernor for host, creating it if need be."""
+    HostGovernorsLock.acquire()
+    try:
+        if host not in HostGovernors:
+            HostGovernors[host] = HostGovernor(bytespersec, commandspersec)
+        return HostGovernors[host]
+    finally:
+        HostGovernorsLock.release()
+
+class TlsSessionCache:
+    """One SSLContext for every SSL connection, and the last TLS session
+    from each (host, port), so a new connection (a Clone for the large
+    message lane, a Reconnect after the server drops us, another account
+    on the same server) can resume it rather than do a full handshake.
+    Python can't save a session to disk, so each run starts afresh."""
+
+    def __init__(self):
+        self.context = None
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get_context(self):
+        """Returns the shared SSLContext, making it (set up the way imaplib
+        would make one for each connection: no certificate or hostname
+        checks) if need be."""
+        self.lock.acquire()
+        try:
+            if self.context is None:
+                context = ssl.create_default_context()
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                self.context = context
+            return self.context
+        finally:
+            self.lock.release()
+
+    def get(self, host, port):
+        """Returns the session to resume with host and port, or None."""
+        self.lock.acquire()
+        try:
+            return self.sessions.get((host, port))
+        finally:
+            self.lock.release()
+
+    def put(self, host, port, session):
+        """Keeps session for the next connection to host and port."""
+        if session is None:
+            return
+        self.lock.acquire()
+        try:
+            self.sessions[(host, port)] = session
+        finally:
+            self.lock.release()
+
+TlsSessions = TlsSessionCache()
+
+class RateGovernor:
+    """Caps the bytes/s and commands/s of a connection, and of all the
+    connections to its host, and keeps track of how fast we're going."""
+
+    def __init__(self, host, bytespersec=0, commandspersec=0,
+                 hostbytespersec=0, hostcommandspersec=0):
+        self.host = host_governor(host, hostbytespersec, hostcommandspersec)
+        self.bytes = TokenBucket(bytespersec)
+        self.commands = TokenBucket(commandspersec)
+        self.totalbytes = 0
+        self.totalcommands = 0
+        self.started = time.time()
+        self.windowstart = self.started
+        self.windowbytes = 0
+        self.rate = 0.0
+
+    def command(self):
+        """Call before sending a command."""
+        if self.host.pause:
+            time.sleep(self.host.pause)
+        factor = self.host.factor
+        self.commands.consume(1, factor)
+        self.host.commands.consume(1, factor)
+        self.totalcommands += 1
+
+    def transfer(self, nbytes):
+        """Call for every nbytes sent or received over the wire."""
+        factor = self.host.factor
+        self.bytes.consume(nbytes, factor)
+        self.host.bytes.consume(nbytes, factor)
+        self.totalbytes += nbytes
+        self.windowbytes += nbytes
+        now = time.time()
+        if now - self.windowstart >= 5:
+            self.rate = self.windowbytes / (now - self.windowstart)
+            self.windowstart = now
+            self.windowbytes = 0
+
+    def stats(self):
+        """Returns a dict of how things are going."""
+        elapsed = max(time.time() - self.started, 0.001)
+        return {'bytes': self.totalbytes,
+                'commands': self.totalcommands,
+                'bytespersec': self.rate or self.totalbytes / elapsed,
+                'commandspersec': self.totalcommands / elapsed,
+                'factor': self.host.factor,
+                'pause': self.host.pause,
+                'throttles': self.host.throttles}
+
+class BatchSizer:
+    """Picks how much to ask for at once (summaries per FETCH, bytes per
+    chunk), the way TCP picks a window: measure() each round trip, and
+    the size grows by step while they come back within target seconds,
+    and halves when one doesn't (or on decrease(), when one fails).  It
+    stays between minimum and maximum.  Keeps a smoothed round trip time
+    and throughput (things per second), for the logs."""
+
+    def __init__(self, initial, minimum, maximum, step=None, target=2.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step or minimum
+        self.target = target
+        self.size = max(minimum, min(initial, maximum))
+        self.rtt = None
+        self.throughput = None
+
+    def measure(self, elapsed, amount=None):
+        """Call after each round trip, with how long it took and how much
+        came back (default: size).  Returns the size to use next."""
+        if amount is None:
+            amount = self.size
+        throughput = amount / max(elapsed, 0.001)
+        if self.rtt is None:
+            self.rtt = elapsed
+            self.throughput = throughput
+        else:
+            self.rtt = 0.875 * self.rtt + 0.125 * elapsed
+            self.throughput = 0.875 * self.throughput + 0.125 * throughput
+        if elapsed > self.target:
+            return self.decrease()
+        if amount >= self.size:
+            # Only grow if we actually used the whole window
+            self.size = min(self.size + self.step, self.maximum)
+        return self.size
+
+    def decrease(self):
+        """Halves the size; returns the new one."""
+        self.size = max(self.size // 2, self.minimum)
+        return self.size
+
+    def stats(self):
+        """Returns a dict of the size, rtt and throughput."""
+        return {'size': self.size,
+                'rtt': self.rtt or 0.0,
+                'throughput': self.throughput or 0.0}
+
+class DeflateStream:
+    """Streaming zlib layer for an IMAP connection which has negotiated
+    COMPRESS=DEFLATE (RFC 4978).  Wraps a raw recv(size) function, which
+    returns whatever is available, and a raw send(data) function.
+    """
+
+    def __init__(self, recv, send, level=6):
+        self.__recv = recv
+        self.__send = send
+        self.__buffer = b''
+        self.__compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.__decompressor = zlib.decompressobj(-15)
+
+    def __fill(self):
+        """Reads and inflates another block from the wire."""
+        data = self.__recv(16384)
+        if not data:
+            raise EOFError('connection closed while reading deflate stream')
+        self.__buffer += self.__decompressor.decompress(data)
+
+    def read(self, size):
+        """Reads exactly size bytes of inflated data."""
+        while len(self.__buffer) < size:
+            self.__fill()
+        data, self.__buffer = self.__buffer[:size], self.__buffer[size:]
+        return data
+
+    def readline(self):
+        """Reads an inflated line, including the trailing newline."""
+        pos = self.__buffer.find(b'\n')
+        while pos < 0:
+            start = len(self.__buffer)
+            self.__fill()
+            pos = self.__buffer.find(b'\n', start)
+        line, self.__buffer = self.__buffer[:pos+1], self.__buffer[pos+1:]
+        return line
+
+    def send(self, data):
+        """Deflates and sends data, flushing so the server sees it now."""
+        self.__send(self.__compressor.compress(data) +
+                    self.__compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def pending(self):
+        """Returns the number of inflated bytes waiting to be read."""
+        return len(self.__buffer)
 
 class __simplebase:
     """ __simple base
     """
 
+    _deflate = None
+    _governor = None
+    _lock = None
+    _lastcommand = 0
+
+    def read(self, size):
+        """Read 'size' bytes from remote, inflating if compressed."""
+        if self._deflate:
+            return self._deflate.read(size)
+        return self._account(self._raw_read(size))
+
+    def readline(self):
+        """Read line from remote, inflating if compressed."""
+        if self._deflate:
+            return self._deflate.readline()
+        return self._account(self._raw_readline())
+
+    def send(self, data):
+        """Send data to remote, deflating if compressed."""
+        if self._deflate:
+            return self._deflate.send(data)
+        return self._raw_send(self._account(data))
+
+    def _account(self, data):
+        """Tells the governor (if any) about data crossing the wire."""
+        if self._governor and data:
+            self._governor.transfer(len(data))
+        return data
+
+    def _wire_recv(self, size):
+        """_raw_recv, with accounting; DeflateStream reads with this."""
+        return self._account(self._raw_recv(size))
+
+    def _wire_send(self, data):
+        """_raw_send, with accounting; DeflateStream writes with this."""
+        return self._raw_send(self._account(data))
+
+    def commandlock(self):
+        """Returns the lock held while a command is running, so other
+        threads (e.g. a KeepaliveThread) can stay out of its way."""
+        if self._lock is None:
+            self._lock = threading.RLock()
+        return self._lock
+
+    def idletime(self):
+        """Returns the seconds since the last command finished."""
+        return time.time() - self._lastcommand
+
+    def _simple_command(self, name, *args):
+        """Runs a command, holding the command lock throughout."""
+        lock = self.commandlock()
+        lock.acquire()
+        try:
+            return imaplib.IMAP4._simple_command(self, name, *args)
+        finally:
+            lock.release()
+
+    def _command(self, name, *args):
+        """Sends a command, once the governor (if any) says we may."""
+        if self._governor:
+            self._governor.command()
+        return imaplib.IMAP4._command(self, name, *args)
+
+    def _command_complete(self, name, tag):
+        """Waits for a command's result, and lets the governor know if the
+        server is asking us to slow down.  Raises ThrottledError if the
+        command failed because of it."""
+
+        try:
+            status, data = imaplib.IMAP4._command_complete(self, name, tag)
+        except imaplib.IMAP4.abort:
+            if (self._governor and name != 'LOGOUT' and
+                    'BYE' in self.untagged_responses):
+                self._governor.host.throttled()
+            raise
+        finally:
+            self._lastcommand = time.time()
+
+        throttled = False
+        for code in ('THROTTLED', 'UNAVAILABLE'):
+            if self.untagged_responses.pop(code, None) is not None:
+                throttled = True
+
+        if self._governor:
+            if throttled:
+                self._governor.host.throttled()
+            else:
+                self._governor.host.ok()
+        if throttled and status != 'OK':
+            raise ThrottledError('%s: %s %s' % (name, status, data))
+        return status, data
+
+    def _raw_recv(self, size):
+        """Returns up to size bytes, blocking only until some are available.
+        Needs a buffered file with read1(); None if we don't have one."""
+        read1 = getattr(getattr(self, 'file', None), 'read1', None)
+        if read1:
+            return read1(size)
+        return None
+
+    def has_capability(self, capability):
+        """Returns True if the server advertises capability."""
+        return capability.upper() in self.capabilities
+
+    def refresh_capabilities(self):
+        """Re-reads CAPABILITY; servers often advertise more after login."""
+        status, data = self.capability()
+        if status == 'OK' and data and data[-1]:
+            caps = data[-1]
+            if not isinstance(caps, str):
+                caps = caps.decode('ascii')
+            self.capabilities = tuple(caps.upper().split())
+        return self.capabilities
+
+    def compress(self, level=6):
+        """Negotiates COMPRESS=DEFLATE (RFC 4978) if the server offers it.
+        Returns True if the connection is now compressed."""
+
+        if self._deflate or not self.has_capability('COMPRESS=DEFLATE'):
+            return False
+        if self._raw_recv(0) is None:
+            log.debug('COMPRESS=DEFLATE offered, but this Python has no '
+                          'buffered read1(); staying uncompressed')
+            return False
+
+        lock = self.commandlock()
+        lock.acquire()
+        try:
+            status, data = self._simple_command('COMPRESS', 'DEFLATE')
+            if status != 'OK':
+                log.debug('COMPRESS DEFLATE refused: %s', data)
+                return False
+
+            self._deflate = DeflateStream(self._wire_recv, self._wire_send,
+                                          level)
+            return True
+        finally:
+            lock.release()
+
+    def _wait_readable(self, timeout):
+        """Returns True once there's something to read, False if timeout
+        seconds pass first."""
+        if self._deflate and self._deflate.pending():
+            return True
+        if not self._deflate and self._buffered():
+            return True
+        sock = self.socket()
+        if getattr(sock, 'pending', None) and sock.pending():
+            return True
+        return bool(select.select([sock], [], [], max(timeout, 0))[0])
+
+    def _buffered(self):
+        """Returns True if imaplib's file object has read more than has
+        been asked for already (e.g. an EXISTS in the same packet as the
+        "+ idling"), which select() can't see."""
+
+        fileobj = getattr(self, 'file', None)
+        if fileobj is None:
+            return False
+        if getattr(fileobj, '_rbuf', None) is not None:
+            # Python 2's socket._fileobject
+            return len(fileobj._rbuf.getvalue()) > 0
+        if not hasattr(fileobj, 'peek'):
+            return False
+        # peek() reads from the socket if there's nothing buffered, so
+        # don't let it wait
+        sock = self.socket()
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return len(fileobj.peek(1)) > 0
+        except (socket.error, IOError):
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def idle(self, timeout):
+        """Sits in IDLE (RFC 2177) until the server reports a change to the
+        selected mailbox, or timeout seconds pass.  Returns True if EXISTS,
+        RECENT, EXPUNGE or FETCH responses showed up, False otherwise."""
+
+        lock = self.commandlock()
+        lock.acquire()
+        try:
+            return self.__idle(timeout)
+        finally:
+            lock.release()
+
+    def __idle(self, timeout):
+        """idle(), once we have the command lock."""
+
+        changes = ('EXISTS', 'RECENT', 'EXPUNGE', 'FETCH')
+        for name in changes:
+            self.untagged_responses.pop(name, None)
+
+        tag = self._command('IDLE')
+        while self._get_response():
+            if self.tagged_commands[tag]:
+                # Refused (NO/BAD) instead of a continuation
+                status, data = self._command_complete('IDLE', tag)
+                raise Exception('idle: %s %s' % (status, data))
+
+        deadline = time.time() + timeout
+        changed = False
+        while not changed and self._wait_readable(deadline - time.time()):
+            self._get_response()
+            changed = [name for name in changes
+                       if name in self.untagged_responses] != []
+
+        self.send(b'DONE\r\n')
+        self._command_complete('IDLE', tag)
+        return changed
+
     def parseFetch(self, text):
         """Given a string (e.g. '1 (ENVELOPE...'), breaks it down into
         a useful format.
@@ -102,56 +948,15 @@ class __simplebase:
 
     def parseInternalDate(self, resp):
         """Takes IMAP INTERNALDATE and turns it into a Python time
-        tuple referenced to GMT.
+        tuple in local time.  See internaldate_to_epoch.
 
         Based from: http://code.google.com/p/webpymail/
         """
 
-        Mon2num = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
-                 'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
-
-        InternalDate = re.compile(
-                        r'(?P<day>[ 0123]?[0-9])-(?P<mon>[A-Z][a-z][a-z])-(?P<year>[0-9][0-9][0-9][0-9])'
-                        r' (?P<hour>[0-9][0-9]):(?P<min>[0-9][0-9]):(?P<sec>[0-9][0-9])'
-                        r' (?P<zonen>[-+])(?P<zoneh>[0-9][0-9])(?P<zonem>[0-9][0-9])'
-                        )
-
-        mo = InternalDate.match(resp)
-        if not mo:
-            # try email date format (returns None on failure)
-            return email.utils.parsedate(resp)
-
-        mon = Mon2num[mo.group('mon')]
-        zonen = mo.group('zonen')
-
-        day = int(mo.group('day'))
-        year = int(mo.group('year'))
-        hour = int(mo.group('hour'))
-        min = int(mo.group('min'))
-        sec = int(mo.group('sec'))
-        zoneh = int(mo.group('zoneh'))
-        zonem = int(mo.group('zonem'))
-
-        zone = (zoneh*60 + zonem)*60
-
-        # handle negative offsets
-        if zonen == '-':
-            zone = -zone
-
-        tt = (year, mon, day, hour, min, sec, -1, -1, -1)
-
-        utc = time.mktime(tt)
-
-        # Following is necessary because the time module has no 'mkgmtime'.
-        # 'mktime' assumes arg in local timezone, so adds timezone/altzone.
-
-        lt = time.localtime(utc)
-        if time.daylight and lt[-1]:
-            zone = zone + time.altzone
-        else:
-            zone = zone + time.timezone
-
-        return time.localtime(utc - zone)
+        epoch = internaldate_to_epoch(_str(resp))
+        if epoch is None:
+            return None
+        return time.localtime(epoch)
 
     def get_messages_by_folder(self, folder, charset=None, search='ALL'):
         """ get messages by folder
@@ -166,7 +971,7 @@ class __simplebase:
         """ get ids by folder
         """
 
-        self.select(folder, readonly=True)
+        self.select(quote_mailbox(folder), readonly=True)
         status, data = self.search(charset, search)
         if status != 'OK':
             raise Exception('search %s: %s' % (search, data[0]))
@@ -174,15 +979,36 @@ class __simplebase:
         return data[0].split()
 
     def get_uids_by_folder(self, folder, charset=None, search='ALL'):
-        """ get_uids by folders
-        """
+        """Returns a UidSet of the uids in folder matching search.  Uses
+        ESEARCH (RFC 4731) if we can, so the server sends ranges rather
+        than every single uid."""
+
+        self.select(quote_mailbox(folder), readonly=True)
+
+        if self.has_capability('ESEARCH'):
+            args = ['RETURN', '(ALL)']
+            if charset:
+                args += ['CHARSET', charset]
+            status, data = self._simple_command('UID', 'SEARCH', *(args + [search]))
+            if status != 'OK':
+                raise Exception('search %s: %s' % (search, data[0]))
+            status, data = self._untagged_response(status, data, 'ESEARCH')
+            for line in data:
+                mo = line and EsearchAll.match(_str(line))
+                if mo:
+                    return UidSet.from_sequence_set(mo.group('uids'))
+            return UidSet()
 
-        self.select(folder, readonly=True)
         status, data = self.uid('SEARCH', charset, search)
         if status != 'OK':
             raise Exception('search %s: %s' % (search, data[0]))
 
-        return data[0].split()
+        # Added as they come, rather than listed, sorted and then added;
+        # servers mostly send them in order, which add() makes cheap.
+        uids = UidSet()
+        for uid in (data[0] or b'').split():
+            uids.add(int(uid))
+        return uids
 
     def get_summaries_by_folder(self, folder, charset=None, search='ALL'):
         """ get summaries by folder
@@ -220,12 +1046,75 @@ class __simplebase:
         """ get_message_by_uid
         """
 
-        status, data = self.uid('FETCH', uid, '(RFC822)')
+        status, data = self.uid('FETCH', str(uid), '(RFC822)')
 
         if status != 'OK':
             raise Exception('uid %s: %s' % (uid, data[0]))
 
-        return email.message_from_string(data[0][1])
+        return getattr(email, 'message_from_bytes',
+                       email.message_from_string)(data[0][1])
+
+    def get_message_chunk_by_uid(self, uid, offset, length):
+        """Returns up to length bytes of the raw message, starting at
+        offset, using BODY.PEEK[]<offset.length>.  An empty result means
+        we're past the end."""
+
+        status, data = self.uid('FETCH', str(uid),
+                                '(BODY.PEEK[]<%i.%i>)' % (offset, length))
+
+        if status != 'OK':
+            raise Exception('uid %s: %s' % (uid, data[0]))
+
+        for item in data:
+            if isinstance(item, tuple):
+                return item[1]
+        return b''
+
+    def get_message_stub_by_uid(self, uid, maxsize):
+        """Returns (message, bytes left out) for a stub of the message
+        with the given uid: its headers and the text parts of it that are
+        at most maxsize bytes, with the rest (attachments, mostly)
+        replaced by notes saying what they were.  An X-Imap2maildir-Stub
+        header says which parts were left out.  Returns None if nothing
+        would be left out."""
+
+        status, data = self.uid('FETCH', str(uid),
+                                '(UID BODYSTRUCTURE BODY.PEEK[HEADER])')
+        if status != 'OK':
+            raise Exception('uid %s: %s' % (uid, data[0]))
+        contents = list(self.__parse_fetch(data).values())
+        if not contents or 'BODYSTRUCTURE' not in contents[0]:
+            raise Exception('uid %s: no BODYSTRUCTURE' % uid)
+        structure = contents[0]['BODYSTRUCTURE']
+        header = contents[0]['BODY[HEADER]']
+
+        wanted, omitted = stub_sections(structure, maxsize)
+        if not omitted:
+            return None
+        omittedbytes = sum([info['size'] for number, info in omitted])
+        stubheader = 'X-Imap2maildir-Stub: uid %i; omitted %s (%i bytes)\r\n' % (
+            int(uid), ', '.join([number for number, info in omitted]),
+            omittedbytes)
+
+        if not multipart_children(structure):
+            # The whole body goes; keep what it was, but say what it is now
+            header = ContentHeader.sub(r'X-Imap2maildir-Original-\1:', header)
+            note = stub_note(*omitted[0]).split('\r\n\r\n', 1)
+            stub = (stubheader + header.rstrip('\r\n') + '\r\n' +
+                    note[0] + '\r\n\r\n' + note[1])
+        else:
+            status, data = self.uid('FETCH', str(uid), '(%s)' % ' '.join(
+                ['BODY.PEEK[%s]' % section for section in wanted]))
+            if status != 'OK':
+                raise Exception('uid %s: %s' % (uid, data[0]))
+            contents = list(self.__parse_fetch(data).values())
+            sections = dict([(section, contents[0]['BODY[%s]' % section])
+                             for section in wanted])
+            stub = stubheader + header + stub_body(structure, sections)
+
+        message = getattr(email, 'message_from_bytes',
+                          email.message_from_string)(_bytes(stub))
+        return message, omittedbytes
 
     def get_summaries_by_ids(self, ids):
         """ get summaries by ids
@@ -275,36 +1164,57 @@ class __simplebase:
 
         return None
 
-    def get_summaries_by_uids(self, uids):
-        """ get summaries by uids
-        """
-
-        for i in uids:
-            yield self.get_summary_by_uid(int(i))
-
-    def get_summary_by_uid(self, uid):
+    def get_summary_by_uid(self, uid, envelope=True, gmail=False):
         """Retrieve a dictionary of simple header information for a given uid.
 
         Requires: uid (unique numeric ID of message)
+        Optional: envelope (False skips the ENVELOPE; msgid and envfrom
+                            will be None)
+                  gmail (True adds X-GM-MSGID, X-GM-THRID and X-GM-LABELS)
         Returns: {'uid': UID you requested,
                   'msgid': RFC822 Message ID,
                   'size': Size of message in bytes,
                   'date': IMAP's Internaldate for the message,
                   'envelope': Envelope data}
+                 plus 'gmmsgid', 'gmthrid' and 'labels' if gmail.
         """
 
         # Retrieve the message from the server.
-        status, data = self.uid('FETCH', uid,
-                          '(UID ENVELOPE RFC822.SIZE INTERNALDATE)')
+        status, data = self.uid('FETCH', str(uid),
+                                self.__summary_items(envelope, gmail))
 
         if status != 'OK':
             return None
 
         return self.parse_summary_data(data)
 
+    def get_summaries_by_uids(self, uids, envelope=True, gmail=False):
+        """Like get_summary_by_uid, but for a bunch of uids (a UidSet, or
+        any iterable) in one command.  Returns a dict of uid: summary;
+        uids which have gone away are left out."""
+
+        if not isinstance(uids, UidSet):
+            uids = UidSet(uids)
+        status, data = self.uid('FETCH', str(uids),
+                                self.__summary_items(envelope, gmail))
+        if status != 'OK':
+            raise Exception('uid %s: %s' % (uids, data[0]))
+
+        return dict([(summary['uid'], summary)
+                     for summary in self.parse_summaries_data(data)])
+
+    def __summary_items(self, envelope, gmail):
+        """The FETCH items get_summary_by_uid and friends ask for."""
+        items = 'UID RFC822.SIZE INTERNALDATE'
+        if envelope:
+            items = 'UID ENVELOPE RFC822.SIZE INTERNALDATE'
+        if gmail:
+            items += ' X-GM-MSGID X-GM-THRID X-GM-LABELS'
+        return '(%s)' % items
+
     def set_seen_by_uid(self, uid):
         """Applies the SEEN flag to a message."""
-        status, data = self.uid('STORE', uid, '+FLAGS', '(\\Seen)')
+        status, data = self.uid('STORE', str(uid), '+FLAGS', '(\\Seen)')
         if status != 'OK':
             raise Exception('set_seen_by_uid %s: %s' % (uid, data[0]))
 
@@ -323,47 +1233,341 @@ class __simplebase:
                   'envelope': Envelope data}
         """
 
-        uid = date = envdate = envfrom = msgid = size = None
+        summaries = self.parse_summaries_data(data)
+        if summaries:
+            return summaries[0]
+        return None
+
+    def parse_summaries_data(self, data):
+        """As parse_summary_data, for a FETCH of any number of messages:
+        returns a list of summaries, in the order of their sequence
+        numbers (which is uid order, too).  Untagged FETCH responses
+        without a UID and size (flag changes) are skipped."""
+
+        # Grab a list of things in the FETCH response.
+        fetchresult = self.__parse_fetch(data)
+        summaries = []
+        for key in sorted(fetchresult.keys()):
+            summary = self.__summary_from_contents(fetchresult[key])
+            if summary:
+                summaries.append(summary)
+        return summaries
+
+    def __parse_fetch(self, data):
+        """Runs the data result of a FETCH through parseFetch, literals
+        and all.  Returns {} if there's nothing there."""
 
         for idx, val in enumerate(data):
             if isinstance(val, tuple):
-                # This seems to happen if there are newlines in the Subject?!
-                data[idx] = ' '.join(list(val))
+                # A literal ({n} and then the n bytes); also happens if
+                # there are newlines in the Subject?!
+                val = ' '.join([_str(i) for i in val])
+            data[idx] = _str(val)
 
-        if data[0]:
-            combined_data = ' '.join(data)
+        if not data[0]:
+            return {}
+        return self.parseFetch(' '.join(data))
 
-            # Grab a list of things in the FETCH response.
-            fetchresult = self.parseFetch(combined_data)
-            contents = fetchresult[list(fetchresult.keys())[0]]
+    def __summary_from_contents(self, contents):
+        """Turns one message's parseFetch contents into a summary."""
 
-            uid = contents['UID']
-            envdate = contents['ENVELOPE'][0]
-            if 'INTERNALDATE' in contents:
-                date = contents['INTERNALDATE']
-            else:
-                date = envdate
+        if 'UID' not in contents or 'RFC822.SIZE' not in contents:
+            return None
 
-            envelope = contents['ENVELOPE']
+        date = envdate = envfrom = msgid = None
+        gmail = {}
 
-            if (envelope
-                and envelope[2]
-                and envelope[2][0]
-                and envelope[2][0][2]
-                and envelope[2][0][3]
-                ):
-                envfrom = '@'.join(envelope[2][0][2:])
-            else:
-                # No From: header.  Woaaah.
-                envfrom = 'MAILER-DAEMON'
+        uid = contents['UID']
+        envelope = contents.get('ENVELOPE')
+        if envelope:
+            envdate = envelope[0]
+        if 'INTERNALDATE' in contents:
+            date = contents['INTERNALDATE']
+        else:
+            date = envdate
+
+        if envelope is None:
+            # Didn't ask for it.
+            pass
+        elif (envelope
+            and envelope[2]
+            and envelope[2][0]
+            and envelope[2][0][2]
+            and envelope[2][0][3]
+            ):
+            envfrom = '@'.join(envelope[2][0][2:])
+        else:
+            # No From: header.  Woaaah.
+            envfrom = 'MAILER-DAEMON'
+        if envelope:
             msgid = envelope[9]
-            size = int(contents['RFC822.SIZE'])
+        size = int(contents['RFC822.SIZE'])
+
+        if 'X-GM-MSGID' in contents:
+            gmail = {'gmmsgid': int(contents['X-GM-MSGID']),
+                     'gmthrid': int(contents.get('X-GM-THRID') or 0),
+                     'labels': [str(i) for i in
+                                contents.get('X-GM-LABELS') or []]}
 
         if msgid or size or date:
-            return {'uid': int(uid), 'msgid': msgid, 'size': size, 'date': date, 'envfrom': envfrom, 'envdate': envdate}
+            summary = {'uid': int(uid), 'msgid': msgid, 'size': size, 'date': date, 'envfrom': envfrom, 'envdate': envdate}
+            summary.update(gmail)
+            return summary
         else:
             return None
 
+    def get_gmail_msgids_by_uids(self, uids):
+        """Returns a dict of uid: X-GM-MSGID for the given uids, asking
+        for a few hundred at a time.  Missing uids are left out."""
+
+        uids = list(uids)
+        result = {}
+        for start in range(0, len(uids), 500):
+            uidset = ','.join([str(u) for u in uids[start:start+500]])
+            status, data = self.uid('FETCH', uidset, '(UID X-GM-MSGID)')
+            if status != 'OK':
+                raise Exception('uid %s: %s' % (uidset, data[0]))
+            for line in data:
+                if isinstance(line, tuple):
+                    line = line[0]
+                mo = GmailMsgidResponse.match(_str(line or ''))
+                if mo:
+                    result[int(mo.group('uid'))] = int(mo.group('gmmsgid'))
+        return result
+
+    def get_sizes_by_uids(self, uids):
+        """Returns a dict of uid: RFC822.SIZE for the given UidSet, asking
+        for a few hundred ranges at a time.  Missing uids are left out."""
+
+        ranges = list(uids.ranges())
+        result = {}
+        for start in range(0, len(ranges), 500):
+            uidset = str(UidSet.from_ranges(ranges[start:start+500]))
+            status, data = self.uid('FETCH', uidset, '(UID RFC822.SIZE)')
+            if status != 'OK':
+                raise Exception('uid %s: %s' % (uidset, data[0]))
+            for line in data:
+                if isinstance(line, tuple):
+                    line = line[0]
+                mo = SizeResponse.match(_str(line or ''))
+                if mo:
+                    result[int(mo.group('uid'))] = int(mo.group('size'))
+        return result
+
+    def get_all_flags(self, changedsince=None):
+        """Returns ({uid: [flags]}, modseq) for the selected folder.  If the
+        server has CONDSTORE (RFC 7162), modseq is the highest MODSEQ seen,
+        and given the one from last time as changedsince, only messages
+        whose flags have changed since are included.  Otherwise, modseq is
+        None, and you get everything."""
+
+        args = ['1:*']
+        condstore = self.has_capability('CONDSTORE')
+        if condstore:
+            args.append('(UID FLAGS MODSEQ)')
+            if changedsince:
+                args.append('(CHANGEDSINCE %i)' % changedsince)
+        else:
+            args.append('(UID FLAGS)')
+        status, data = self.uid('FETCH', *args)
+        if status != 'OK':
+            raise Exception('fetch flags: %s' % data[0])
+
+        result = {}
+        modseq = condstore and changedsince or None
+        for line in data:
+            if isinstance(line, tuple):
+                line = line[0]
+            line = _str(line or '')
+            mo = FlagsResponse.match(line)
+            if not mo:
+                continue
+            result[int(mo.group('uid'))] = mo.group('flags').split()
+            mo = ModseqItem.search(line)
+            if mo:
+                modseq = max(modseq or 0, int(mo.group('modseq')))
+        return result, modseq
+
+    def get_folder_list(self, pattern='*'):
+        """Returns [(folder, delimiter)] for the folders on the server which
+        can be selected, in the order LIST gives them.  delimiter is the
+        hierarchy delimiter, or None for a flat namespace.  Names are as
+        the server has them (modified UTF-7)."""
+
+        status, data = self.list('""', pattern)
+        if status != 'OK':
+            raise Exception('list: %s' % data[0])
+
+        result = []
+        for item in data:
+            name = None
+            if isinstance(item, tuple):
+                # The name came as a literal
+                item, name = item[0], _str(item[1])
+            mo = ListResponse.match(_str(item or ''))
+            if not mo:
+                continue
+            flags = mo.group('flags').lower().split()
+            if '\\noselect' in flags or '\\nonexistent' in flags:
+                continue
+            if name is None:
+                name = mo.group('name')
+                if name.startswith('"'):
+                    name = Unquote.sub(r'\1', name[1:-1])
+            delimiter = mo.group('delimiter')
+            if delimiter is not None:
+                delimiter = Unquote.sub(r'\1', delimiter)
+            result.append((name, delimiter))
+        return result
+
+    def get_folder_status(self, folders):
+        """Returns {folder: {'MESSAGES': n, 'UIDNEXT': n, 'UIDVALIDITY': n}}
+        (plus 'HIGHESTMODSEQ', with CONDSTORE) for the given folders, from
+        one STATUS each, all sent before reading any of the answers.
+        Folders the server won't STATUS are left out."""
+
+        items = 'MESSAGES UIDNEXT UIDVALIDITY'
+        if self.has_capability('CONDSTORE'):
+            items += ' HIGHESTMODSEQ'
+
+        lock = self.commandlock()
+        lock.acquire()
+        try:
+            self.untagged_responses.pop('STATUS', None)
+            tags = [self._command('STATUS', quote_mailbox(folder),
+                                  '(%s)' % items) for folder in folders]
+            for folder, tag in zip(folders, tags):
+                try:
+                    status, _ = self._command_complete('STATUS', tag)
+                except imaplib.IMAP4.abort:
+                    raise
+                except imaplib.IMAP4.error:
+                    status = 'BAD'
+                if status != 'OK':
+                    log.debug('No STATUS for %s', folder)
+            responses = self.untagged_responses.pop('STATUS', [])
+        finally:
+            lock.release()
+
+        # Each answer names its folder, so we go by that rather than by
+        # which command it came after.
+        statuses = {}
+        responses = list(responses)
+        while responses:
+            item = responses.pop(0)
+            if isinstance(item, tuple):
+                # The name came as a literal; the rest is the next item
+                name = _str(item[1])
+                line = responses and _str(responses.pop(0) or '') or ''
+            else:
+                line = _str(item or '')
+                name = line[:line.rfind('(')].strip()
+                if name.startswith('"'):
+                    name = Unquote.sub(r'\1', name[1:-1])
+            if name.upper() == 'INBOX':
+                name = 'INBOX'
+            statuses[name] = dict([(k.upper(), int(v)) for k, v in
+                                   StatusItem.findall(line[line.rfind('('):])])
+
+        result = {}
+        for folder in folders:
+            name = folder.upper() == 'INBOX' and 'INBOX' or folder
+            if name in statuses:
+                result[folder] = statuses[name]
+        return result
+
+    def get_msgids_and_sizes_by_folder(self, folder):
+        """Returns a set of (Message-ID, size) for the messages in folder
+        that have a Message-ID, so we can tell if one is already there."""
+
+        status, data = self.select(quote_mailbox(folder), readonly=True)
+        if status != 'OK':
+            raise Exception('select %s: %s' % (folder, data[0]))
+        result = set()
+        if not int(data[0] or 0):
+            return result
+
+        status, data = self.uid('FETCH', '1:*',
+                '(RFC822.SIZE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
+        if status != 'OK':
+            raise Exception('fetch %s: %s' % (folder, data[0]))
+        for item in data:
+            if not isinstance(item, tuple):
+                continue
+            size = Rfc822Size.search(_str(item[0]))
+            msgid = MessageIdHeader.search(_str(item[1]))
+            if size and msgid:
+                result.add((msgid.group('msgid'), int(size.group('size'))))
+        return result
+
+    def append_messages(self, mailbox, messages):
+        """Uploads messages, a list of (flags, date_time, message) tuples
+        (as for append()), to mailbox, as quickly as the server lets us:
+        all in one command with MULTIAPPEND (RFC 3502), or as pipelined
+        APPENDs with LITERAL+ (RFC 2088), or else one at a time.  Returns
+        the number of messages uploaded."""
+
+        messages = [(flags, date_time, imaplib.MapCRLF.sub(imaplib.CRLF,
+                                                           message))
+                    for flags, date_time, message in messages]
+        literalplus = self.has_capability('LITERAL+')
+        if self.has_capability('MULTIAPPEND'):
+            batches = [messages]
+        elif literalplus:
+            batches = [[m] for m in messages]
+        else:
+            for flags, date_time, message in messages:
+                status, data = self.append(quote_mailbox(mailbox), flags,
+                                           date_time, message)
+                if status != 'OK':
+                    raise Exception('append %s: %s' % (mailbox, data[0]))
+            return len(messages)
+
+        lock = self.commandlock()
+        lock.acquire()
+        try:
+            tags = [self.__append(mailbox, batch, literalplus)
+                    for batch in batches]
+            errors = []
+            for tag in tags:
+                status, data = self._command_complete('APPEND', tag)
+                if status != 'OK':
+                    errors.append(data[0])
+        finally:
+            lock.release()
+        if errors:
+            raise Exception('append %s: %s' % (mailbox, errors[0]))
+        return len(messages)
+
+    def __append(self, mailbox, messages, literalplus):
+        """Sends one APPEND command for messages, without waiting for it
+        to complete.  Returns its tag."""
+
+        if self._governor:
+            self._governor.command()
+        tag = self._new_tag()
+        line = tag + _bytes(' APPEND ' + quote_mailbox(mailbox))
+        for flags, date_time, message in messages:
+            if flags:
+                if (flags[0], flags[-1]) != ('(', ')'):
+                    flags = '(%s)' % flags
+                line += _bytes(' ' + flags)
+            if date_time:
+                line += _bytes(' ' + imaplib.Time2Internaldate(date_time))
+            if literalplus:
+                self.send(line + _bytes(' {%i+}\r\n' % len(message)) +
+                          message)
+            else:
+                self.send(line + _bytes(' {%i}\r\n' % len(message)))
+                while self._get_response():
+                    if self.tagged_commands[tag]:
+                        # Refused; _command_complete will say why
+                        return tag
+                self.send(message)
+            line = b''
+        self.send(line + b'\r\n')
+        return tag
+
     def Folder(self, folder, charset=None):
         """Returns an instance of FolderClass."""
         return FolderClass(self, folder, charset)
@@ -371,53 +1575,172 @@ class __simplebase:
 class FolderClass:
     """Class for instantiating a folder instance.
 
-    TODO: Trap exceptions like:
-    ssl.SSLError: [Errno 8] _ssl.c:1325: EOF occurred in violation of protocol
-    by trying to reconnect to the server.
-    (Raised up via get_summary_by_uid in Summaries when IMAP server boogers.)
+    If given a reconnector (see __reconnector__), commands which die with
+    one of ConnectionErrors (e.g. gmail's "EOF occurred in violation of
+    protocol" after ~10k fetches) are retried on a fresh connection, after
+    re-selecting the folder and checking its UIDVALIDITY.
+
+    Summaries are fetched in batches, and big messages in chunks, whose
+    sizes are tuned as we go by a BatchSizer each (see BatchStats).
     """
     def __init__(self, parent, folder='INBOX', charset=None):
         self.__folder = folder
         self.__charset = charset
         self.__parent = parent
-        self.__keepaliver = self.__keepaliver_none__
+        self.__reconnector = None
         self.__turbo = None
+        self.__summarycache = None
+        self.__missed = 0
         self.host = parent.host
         self.folder = folder
+        self.uidvalidity = None
+        self.summarybatch = BatchSizer(16, 1, 500, step=16, target=2.0)
+        self.chunksizer = BatchSizer(1024*1024, 64*1024, 16*1024*1024,
+                                     step=256*1024, target=5.0)
 
     def __len__(self):
         """ __len__
         """
 
-        status, data = self.__parent.select(self.__folder, readonly=True)
-        if status != 'OK':
-            raise Exception('folder %s: %s' % (self.__folder, data[0]))
+        return self.__retry(self.Select)
 
-        return int(data[0])
-
-    def __keepaliver__(self, keepaliver):
-        """ __keep aliver
+    def Select(self):
+        """Selects (read-only) the folder, returning the number of messages.
+        Raises UidValidityError if UIDVALIDITY changed since the first time.
         """
 
-        self.__keepaliver = keepaliver
+        status, data = self.__parent.select(quote_mailbox(self.__folder),
+                                            readonly=True)
+        if status != 'OK':
+            raise Exception('folder %s: %s' % (self.__folder, data[0]))
 
-    def __keepaliver_none__(self):
-        """ __keepaliver_none__
-        """
+        status, uidvalidity = self.__parent.response('UIDVALIDITY')
+        if uidvalidity and uidvalidity[0] is not None:
+            uidvalidity = int(uidvalidity[0])
+            if self.uidvalidity is None:
+                self.uidvalidity = uidvalidity
+            elif self.uidvalidity != uidvalidity:
+                raise UidValidityError('folder %s: UIDVALIDITY changed from '
+                                       '%i to %i' % (self.__folder,
+                                       self.uidvalidity, uidvalidity))
 
-        pass
+        return int(data[0])
 
-    def __turbo__(self, turbofunction):
-        """Calls turbofunction(uid) for every uid, only yielding those
-        where turbofunction returns False.  Set to None to disable."""
-        self.__turbo = turbofunction
+    def __reconnector__(self, reconnector):
+        """Sets a function returning a fresh connection, used to recover
+        from dropped connections.  Set to None to disable."""
+        self.__reconnector = reconnector
+
+    def Reconnect(self):
+        """Swaps in a fresh connection and re-selects the folder."""
+        self.__parent = self.__reconnector()
+        self.Select()
+
+    def __retry(self, function, *args):
+        """Calls function(*args), reconnecting and trying again (a few
+        times) if the connection drops.  function may be the name of a
+        method of the connection, since the connection will change."""
+
+        attempt = 0
+        while True:
+            try:
+                if callable(function):
+                    return function(*args)
+                return getattr(self.__parent, function)(*args)
+            except ThrottledError:
+                # The governor makes us wait before the next try
+                attempt += 1
+                if attempt > 5:
+                    raise
+                continue
+            except ConnectionErrors:
+                attempt += 1
+                if not self.__reconnector or attempt > 3:
+                    raise
+                log.warning("Lost connection to %s (attempt %i); "
+                                "reconnecting", self.host, attempt,
+                                exc_info=True)
+                self.Reconnect()
+
+    def Message(self, uid):
+        """Returns the message with the given uid."""
+        return self.__retry('get_message_by_uid', uid)
+
+    def MessageStub(self, uid, maxsize):
+        """Returns (message, bytes left out) for a stub of the message
+        with the given uid, or None; see get_message_stub_by_uid."""
+        return self.__retry('get_message_stub_by_uid', uid, maxsize)
+
+    def MessageToFile(self, uid, fileobj, chunksize=None):
+        """Appends the message with the given uid to fileobj, chunksize
+        bytes at a time (or as many as self.chunksizer reckons, if None),
+        starting from however much fileobj already has.  A dropped
+        connection only costs the chunk in flight.  Returns the size of
+        the message."""
+
+        fileobj.seek(0, 2)
+        offset = fileobj.tell()
+        while True:
+            length = chunksize or self.chunksizer.size
+            start = time.time()
+            chunk = self.__retry('get_message_chunk_by_uid', uid, offset,
+                                 length)
+            if not chunksize:
+                self.chunksizer.measure(time.time() - start, len(chunk))
+            fileobj.write(chunk)
+            fileobj.flush()
+            offset += len(chunk)
+            if len(chunk) < length:
+                return offset
+
+    def BatchStats(self):
+        """Returns the stats (size, rtt, throughput) of the summary
+        BatchSizer and the chunk one, as {'summaries': ..., 'chunks': ...}."""
+
+        return {'summaries': self.summarybatch.stats(),
+                'chunks': self.chunksizer.stats()}
+
+    def IsGmail(self):
+        """Returns True if the server has Gmail's IMAP extensions."""
+        return self.__parent.has_capability('X-GM-EXT-1')
+
+    def GmailMsgids(self, uids):
+        """Returns a dict of uid: X-GM-MSGID for the given uids."""
+        self.__retry(self.Select)
+        return self.__retry('get_gmail_msgids_by_uids', uids)
+
+    def Sizes(self, uids):
+        """Returns a dict of uid: RFC822.SIZE for the given UidSet;
+        uids that have gone from the server are left out."""
+        self.__retry(self.Select)
+        return self.__retry('get_sizes_by_uids', uids)
+
+    def Flags(self, changedsince=None):
+        """Returns ({uid: [flags]}, modseq); see get_all_flags."""
+        if not self.__retry(self.Select):
+            return {}, changedsince
+        return self.__retry('get_all_flags', changedsince)
+
+    def __turbo__(self, knownuids):
+        """knownuids is a UidSet of uids we already have; Summaries skips
+        them all in one go, without asking the server about them.  Set to
+        None to disable."""
+        self.__turbo = knownuids
         self.__turbocounter = 0
+        self.__missed = 0
+
+    def __summarycache__(self, cache):
+        """cache keeps summaries between runs: Summaries asks its
+        get(uid, envelope) before asking the server, and hands what the
+        server says to its put(summary, envelope).  Set to None to
+        disable."""
+        self.__summarycache = cache
 
     def turbocounter(self, reset=False):
         """ turbocounter
         """
 
-        if self.__turbo:
+        if self.__turbo is not None:
             oldvalue = self.__turbocounter
             if reset:
                 self.__turbocounter = 0
@@ -425,67 +1748,147 @@ class FolderClass:
         else:
             return 0
 
+    def missedcounter(self):
+        """How many uids Summaries has left out so far, because their
+        summaries couldn't be fetched (or they'd gone by then)."""
+
+        return self.__missed
+
     def Messages(self, search='ALL'):
         """ Messsages
         """
 
-        self.__parent.select(self.__folder, readonly=True)
+        self.__parent.select(quote_mailbox(self.__folder), readonly=True)
         for m in self.__parent.get_messages_by_folder(self.__folder, self.__charset, search):
             yield m
 
-    def Summaries(self, search='ALL'):
-        """ Summaries
-        """
-
-        if self.__turbo:
-            self.__parent.select(self.__folder, readonly=True)
-            for u in self.Uids(search=search):
-                if not self.__turbo(u):
-                    try:
-                        summ = self.__parent.get_summary_by_uid(u)
-                        if summ:
-                            yield summ
-                    except Exception:
-                        logging.exception("Couldn't retrieve uid %s", u)
-                        continue
+    def Summaries(self, search='ALL', envelope=True, order='oldest'):
+        """Yields summaries for the uids matching search.  The uid list is
+        fetched once, so if the connection drops part way through, we pick
+        up again at the same uid on the new connection.  On Gmail, the
+        summaries include X-GM-MSGID and friends, and envelope=False
+        skips fetching the ENVELOPE.  order is 'oldest' (lowest uid) first,
+        'newest' first, or 'smallest' first (asking for all the sizes in
+        one go).  Summaries are asked for self.summarybatch.size at a time;
+        if a batch fails, we fall back to one at a time for it, and any
+        still missing are skipped (and counted; see missedcounter)."""
+
+        gmail = self.IsGmail()
+        if not gmail:
+            envelope = True
+
+        uids = self.UidSet(search=search)
+        if self.__turbo is not None:
+            missing = uids.difference(self.__turbo)
+            self.__turbocounter += len(uids) - len(missing)
+            uids = missing
+
+        if order == 'newest':
+            uids = reversed(uids)
+        elif order == 'smallest':
+            sizes = self.__retry('get_sizes_by_uids', uids)
+            uids = sorted(uids, key=lambda u: (sizes.get(u, 0), u))
+
+        cache = self.__summarycache
+        uids = iter(uids)
+        while True:
+            batch = list(itertools.islice(uids, self.summarybatch.size))
+            if not batch:
+                break
+
+            cached = {}
+            if cache is not None:
+                for u in batch:
+                    summ = cache.get(u, envelope)
+                    if summ:
+                        cached[u] = summ
+            wanted = [u for u in batch if u not in cached]
+            fetched = wanted and self.__summaries(wanted, envelope, gmail) or {}
+
+            for u in batch:
+                if u in cached:
+                    yield cached[u]
+                elif u in fetched:
+                    if cache is not None:
+                        cache.put(fetched[u], envelope)
+                    yield fetched[u]
                 else:
-                    # long hangtimes can suck
-                    self.__keepaliver()
-                    self.__turbocounter += 1
-        else:
-            for s in self.__parent.get_summaries_by_folder(self.__folder, self.__charset, search):
-                yield s
+                    self.__missed += 1
+
+    def __summaries(self, uids, envelope, gmail):
+        """Fetches the summaries for a batch of uids, timing it for
+        self.summarybatch.  Returns a dict of uid: summary."""
+
+        start = time.time()
+        try:
+            result = self.__retry('get_summaries_by_uids', uids, envelope,
+                                  gmail)
+        except ConnectionErrors + (UidValidityError, ThrottledError):
+            self.summarybatch.decrease()
+            raise
+        except Exception:
+            log.exception("Couldn't retrieve uids %s; trying them one at "
+                          "a time", UidSet(uids))
+            self.summarybatch.decrease()
+            result = {}
+            for u in uids:
+                try:
+                    summ = self.__retry('get_summary_by_uid', u, envelope,
+                                        gmail)
+                    if summ:
+                        result[u] = summ
+                except ConnectionErrors + (UidValidityError, ThrottledError):
+                    raise
+                except Exception:
+                    log.exception("Couldn't retrieve uid %s", u)
+            return result
+
+        self.summarybatch.measure(time.time() - start, len(uids))
+        return result
 
     def Ids(self, search='ALL'):
         """ Ids
         """
 
-        self.__parent.select(self.__folder, readonly=True)
+        self.__parent.select(quote_mailbox(self.__folder), readonly=True)
         for i in self.__parent.get_ids_by_folder(self.__folder, self.__charset, search):
             yield i
 
+    def UidSet(self, search='ALL'):
+        """Returns a UidSet of the uids matching search."""
+
+        self.__retry(self.Select)
+        return self.__retry('get_uids_by_folder', self.__folder, self.__charset, search)
+
     def Uids(self, search='ALL'):
         """ Uids
         """
 
-        self.__parent.select(self.__folder, readonly=True)
-        for u in self.__parent.get_uids_by_folder(self.__folder, self.__charset, search):
+        for u in self.UidSet(search=search):
             yield u
 
 class Server:
     """ Class for instantiating a server instance
     """
 
-    def __init__(self, hostname=None, username=None, password=None, port=None, ssl=True):
+    def __init__(self, hostname=None, username=None, password=None, port=None, ssl=True, compress=True, retries=8, backoff=1, limits=None):
         """ Constructor
+
+        limits: dict of RateGovernor limits (bytespersec, commandspersec,
+                hostbytespersec, hostcommandspersec); default unlimited
         """
 
         self.__hostname = hostname
         self.__username = username
         self.__password = password
         self.__ssl = ssl
+        self.__compress = compress
+        self.__retries = retries
+        self.__backoff = backoff
+        self.__limits = limits or {}
+        self.__governor = RateGovernor(hostname, **self.__limits)
         self.__connection = None
-        self.__lastnoop = 0
+        self.__keepalive = None
 
         if port:
             self.__port = port
@@ -506,7 +1909,57 @@ class Server:
         else:
             self.__connection = SimpleImap(self.__hostname, self.__port)
 
+        self.__connection._governor = self.__governor
         self.__connection.login(self.__username, self.__password)
+        self.__connection.refresh_capabilities()
+
+        if self.__ssl and self.__connection.save_tls_session():
+            log.debug('Resumed TLS session with %s', self.__hostname)
+
+        if self.__compress:
+            if self.__connection.compress():
+                log.debug('Negotiated COMPRESS=DEFLATE with %s',
+                              self.__hostname)
+
+    def Clone(self):
+        """Returns a new Server, with its own connection, to the same place
+        with the same credentials.  Handy for working in parallel."""
+
+        return Server(hostname=self.__hostname, username=self.__username,
+                      password=self.__password, port=self.__port,
+                      ssl=self.__ssl, compress=self.__compress,
+                      retries=self.__retries, backoff=self.__backoff,
+                      limits=self.__limits)
+
+    def Reconnect(self):
+        """Throws away the connection and makes a new one, backing off
+        exponentially (backoff, 2*backoff, ... seconds, up to five
+        minutes) between attempts.  Returns the new connection."""
+
+        try:
+            self.__connection.shutdown()
+        except Exception:
+            pass
+
+        delay = self.__backoff
+        for attempt in range(self.__retries):
+            try:
+                self.Connect()
+                return self.__connection
+            except ConnectionErrors:
+                if attempt + 1 >= self.__retries:
+                    raise
+                log.warning('Reconnect to %s failed; retrying in %i '
+                                'seconds', self.__hostname, delay,
+                                exc_info=True)
+                time.sleep(delay)
+                delay = min(delay * 2, 300)
+
+    def Stats(self):
+        """Returns the RateGovernor's stats: bytes, commands, bytespersec,
+        commandspersec, factor, pause and throttles."""
+
+        return self.__governor.stats()
 
     def Get(self):
         """ Get
@@ -514,24 +1967,134 @@ class Server:
 
         return self.__connection
 
-    def Keepalive(self):
-        """Call me occasionally just to make sure everything's OK..."""
-        if self.__lastnoop + 30 < time.time():
-            self.__connection.noop()
-            self.__lastnoop = time.time()
+    def Wait(self, timeout=29*60, interval=60):
+        """Blocks until the selected folder changes, or timeout seconds pass.
+        Uses IDLE if the server has it; otherwise, NOOPs every interval
+        seconds.  Returns True if something changed."""
+
+        if self.__connection.has_capability('IDLE'):
+            return self.__connection.idle(timeout)
 
-class SimpleImap(imaplib.IMAP4, __simplebase):
+        changes = ('EXISTS', 'RECENT', 'EXPUNGE', 'FETCH')
+        for name in changes:
+            self.__connection.untagged_responses.pop(name, None)
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            time.sleep(max(min(interval, deadline - time.time()), 0))
+            self.__connection.noop()
+            for name in changes:
+                if self.__connection.untagged_responses.pop(name, None):
+                    return True
+        return False
+
+    def Keepalive(self, idle=30):
+        """Sends a NOOP if the connection has been idle for idle seconds.
+        Safe to call from another thread: if a command is running, the
+        connection isn't idle, and we leave it be."""
+
+        connection = self.__connection
+        lock = connection.commandlock()
+        if not lock.acquire(False):
+            return
+        try:
+            if connection.idletime() >= idle:
+                connection.noop()
+        finally:
+            lock.release()
+
+    def StartKeepalive(self, idle=30):
+        """Starts a KeepaliveThread, so the connection stays up while we're
+        busy with something else (loading caches, writing to a slow disk)."""
+
+        if self.__keepalive is None:
+            self.__keepalive = KeepaliveThread(self, idle)
+            self.__keepalive.start()
+
+    def StopKeepalive(self):
+        """Stops the KeepaliveThread, if there is one."""
+
+        if self.__keepalive is not None:
+            self.__keepalive.stop()
+            self.__keepalive.join()
+            self.__keepalive = None
+
+class KeepaliveThread(threading.Thread):
+    """Calls server.Keepalive(idle) every so often, in the background."""
+
+    def __init__(self, server, idle=30):
+        threading.Thread.__init__(self, name='imap keepalive')
+        self.daemon = True
+        self.server = server
+        self.idle = idle
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            self.stopped.wait(self.idle / 3.0)
+            if self.stopped.is_set():
+                return
+            try:
+                self.server.Keepalive(self.idle)
+            except ConnectionErrors:
+                # Whoever uses the connection next will reconnect
+                log.debug('Keepalive failed', exc_info=True)
+            except Exception:
+                log.exception('Keepalive failed')
+
+    def stop(self):
+        self.stopped.set()
+
+class SimpleImap(__simplebase, imaplib.IMAP4):
     """ Simple Imap
     """
 
-    pass
+    _raw_read = imaplib.IMAP4.read
+    _raw_readline = imaplib.IMAP4.readline
+    _raw_send = imaplib.IMAP4.send
 
-class SimpleImapSSL(imaplib.IMAP4_SSL, __simplebase):
+class SimpleImapSSL(__simplebase, imaplib.IMAP4_SSL):
     """ Simple Imap SSL
     """
 
-    if platform.python_version().startswith('2.6.'):
-        def readline(self):
+    _raw_read = imaplib.IMAP4_SSL.read
+    _raw_readline = imaplib.IMAP4_SSL.readline
+    _raw_send = imaplib.IMAP4_SSL.send
+
+    if ssl is not None and hasattr(ssl, 'SSLSession'):
+        def __init__(self, host='', port=imaplib.IMAP4_SSL_PORT, **kwargs):
+            """As imaplib's, but on the shared SSLContext (see
+            TlsSessionCache) unless given a context or key/cert files."""
+            if 'keyfile' not in kwargs and 'certfile' not in kwargs:
+                kwargs.setdefault('ssl_context', TlsSessions.get_context())
+            imaplib.IMAP4_SSL.__init__(self, host, port, **kwargs)
+
+        def _create_socket(self, *args):
+            """Wraps the socket as imaplib does, resuming the last TLS
+            session with this host and port if there is one."""
+            sock = imaplib.IMAP4._create_socket(self, *args)
+            session = None
+            if self.ssl_context is TlsSessions.context:
+                session = TlsSessions.get(self.host, self.port)
+            return self.ssl_context.wrap_socket(sock,
+                                                server_hostname=self.host,
+                                                session=session)
+
+        def save_tls_session(self):
+            """Keeps this connection's TLS session for the next one to
+            resume; call once logged in, as TLS 1.3 servers send their
+            session tickets after the handshake.  Returns True if this
+            connection resumed a session itself."""
+            if self.ssl_context is TlsSessions.context:
+                TlsSessions.put(self.host, self.port, self.sock.session)
+            return self.sock.session_reused
+    else:
+        def save_tls_session(self):
+            """This Python can't resume TLS sessions."""
+            return False
+
+    if sys.version_info[:2] == (2, 6):
+        def _raw_readline(self):
             """Read line from remote.  Overrides built-in method to fix
             infinite loop problem when EOF occurs, since sslobj.read
             returns '' on EOF."""
@@ -542,8 +2105,8 @@ class SimpleImapSSL(imaplib.IMAP4_SSL, __simplebase):
                 line.append(char)
                 if char == "\n": return ''.join(line)
 
-    if 'Windows' in platform.platform():
-        def read(self, n):
+    if sys.platform == 'win32':
+        def _raw_read(self, n):
             """Read 'size' bytes from remote.  (Contains workaround)"""
             maxRead = 1000000
             # Override the read() function; fixes a problem on Windows
@@ -3,7 +3,24 @@
 """ Runs various tests on stuff.
 """
 
+import email
+import imap2maildir
+import io
+import json
+import logging
+import mailbox
+import optparse
+import os
+import rfc822py3
+import shutil
 import simpleimap
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 
@@ -126,5 +143,1803 @@ class TestParseSummaryData(unittest.TestCase):
         for i in validkeys:
             self.assertEqual(validresult[i], result[i], "mismatch on %s" % i)
 
+class TestInternalDate(unittest.TestCase):
+    """ Test INTERNALDATE parsing, without needing a server
+    """
+
+    def testEpoch(self):
+        """
+        Tests converting to seconds since the epoch, whatever our timezone.
+        """
+        self.assertEqual(simpleimap.internaldate_to_epoch('1-Jul-2015 17:30:49 +0200'), 1435764649)
+        self.assertEqual(simpleimap.internaldate_to_epoch('01-Jul-2015 11:30:49 -0400'), 1435764649)
+        self.assertEqual(simpleimap.internaldate_to_epoch('Wed, 01 Jul 2015 15:30:49 +0000'), 1435764649)
+        self.assertEqual(simpleimap.internaldate_to_epoch('garbage'), None)
+
+    def testCached(self):
+        """The cached parser gives the same answers as the plain one
+        """
+        dates = ['%02d-Jul-2015 %02d:%02d:00 +0200' % (1 + i % 3, i % 24, i % 60)
+                 for i in range(1000)]
+        uncached = simpleimap.internaldate_to_epoch.__wrapped__
+        cached = simpleimap.internaldate_to_epoch
+        self.assertEqual([cached(d) for d in dates], [uncached(d) for d in dates])
+        self.assertEqual([cached(d) for d in dates], [uncached(d) for d in dates])
+
+class TestParseGmailSummaryData(unittest.TestCase):
+    """ Test Parse Summary Data, with Gmail's extensions
+    """
+
+    class Connection(simpleimap.SimpleImapSSL):
+        def __init__(self):
+            pass
+
+    def setUp(self):
+        """ create an instance, without connecting it to anything
+        """
+        self.imap = self.Connection()
+
+    def testNoEnvelope(self):
+        """
+        Tests a summary fetched with X-GM-MSGID and friends instead of an
+        ENVELOPE, as Python 3's imaplib hands it over (bytes).
+
+        >>> imap.uid('FETCH', 1234, '(UID RFC822.SIZE INTERNALDATE X-GM-MSGID X-GM-THRID X-GM-LABELS)')
+        """
+        status, data = ('OK', [b'12 (X-GM-THRID 1278455344230334865 X-GM-MSGID 1278455344230334866 X-GM-LABELS (\\Inbox "Foo Bar") UID 1234 RFC822.SIZE 4321 INTERNALDATE "27-Mar-2007 00:51:31 +0000")'])
+
+        validresult = {'uid': 1234, 'envfrom': None, 'msgid': None, 'envdate': None, 'date': '27-Mar-2007 00:51:31 +0000', 'size': 4321, 'gmmsgid': 1278455344230334866, 'gmthrid': 1278455344230334865, 'labels': ['\\Inbox', 'Foo Bar']}
+
+        result = self.imap.parse_summary_data(data)
+
+        self.assertEqual(sorted(validresult.keys()), sorted(result.keys()), "wrong keys in result")
+
+        for i in validresult:
+            self.assertEqual(validresult[i], result[i], "mismatch on %s" % i)
+
+    def testBatch(self):
+        """
+        Tests a summary fetch of several messages in one go, with a flag
+        change from another client mixed in.
+
+        >>> imap.uid('FETCH', '1234,1236', '(UID RFC822.SIZE INTERNALDATE X-GM-MSGID X-GM-THRID X-GM-LABELS)')
+        """
+        status, data = ('OK', [b'14 (X-GM-THRID 6 X-GM-MSGID 6 X-GM-LABELS () UID 1236 RFC822.SIZE 99 INTERNALDATE "28-Mar-2007 00:51:31 +0000")',
+                               b'13 (FLAGS (\\Seen))',
+                               b'12 (X-GM-THRID 5 X-GM-MSGID 5 X-GM-LABELS (\\Inbox) UID 1234 RFC822.SIZE 4321 INTERNALDATE "27-Mar-2007 00:51:31 +0000")'])
+
+        result = self.imap.parse_summaries_data(data)
+
+        self.assertEqual([(r['uid'], r['size'], r['gmmsgid']) for r in result],
+                         [(1234, 4321, 5), (1236, 99, 6)])
+        self.assertEqual(self.imap.parse_summaries_data([None]), [])
+
+    def testGmailMsgidResponse(self):
+        """
+        Tests picking the uid and X-GM-MSGID out of a bulk fetch response.
+        """
+        mo = simpleimap.GmailMsgidResponse.match('7 (X-GM-MSGID 1278455344230334866 UID 1234)')
+        self.assertEqual(mo.group('uid'), '1234')
+        self.assertEqual(mo.group('gmmsgid'), '1278455344230334866')
+
+class TestFlagsResponse(unittest.TestCase):
+    """ Test picking flags (and MODSEQ) out of a UID FETCH (FLAGS)
+    """
+
+    def testFlags(self):
+        mo = simpleimap.FlagsResponse.match('3 (FLAGS (\\Seen \\Flagged) UID 42 MODSEQ (12345))')
+        self.assertEqual(mo.group('uid'), '42')
+        self.assertEqual(mo.group('flags').split(), ['\\Seen', '\\Flagged'])
+        mo = simpleimap.ModseqItem.search('3 (FLAGS (\\Seen \\Flagged) UID 42 MODSEQ (12345))')
+        self.assertEqual(mo.group('modseq'), '12345')
+
+    def testNoFlags(self):
+        mo = simpleimap.FlagsResponse.match('4 (UID 43 FLAGS ())')
+        self.assertEqual(mo.group('uid'), '43')
+        self.assertEqual(mo.group('flags').split(), [])
+
+class TestDeflateStream(unittest.TestCase):
+    """ Test the COMPRESS=DEFLATE stream layer
+    """
+
+    def testRoundTrip(self):
+        """
+        Tests that what one end sends, the other end reads, line by line
+        and in odd-sized chunks.
+        """
+        wire = []
+        sender = simpleimap.DeflateStream(None, wire.append)
+        sender.send(b'* OK first line\r\n')
+        sender.send(b'* 1 FETCH (RFC822 {10}\r\n0123456789)\r\n')
+
+        # Hand the receiver the compressed bytes a few at a time, like a
+        # slow socket would.
+        data = b''.join(wire)
+        chunks = [data[i:i+3] for i in range(0, len(data), 3)]
+        receiver = simpleimap.DeflateStream(lambda size: chunks.pop(0), None)
+
+        self.assertEqual(receiver.readline(), b'* OK first line\r\n')
+        self.assertEqual(receiver.readline(), b'* 1 FETCH (RFC822 {10}\r\n')
+        self.assertEqual(receiver.read(4), b'0123')
+        self.assertEqual(receiver.read(6), b'456789')
+        self.assertEqual(receiver.readline(), b')\r\n')
+
+    def testEOF(self):
+        """
+        Tests that a dropped connection doesn't spin forever.
+        """
+        receiver = simpleimap.DeflateStream(lambda size: b'', None)
+        self.assertRaises(EOFError, receiver.readline)
+
+class TestRateGovernor(unittest.TestCase):
+    """ Test the token buckets and throttling backoff
+    """
+
+    def testTokenBucket(self):
+        """
+        Tests that a bucket lets a burst through, then makes us wait.
+        """
+        bucket = simpleimap.TokenBucket(rate=100)
+        self.assertEqual(bucket.consume(100), 0)
+        waited = bucket.consume(10)
+        self.assertTrue(0.05 < waited < 0.2, waited)
+
+    def testUnlimited(self):
+        """
+        Tests that a rate of 0 never waits.
+        """
+        bucket = simpleimap.TokenBucket()
+        self.assertEqual(bucket.consume(10 ** 9), 0)
+
+    def testBackoff(self):
+        """
+        Tests that throttling cuts the rate and adds a pause, and that
+        good responses undo it bit by bit.
+        """
+        host = simpleimap.HostGovernor()
+        host.throttled()
+        host.throttled()
+        self.assertEqual(host.factor, 0.25)
+        self.assertEqual(host.pause, 2.0)
+        host.ok()
+        self.assertEqual(host.pause, 1.0)
+        self.assertTrue(0.25 < host.factor < 0.5)
+        for i in range(100):
+            host.ok()
+        self.assertEqual((host.factor, host.pause), (1.0, 0.0))
+
+class TestBatchSizer(unittest.TestCase):
+    """ Test picking batch sizes from how long round trips take
+    """
+
+    def testGrowAndShrink(self):
+        """
+        Tests that quick round trips grow the size a step at a time, and a
+        slow one halves it.
+        """
+        sizer = simpleimap.BatchSizer(16, 1, 500, step=16, target=2.0)
+        self.assertEqual(sizer.measure(0.5), 32)
+        self.assertEqual(sizer.measure(0.5), 48)
+        # A short batch (the last one) doesn't say the window is too small
+        self.assertEqual(sizer.measure(0.1, 10), 48)
+        self.assertEqual(sizer.measure(3.0), 24)
+        self.assertEqual(sizer.decrease(), 12)
+        stats = sizer.stats()
+        self.assertEqual(stats['size'], 12)
+        self.assertTrue(0.5 < stats['rtt'] < 3.0, stats)
+
+    def testBounds(self):
+        """
+        Tests that the size stays between the minimum and the maximum.
+        """
+        sizer = simpleimap.BatchSizer(1000, 10, 100, step=50)
+        self.assertEqual(sizer.size, 100)
+        self.assertEqual(sizer.measure(0.1), 100)
+        for i in range(10):
+            sizer.measure(10.0)
+        self.assertEqual(sizer.size, 10)
+
+class TestTlsSessions(unittest.TestCase):
+    """ Test sharing TLS sessions between connections
+    """
+
+    def testCache(self):
+        """
+        Tests that every connection gets the same SSLContext, and the last
+        session for its host and port.
+        """
+        cache = simpleimap.TlsSessionCache()
+        self.assertTrue(cache.get_context() is cache.get_context())
+        self.assertFalse(cache.get_context().check_hostname)
+        self.assertEqual(cache.get_context().verify_mode, ssl.CERT_NONE)
+        self.assertEqual(cache.get('imap.example.com', 993), None)
+        cache.put('imap.example.com', 993, 'session1')
+        cache.put('imap.example.com', 993, None)
+        cache.put('imap.example.org', 993, 'session2')
+        self.assertEqual(cache.get('imap.example.com', 993), 'session1')
+        self.assertEqual(cache.get('imap.example.com', 143), None)
+        self.assertEqual(cache.get('imap.example.org', 993), 'session2')
+
+class TestKeepalive(unittest.TestCase):
+    """ Test the keepalive, without connecting to anything
+    """
+
+    class Connection(simpleimap.SimpleImapSSL):
+        def __init__(self):
+            pass
+
+    def setUp(self):
+        self.noops = []
+        self.imap = self.Connection()
+        self.imap.noop = lambda: self.noops.append(time.time())
+        self.server = simpleimap.Server()
+        self.server._Server__connection = self.imap
+
+    def testIdle(self):
+        """Tests that we only NOOP once the connection has been idle
+        """
+        self.imap._lastcommand = time.time()
+        self.server.Keepalive(30)
+        self.assertEqual(self.noops, [])
+        self.imap._lastcommand = time.time() - 31
+        self.server.Keepalive(30)
+        self.assertEqual(len(self.noops), 1)
+
+    def testBusy(self):
+        """Tests that we stay out of the way of a running command
+        """
+        locked = threading.Event()
+        done = threading.Event()
+        def command():
+            lock = self.imap.commandlock()
+            lock.acquire()
+            locked.set()
+            done.wait()
+            lock.release()
+        thread = threading.Thread(target=command)
+        thread.start()
+        locked.wait()
+        try:
+            self.server.Keepalive(0)
+        finally:
+            done.set()
+            thread.join()
+        self.assertEqual(self.noops, [])
+        self.server.Keepalive(0)
+        self.assertEqual(len(self.noops), 1)
+
+    def testThread(self):
+        """Tests that the thread keeps alive in the background until stopped
+        """
+        self.imap._lastcommand = 0
+        thread = simpleimap.KeepaliveThread(self.server, idle=0.03)
+        self.assertTrue(thread.daemon)
+        thread.start()
+        time.sleep(0.1)
+        thread.stop()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(self.noops)
+
+class TestWaitReadable(unittest.TestCase):
+    """ Test waiting for the server to say something
+    """
+
+    class Connection(simpleimap.SimpleImap):
+        def __init__(self, sock):
+            self.sock = sock
+            self.file = sock.makefile('rb')
+
+    def testBuffered(self):
+        """An EXISTS in the same packet as the continuation is noticed
+        """
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        ours = socket.create_connection(listener.getsockname())
+        theirs = listener.accept()[0]
+        listener.close()
+        try:
+            connection = self.Connection(ours)
+            self.assertFalse(connection._wait_readable(0))
+            theirs.sendall(b'+ idling\r\n* 3 EXISTS\r\n')
+            self.assertEqual(connection.file.readline(), b'+ idling\r\n')
+            self.assertTrue(connection._wait_readable(0))
+            self.assertEqual(connection.file.readline(), b'* 3 EXISTS\r\n')
+            self.assertFalse(connection._wait_readable(0))
+            theirs.sendall(b'* 4 EXISTS\r\n')
+            self.assertTrue(connection._wait_readable(1))
+            connection.file.close()
+        finally:
+            ours.close()
+            theirs.close()
+
+class TestUidSet(unittest.TestCase):
+
+    def testRanges(self):
+        """Tests that UIDs are coalesced into ranges
+        """
+        uids = simpleimap.UidSet([5, 1, 2, 3, 9, 10, 3])
+        self.assertEqual(str(uids), '1:3,5,9:10')
+        self.assertEqual(len(uids), 6)
+        self.assertEqual(list(uids), [1, 2, 3, 5, 9, 10])
+        self.assertEqual(list(reversed(uids)), [10, 9, 5, 3, 2, 1])
+        self.assertTrue(5 in uids)
+        self.assertFalse(4 in uids)
+        self.assertFalse(0 in uids)
+        self.assertFalse(11 in uids)
+
+    def testSequenceSet(self):
+        """Tests parsing an ESEARCH sequence set
+        """
+        uids = simpleimap.UidSet.from_sequence_set(b'9:6,1:4,5,20')
+        self.assertEqual(str(uids), '1:9,20')
+        self.assertEqual(len(uids), 10)
+        self.assertEqual(uids, simpleimap.UidSet(list(range(1, 10)) + [20]))
+        self.assertEqual(len(simpleimap.UidSet.from_sequence_set('')), 0)
+
+    def testAdd(self):
+        """Tests adding single UIDs, joining ranges where they touch
+        """
+        uids = simpleimap.UidSet.from_sequence_set('1:3,7:9')
+        for uid in (5, 2, 10, 4, 6, 20):
+            uids.add(uid)
+        self.assertEqual(str(uids), '1:10,20')
+        self.assertEqual(len(uids), 11)
+
+    def testSearch(self):
+        """Tests a plain UID SEARCH answer, from a server without ESEARCH
+        """
+        class Connection(simpleimap.SimpleImap):
+            def __init__(self):
+                pass
+
+            def select(self, folder, readonly=False):
+                return 'OK', [b'6']
+
+            def has_capability(self, capability):
+                return False
+
+            def uid(self, command, *args):
+                return 'OK', [b'4 5 6 7 1 2 9 10']
+        uids = Connection().get_uids_by_folder('INBOX')
+        self.assertEqual(str(uids), '1:2,4:7,9:10')
+        self.assertEqual(len(uids), 8)
+
+    def testDifference(self):
+        """Tests the merge pass that turbo mode uses
+        """
+        server = simpleimap.UidSet.from_sequence_set('1:100,200:300,400')
+        known = simpleimap.UidSet.from_sequence_set('5:10,50:250,290,500')
+        missing = server.difference(known)
+        self.assertEqual(str(missing), '1:4,11:49,251:289,291:300,400')
+        self.assertEqual(set(missing), set(server) - set(known))
+        self.assertEqual(len(server.difference(server)), 0)
+        self.assertEqual(server.difference(simpleimap.UidSet()), server)
+
+    def testDifferenceLarge(self):
+        """Tests a big, mostly-known folder against the plain set version
+        """
+        server = simpleimap.UidSet.from_ranges([(1, 200000), (200100, 400000)])
+        known = simpleimap.UidSet([uid for uid in range(1, 400001) if uid % 997])
+        missing = server.difference(known)
+        self.assertEqual(set(missing), set(server) - set(known))
+        self.assertEqual(list(missing), sorted(set(server) - set(known)))
+        self.assertEqual(len(missing), len(set(server) - set(known)))
+
+class TestHeaderMessage(unittest.TestCase):
+    """ Test the header-only lazyMaildir factory
+    """
+
+    message = (b'Return-Path: <alice@example.com>\r\n' +
+               b''.join([b'Received: from relay%i.example.com by mx.example.org;\r\n'
+                         b'\tWed, 01 Jul 2015 15:30:%02i +0000\r\n' % (i, i)
+                         for i in range(20)]) +
+               b'From: Alice <alice@example.com>\r\n'
+               b'To: Bob <bob@example.org>\r\n'
+               b'Subject: A long\r\n  folded subject\r\n'
+               b'Date: Wed, 01 Jul 2015 15:30:49 +0000\r\n'
+               b'Message-ID: <1234@example.com>\r\n'
+               b'\r\n' +
+               b'Hello, Bob.\r\n' * 5000)
+
+    def testHeaders(self):
+        msg = imap2maildir.HeaderMessage(io.BytesIO(self.message))
+        self.assertEqual(msg['subject'], 'A long folded subject')
+        self.assertEqual(msg.get('Message-ID'), '<1234@example.com>')
+        self.assertEqual(len(msg.get_all('Received')), 20)
+        self.assertTrue('From' in msg)
+        self.assertFalse('Cc' in msg)
+        self.assertRaises(KeyError, lambda: msg['Cc'])
+        self.assertEqual(msg.get_body(), b'Hello, Bob.\r\n' * 5000)
+
+    def testNoHeaders(self):
+        """A message with no headers still has to count as there
+        """
+        msg = imap2maildir.HeaderMessage(io.BytesIO(b'\nJust a body\n'))
+        self.assertEqual(len(msg), 0)
+        self.assertTrue(msg)
+        self.assertEqual(msg.get_body(), b'Just a body\n')
+
+    def testLongHeaders(self):
+        """Headers longer than one read
+        """
+        msg = imap2maildir.HeaderMessage.__new__(imap2maildir.HeaderMessage)
+        msg.headersize = 100
+        msg.__init__(io.BytesIO(self.message))
+        self.assertEqual(msg['Date'], 'Wed, 01 Jul 2015 15:30:49 +0000')
+        self.assertTrue(msg.get_body().startswith(b'Hello, Bob.'))
+
+    def testSameHeaders(self):
+        """HeaderMessage has the same headers rfc822py3 (the old factory) and
+        the email package find, give or take folding"""
+        def unfold(values):
+            return [' '.join(value.split()) for value in values]
+
+        msg = imap2maildir.HeaderMessage(io.BytesIO(self.message))
+        old = rfc822py3.Message(io.StringIO(self.message.decode('latin-1')))
+        emailmsg = getattr(email, 'message_from_bytes', email.message_from_string)(self.message)
+        self.assertEqual([name.lower() for name in msg.keys()],
+                         [name.lower() for name in emailmsg.keys()])
+        for name in set(old.keys()):
+            self.assertEqual(unfold(msg.get_all(name)), unfold(old.getheaders(name)))
+            self.assertEqual(unfold(msg.get_all(name)), unfold(emailmsg.get_all(name)))
+            self.assertEqual(unfold([msg.getheader(name)]), unfold([emailmsg[name]]))
+
+class TestLazyMaildir(unittest.TestCase):
+    """ Test the subfolder handles lazyMaildir keeps around
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.mbox = imap2maildir.open_mailbox_maildir(os.path.join(self.dir, 'md'), create=True)
+        for name in ('Drafts', 'Sent', 'Trash'):
+            self.mbox.add_folder(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testFolderCache(self):
+        """The least recently used folder is the one let go
+        """
+        self.mbox.foldercachesize = 2
+        self.mbox._folders.clear()
+        drafts = self.mbox.get_folder('Drafts')
+        self.mbox.get_folder('Sent')
+        self.assertTrue(self.mbox.get_folder('Drafts') is drafts)
+        self.mbox.get_folder('Trash')
+        self.assertEqual(list(self.mbox._folders), ['Drafts', 'Trash'])
+        self.assertTrue(self.mbox.get_folder('Drafts') is drafts)
+
+        self.mbox.remove_folder('Trash')
+        self.assertEqual(list(self.mbox._folders), ['Drafts'])
+
+    def testEmptyFolder(self):
+        """An empty subfolder is still the one written to
+        """
+        sent = imap2maildir.folder_mailbox(self.mbox, 'Sent')
+        self.assertEqual(len(sent), 0)
+        self.assertEqual(sent._path, os.path.join(self.mbox._path, '.Sent'))
+        self.assertTrue(imap2maildir.folder_mailbox(self.mbox, '') is self.mbox)
+
+        key = sent.add(b'From: a@example.com\nSubject: hi\n\nHello\n')
+        self.assertEqual(list(self.mbox.get_folder('Sent').keys()), [key])
+        self.assertEqual(list(self.mbox.keys()), [])
+
+
+class TestSeenMessagesCache(unittest.TestCase):
+    """ Test loading the seen cache in the background
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = imap2maildir.open_sql_session(os.path.join(self.dir, 'db.sqlite'))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def testBackgroundLoad(self):
+        for uid in range(1, 101):
+            imap2maildir.store_hash(self.db, 'hash%i' % uid, 'file%i' % uid, uid,
+                                    gmmsgid=uid * 1000)
+        imap2maildir.store_hash(self.db, 'nouid', 'fileX', None)
+        seencache = imap2maildir.SeenMessagesCache()
+        seencache.start_loading(self.db)
+        seencache.wait()
+        self.assertEqual(len(seencache.hashes), 101)
+        self.assertEqual(seencache.uids['42'], ('', 'file42'))
+        self.assertEqual(seencache.gmmsgids[42000], ('', 'file42'))
+        self.assertEqual(str(seencache.uidset), '1:100')
+        self.assertTrue(imap2maildir.known_uids(self.db, seencache) is seencache.uidset)
+
+class TestJournal(unittest.TestCase):
+    """ Test recovering from a crash halfway through writing messages
+    """
+
+    message = b'From: a@example.com\nSubject: hi\nMessage-ID: <1@example.com>\n\nHello\n'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = imap2maildir.open_sql_session(os.path.join(self.dir, 'db.sqlite'))
+        self.journalfile = os.path.join(self.dir, 'journal')
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def record(self, n):
+        return {'hash': 'hash%i' % n, 'uid': n, 'remotefolder': 'INBOX',
+                'internaldate': 1435764649, 'gmmsgid': None, 'labels': None}
+
+    def stored(self):
+        return [row[0] for row in self.db.execute(
+            'select uid from seenmessages order by uid')]
+
+    def testMaildir(self):
+        mbox = imap2maildir.open_mailbox_maildir(os.path.join(self.dir, 'md'), create=True)
+        journal = imap2maildir.Journal(self.journalfile, self.db)
+        key = journal.add(mbox, self.message, self.record(1))
+        # ...and we die before recording it.  A second one dies halfway:
+        tmpfile = mbox._create_tmp()
+        tmpfile.write(b'From: b@exa')
+        tmpfile.close()
+        journal._Journal__write(dict(self.record(2), op='I',
+            tmp=os.path.relpath(tmpfile.name, mbox._path), new='new/nope'))
+
+        journal = imap2maildir.Journal(self.journalfile, self.db)
+        self.assertEqual(journal.recover(mbox), (1, 1))
+        self.assertEqual(self.stored(), [1])
+        self.assertTrue(mbox.get(key))
+        self.assertEqual(os.listdir(os.path.join(mbox._path, 'tmp')), [])
+        self.assertEqual(journal.recover(mbox), (0, 0))
+
+    def testMaildirMessage(self):
+        """A MaildirMessage goes where it says, with its flags
+        """
+        mbox = imap2maildir.open_mailbox_maildir(os.path.join(self.dir, 'md'), create=True)
+        journal = imap2maildir.Journal(self.journalfile, self.db)
+        message = mailbox.MaildirMessage(self.message)
+        message.set_subdir('cur')
+        message.set_flags('SR')
+        key = journal.add(mbox, message, self.record(1))
+        self.assertEqual(mbox._lookup(key), os.path.join('cur', key + ':2,RS'))
+        self.assertEqual(os.listdir(os.path.join(mbox._path, 'tmp')), [])
+
+        # Died before saying so, after linking it but before the unlink
+        journal = imap2maildir.Journal(self.journalfile, self.db)
+        os.link(os.path.join(mbox._path, 'cur', key + ':2,RS'),
+                os.path.join(mbox._path, 'tmp', key))
+        with open(self.journalfile, 'w') as fileobj:
+            fileobj.write(json.dumps(dict(self.record(1), op='I', tmp=os.path.join('tmp', key),
+                                          new=os.path.join('cur', key + ':2,RS'))) + '\n')
+        self.assertEqual(journal.recover(mbox), (1, 0))
+        self.assertEqual(self.db.execute('select mailfile from seenmessages').fetchall(),
+                         [(key,)])
+        self.assertEqual(os.listdir(os.path.join(mbox._path, 'tmp')), [])
+
+    def testClash(self):
+        """A name that's taken already isn't overwritten
+        """
+        mbox = imap2maildir.open_mailbox_maildir(os.path.join(self.dir, 'md'), create=True)
+        create_tmp = mbox._create_tmp
+        def clash():
+            tmpfile = create_tmp()
+            uniq = os.path.basename(tmpfile.name).split(mbox.colon)[0]
+            with open(os.path.join(mbox._path, 'new', uniq), 'wb') as fileobj:
+                fileobj.write(b'Someone else')
+            return tmpfile
+        mbox._create_tmp = clash
+        journal = imap2maildir.Journal(self.journalfile, self.db)
+        self.assertRaises(mailbox.ExternalClashError, journal.add, mbox, self.message,
+                          self.record(1))
+        names = os.listdir(os.path.join(mbox._path, 'new'))
+        with open(os.path.join(mbox._path, 'new', names[0]), 'rb') as fileobj:
+            self.assertEqual(fileobj.read(), b'Someone else')
+        self.assertEqual(os.listdir(os.path.join(mbox._path, 'tmp')), [])
+
+    def testMbox(self):
+        path = os.path.join(self.dir, 'mbox')
+        mbox = imap2maildir.open_mailbox_mbox(path, create=True)
+        journal = imap2maildir.Journal(self.journalfile, self.db)
+        imap2maildir.store_hash(self.db, 'hash1', journal.add(mbox, self.message, self.record(1)), 1)
+        journal.done()
+        journal.checkpoint()
+        size = os.path.getsize(path)
+        journal.add(mbox, self.message, self.record(2))
+        # Dies as it starts on the third
+        journal._Journal__write(dict(self.record(3), op='I',
+                                     offset=os.path.getsize(path)))
+        mbox._file.write(b'From MAILER-DAEMON Thu Jan  1 00:00:00 1970\nFrom: c@exa')
+        mbox._file.flush()
+        mbox.unlock()
+
+        mbox = imap2maildir.open_mailbox_mbox(path)
+        journal = imap2maildir.Journal(self.journalfile, self.db)
+        self.assertEqual(journal.recover(mbox), (1, 1))
+        self.assertEqual(self.stored(), [1, 2])
+        self.assertEqual(len(mbox), 2)
+        self.assertTrue(os.path.getsize(path) > size)
+        mbox.unlock()
+
+class TestSummaryCache(unittest.TestCase):
+    """ Test keeping summaries between runs
+    """
+
+    class Connection(object):
+        """ Just enough of a SimpleImap for FolderClass.Summaries
+        """
+        host = 'imap.example.com'
+
+        def __init__(self):
+            self.fetched = []
+
+        def has_capability(self, capability):
+            return False
+
+        def select(self, folder, readonly=False):
+            return 'OK', [b'3']
+
+        def response(self, code):
+            return code, [b'42']
+
+        def get_uids_by_folder(self, folder, charset, search):
+            return simpleimap.UidSet([1, 2, 3])
+
+        def get_summary_by_uid(self, uid, envelope, gmail):
+            self.fetched.append(uid)
+            return {'uid': uid, 'msgid': '<%i@example.com>' % uid, 'size': 100 + uid,
+                    'date': '01-Jul-2015 11:30:49 -0400', 'envfrom': 'a@example.com',
+                    'envdate': None}
+
+        def get_summaries_by_uids(self, uids, envelope, gmail):
+            return dict([(uid, self.get_summary_by_uid(uid, envelope, gmail))
+                         for uid in uids])
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = imap2maildir.open_sql_session(os.path.join(self.dir, 'db.sqlite'))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def summaries(self, connection):
+        folder = simpleimap.FolderClass(connection, 'INBOX')
+        len(folder)
+        cache = imap2maildir.SummaryCache(self.db, folder.folder, folder.uidvalidity)
+        folder.__summarycache__(cache)
+        return list(folder.Summaries())
+
+    def testCache(self):
+        connection = self.Connection()
+        first = self.summaries(connection)
+        self.assertEqual(connection.fetched, [1, 2, 3])
+        self.db.commit()
+
+        # Message 2 got stored; the others are still to do
+        imap2maildir.store_hash(self.db, first[1]['hash'], 'file2', 2, remotefolder='INBOX')
+        connection = self.Connection()
+        second = self.summaries(connection)
+        self.assertEqual(connection.fetched, [2])
+        self.assertEqual(second, first)
+
+    def testPurge(self):
+        """Summaries of messages that have gone from the server go too
+        """
+        self.summaries(self.Connection())
+        self.db.commit()
+        cache = imap2maildir.SummaryCache(self.db, 'INBOX', 42)
+        cache.purge(simpleimap.UidSet([1, 3]))
+        cache = imap2maildir.SummaryCache(self.db, 'INBOX', 42)
+        self.assertEqual(sorted(cache.summaries), [1, 3])
+
+    def testWantEnvelope(self):
+        """A summary fetched without the ENVELOPE won't do when we want one
+        """
+        cache = imap2maildir.SummaryCache(self.db, 'INBOX', 42)
+        cache.put({'uid': 1, 'msgid': None, 'size': 100, 'date': '01-Jul-2015 11:30:49 -0400',
+                   'envfrom': None, 'envdate': None, 'gmmsgid': 5, 'gmthrid': 6,
+                   'labels': ['\\Inbox']}, envelope=False)
+        self.assertEqual(cache.get(1, envelope=True), None)
+        cache = imap2maildir.SummaryCache(self.db, 'INBOX', 42)
+        self.assertEqual(cache.get(1, envelope=False)['labels'], ['\\Inbox'])
+        self.assertEqual(imap2maildir.SummaryCache(self.db, 'INBOX', 43).get(1, False), None)
+
+class TestOrder(unittest.TestCase):
+    """ Test which messages Summaries hands over first
+    """
+
+    class Connection(TestSummaryCache.Connection):
+        def get_sizes_by_uids(self, uids):
+            return {1: 300, 2: 100, 3: 200}
+
+    def order(self, order):
+        folder = simpleimap.FolderClass(self.Connection(), 'INBOX')
+        return [summ['uid'] for summ in folder.Summaries(order=order)]
+
+    def testOrder(self):
+        self.assertEqual(self.order('oldest'), [1, 2, 3])
+        self.assertEqual(self.order('newest'), [3, 2, 1])
+        self.assertEqual(self.order('smallest'), [2, 3, 1])
+
+    def testBatchFails(self):
+        """A batch the server won't answer is fetched one at a time instead
+        """
+        class Connection(self.Connection):
+            def get_summaries_by_uids(self, uids, envelope, gmail):
+                raise Exception('BAD too many')
+        folder = simpleimap.FolderClass(Connection(), 'INBOX')
+        size = folder.summarybatch.size
+        logging.disable(logging.ERROR)
+        try:
+            self.assertEqual([summ['uid'] for summ in folder.Summaries()], [1, 2, 3])
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(folder.summarybatch.size, size // 2)
+
+    def testMissed(self):
+        """A uid whose summary can't be had at all is skipped, and counted
+        """
+        class Connection(self.Connection):
+            def get_summaries_by_uids(self, uids, envelope, gmail):
+                raise Exception('BAD too many')
+
+            def get_summary_by_uid(self, uid, envelope, gmail):
+                if uid == 2:
+                    raise Exception('BAD broken')
+                return TestOrder.Connection.get_summary_by_uid(self, uid, envelope, gmail)
+        folder = simpleimap.FolderClass(Connection(), 'INBOX')
+        logging.disable(logging.ERROR)
+        try:
+            self.assertEqual([summ['uid'] for summ in folder.Summaries()], [1, 3])
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(folder.missedcounter(), 1)
+        folder.__turbo__(None)
+        self.assertEqual(folder.missedcounter(), 0)
+
+    def testSizeResponse(self):
+        mo = simpleimap.SizeResponse.match('7 (RFC822.SIZE 4321 UID 1234)')
+        self.assertEqual(mo.group('uid'), '1234')
+        self.assertEqual(mo.group('size'), '4321')
+
+class TestReconnect(unittest.TestCase):
+    """ Test picking up again after the connection drops
+    """
+
+    class Connection(TestSummaryCache.Connection):
+        """Drops the connection once it has handed over dropafter
+        summaries (None: never)"""
+
+        def __init__(self, dropafter=None, uidvalidity=42):
+            self.fetched = []
+            self.dropafter = dropafter
+            self.uidvalidity = uidvalidity
+
+        def response(self, code):
+            return code, [str(self.uidvalidity).encode('ascii')]
+
+        def get_uids_by_folder(self, folder, charset, search):
+            return simpleimap.UidSet(range(1, 11))
+
+        def get_summaries_by_uids(self, uids, envelope, gmail):
+            if self.dropafter is not None and len(self.fetched) >= self.dropafter:
+                raise socket.error('Connection reset by peer')
+            return TestSummaryCache.Connection.get_summaries_by_uids(self, uids, envelope,
+                                                                     gmail)
+
+    class Server(simpleimap.Server):
+        """Fails to connect the first failures times"""
+
+        def __init__(self, failures, retries):
+            simpleimap.Server.__init__(self, retries=retries, backoff=1)
+            self.failures = failures
+            self.attempts = 0
+
+        def Connect(self):
+            self.attempts += 1
+            if self.attempts <= self.failures:
+                raise socket.error('Connection refused')
+            self._Server__connection = 'connection %i' % self.attempts
+
+    def setUp(self):
+        self.connections = []
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def folder(self, connection, *reconnections):
+        self.connections = [connection] + list(reconnections)
+        reconnections = list(reconnections)
+        folder = simpleimap.FolderClass(connection, 'INBOX')
+        folder.__reconnector__(lambda: reconnections.pop(0))
+        folder.summarybatch = simpleimap.BatchSizer(2, 2, 2)
+        len(folder)
+        return folder
+
+    def testResume(self):
+        """Summaries carry on at the uid they stopped at, on a new connection
+        """
+        folder = self.folder(self.Connection(dropafter=4), self.Connection())
+        self.assertEqual([summ['uid'] for summ in folder.Summaries()], list(range(1, 11)))
+        self.assertEqual(self.connections[0].fetched, [1, 2, 3, 4])
+        self.assertEqual(self.connections[1].fetched, [5, 6, 7, 8, 9, 10])
+
+    def testGiveUp(self):
+        """After three reconnects that don't help, the error goes up; the
+        next run starts after the last uid stored"""
+        folder = self.folder(self.Connection(dropafter=4),
+                             *[self.Connection(dropafter=0) for i in range(3)])
+        stored = []
+        try:
+            for summ in folder.Summaries():
+                stored.append(summ['uid'])
+        except socket.error:
+            pass
+        else:
+            self.fail('Summaries kept going without a connection')
+        self.assertEqual(stored, [1, 2, 3, 4])
+        self.assertEqual([c.fetched for c in self.connections[1:]], [[], [], []])
+
+        connection = self.Connection()
+        folder = self.folder(connection)
+        folder.__turbo__(simpleimap.UidSet(stored))
+        self.assertEqual([summ['uid'] for summ in folder.Summaries()], [5, 6, 7, 8, 9, 10])
+        self.assertEqual(connection.fetched, [5, 6, 7, 8, 9, 10])
+        self.assertEqual(folder.turbocounter(), 4)
+
+    def testUidValidity(self):
+        """If the folder's UIDVALIDITY changed while we were away, the uids
+        we have mean nothing, so we stop"""
+        folder = self.folder(self.Connection(dropafter=4), self.Connection(uidvalidity=43))
+        summaries = folder.Summaries()
+        self.assertEqual([next(summaries)['uid'] for i in range(4)], [1, 2, 3, 4])
+        self.assertRaises(simpleimap.UidValidityError, next, summaries)
+
+    def testBackoff(self):
+        """Server.Reconnect waits longer after each failed attempt
+        """
+        sleeps = []
+        sleep = time.sleep
+        time.sleep = sleeps.append
+        try:
+            server = self.Server(failures=3, retries=8)
+            self.assertEqual(server.Reconnect(), 'connection 4')
+            self.assertEqual(sleeps, [1, 2, 4])
+
+            del sleeps[:]
+            server = self.Server(failures=10, retries=4)
+            self.assertRaises(socket.error, server.Reconnect)
+            self.assertEqual(server.attempts, 4)
+            self.assertEqual(sleeps, [1, 2, 4])
+        finally:
+            time.sleep = sleep
+
+
+class TestLargeMessageLane(unittest.TestCase):
+    """ Test fetching big messages in chunks on a connection of their own
+    """
+
+    class Connection(TestSummaryCache.Connection):
+        message = b'From: a@example.com\nSubject: big\n\n' + b'x' * 1000
+
+        def __init__(self):
+            self.fetched = []
+
+        def Folder(self, folder, charset=None):
+            return simpleimap.FolderClass(self, folder, charset)
+
+        def get_message_chunk_by_uid(self, uid, offset, length):
+            self.fetched.append((uid, offset))
+            return self.message[offset:offset + length]
+
+        def logout(self):
+            pass
+
+    class Server(object):
+        def __init__(self, connection):
+            self.connection = connection
+
+        def Clone(self):
+            return self
+
+        def Get(self):
+            return self.connection
+
+        def Reconnect(self):
+            pass
+
+        def StartKeepalive(self):
+            pass
+
+        def StopKeepalive(self):
+            pass
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.connection = self.Connection()
+        self.lane = imap2maildir.LargeMessageLane(self.Server(self.connection), 'INBOX', 42,
+                                                  self.dir, chunksize=256)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def summary(self, uid):
+        return {'uid': uid, 'size': len(self.Connection.message)}
+
+    def testResume(self):
+        """A partial file from last time is carried on from where it stopped
+        """
+        path = self.lane.partfile(7)
+        with open(path, 'wb') as fileobj:
+            fileobj.write(self.Connection.message[:300])
+        self.assertTrue(self.lane.submit(self.summary(7), 'hash7'))
+        done = list(self.lane.completed(wait=True))
+        self.assertEqual([(summ['uid'], msghash, p) for summ, msghash, p in done],
+                         [(7, 'hash7', path)])
+        self.assertEqual(self.connection.fetched, [(7, 300), (7, 556), (7, 812)])
+        with open(path, 'rb') as fileobj:
+            self.assertEqual(fileobj.read(), self.Connection.message)
+
+    def testSameHash(self):
+        """Two copies of a message on the server are only fetched once
+        """
+        self.assertTrue(self.lane.submit(self.summary(7), 'hash'))
+        self.assertFalse(self.lane.submit(self.summary(8), 'hash'))
+        done = list(self.lane.completed(wait=True))
+        self.assertEqual([summ['uid'] for summ, msghash, path in done], [7])
+        self.assertEqual(set(uid for uid, offset in self.connection.fetched), set([7]))
+
+    def testFails(self):
+        """A message that can't be fetched comes back with no path
+        """
+        class Connection(self.Connection):
+            def get_message_chunk_by_uid(self, uid, offset, length):
+                raise Exception('NO gone')
+        lane = imap2maildir.LargeMessageLane(self.Server(Connection()), 'INBOX', 42, self.dir)
+        lane.submit(self.summary(7), 'hash7')
+        logging.disable(logging.ERROR)
+        try:
+            done = list(lane.completed(wait=True))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual([(summ['uid'], path) for summ, msghash, path in done], [(7, None)])
+
+class TestVerify(unittest.TestCase):
+    """ Test cross-checking the database against the disk and the server
+    """
+
+    class Folder(object):
+        """ Just enough of a FolderClass for verify
+        """
+        folder = 'INBOX'
+        uidvalidity = 42
+
+        def __init__(self, uids):
+            self.uids = uids
+
+        def __len__(self):
+            return len(self.uids)
+
+        def UidSet(self, search='ALL'):
+            return simpleimap.UidSet(self.uids)
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = imap2maildir.open_sql_session(os.path.join(self.dir, 'db.sqlite'))
+        self.mbox = imap2maildir.open_mailbox_maildir(os.path.join(self.dir, 'md'), create=True)
+        self.keys = {}
+        for uid in range(1, 6):
+            self.keys[uid] = self.mbox.add(b'From: a@example.com\nSubject: %i\n\nHello\n' % uid)
+            imap2maildir.store_hash(self.db, 'hash%i' % uid, self.keys[uid], uid,
+                                    remotefolder='INBOX')
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def path(self, uid):
+        return os.path.join(self.mbox._path, self.mbox._lookup(self.keys[uid]))
+
+    def verify(self, folder=None, slicesize=0):
+        logging.disable(logging.WARNING)
+        try:
+            return imap2maildir.verify(self.db, self.mbox, folder, slicesize, threads=2)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def testClean(self):
+        self.mbox.add_folder('Empty')
+        result = self.verify(self.Folder(range(1, 6)))
+        self.assertEqual((result['checked'], result['missing'], result['empty'],
+                          result['orphans'], result['notonserver'], result['notdownloaded']),
+                         (5, 0, 0, 0, 0, 0))
+
+    def testMissing(self):
+        os.unlink(self.path(2))
+        self.assertEqual(self.verify()['missing'], 1)
+
+    def testEmpty(self):
+        open(self.path(3), 'w').close()
+        result = self.verify()
+        self.assertEqual((result['missing'], result['empty']), (0, 1))
+
+    def testOrphans(self):
+        """Files nobody recorded are found, in subfolders without rows too
+        """
+        self.mbox.add(b'From: b@example.com\n\nStray\n')
+        self.mbox.add_folder('Other').add(b'From: c@example.com\n\nStray\n')
+        self.assertEqual(self.verify()['orphans'], 2)
+
+    def testServer(self):
+        result = self.verify(self.Folder([1, 2, 4, 5, 6, 7]))
+        self.assertEqual((result['notonserver'], result['notdownloaded']), (1, 2))
+
+    def testSlices(self):
+        os.unlink(self.path(5))
+        self.mbox.add(b'From: b@example.com\n\nStray\n')
+        result = self.verify(slicesize=3)
+        self.assertEqual((result['checked'], result['missing'], result['complete']),
+                         (3, 0, False))
+        self.assertFalse('notonserver' in result)
+        result = self.verify(slicesize=3)
+        self.assertEqual((result['checked'], result['missing'], result['complete'],
+                          result['orphans']), (2, 1, True, 1))
+
+class TestSyncFlags(unittest.TestCase):
+    """ Test bringing maildir flags into line with the server's
+    """
+
+    class Folder(object):
+        folder = 'INBOX'
+
+        def __init__(self, flags):
+            self.flags = flags
+
+        def Flags(self, changedsince=None):
+            return self.flags, 7
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = imap2maildir.open_sql_session(os.path.join(self.dir, 'db.sqlite'))
+        self.mbox = imap2maildir.open_mailbox_maildir(os.path.join(self.dir, 'md'), create=True)
+        self.keys = {}
+        for uid in range(1, 4):
+            self.keys[uid] = self.mbox.add(b'From: a@example.com\nSubject: %i\n\nHello\n' % uid)
+            imap2maildir.store_hash(self.db, 'hash%i' % uid, self.keys[uid], uid,
+                                    remotefolder='INBOX')
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def subpath(self, uid):
+        return self.mbox._lookup(self.keys[uid])
+
+    def testFlags(self):
+        folder = self.Folder({1: ['\\Seen', '\\Flagged'], 2: [], 3: ['\\Answered', '$Junk']})
+        self.assertEqual(imap2maildir.sync_flags(self.db, folder, self.mbox), 2)
+        self.assertEqual(self.subpath(1), os.path.join('cur', self.keys[1] + ':2,FS'))
+        self.assertEqual(self.subpath(2), os.path.join('new', self.keys[2]))
+        self.assertEqual(self.subpath(3), os.path.join('cur', self.keys[3] + ':2,R'))
+        self.assertEqual(imap2maildir.sync_flags(self.db, folder, self.mbox), 0)
+
+    def testLocalFlags(self):
+        """Flags IMAP has no word for stay put
+        """
+        os.rename(os.path.join(self.mbox._path, self.subpath(1)),
+                  os.path.join(self.mbox._path, 'cur', self.keys[1] + ':2,PS'))
+        self.mbox._refresh()
+        folder = self.Folder({1: ['\\Flagged']})
+        self.assertEqual(imap2maildir.sync_flags(self.db, folder, self.mbox), 1)
+        self.assertEqual(self.subpath(1), os.path.join('cur', self.keys[1] + ':2,FP'))
+
+class TestIndex(unittest.TestCase):
+    """ Test the full-text index
+    """
+
+    invoice = (b'From: =?utf-8?q?Bj=C3=B6rn?= <bjorn@example.com>\nTo: a@example.com\n'
+               b'Subject: =?utf-8?q?Invoice_for_J=C3=BAly?=\nMessage-ID: <1@example.com>\n'
+               b'Content-Type: multipart/alternative; boundary="b"\n\n'
+               b'--b\nContent-Type: text/html; charset=utf-8\n\n'
+               b'<p>Fish for the <b>penguins</b></p>\n--b--\n')
+    other = (b'From: c@example.com\nTo: a@example.com\nSubject: lunch\n\n'
+             b'Sandwiches for everyone\n')
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = imap2maildir.open_sql_session(os.path.join(self.dir, 'db.sqlite'))
+        self.mbox = imap2maildir.open_mailbox_maildir(os.path.join(self.dir, 'md'), create=True)
+        self.indexfile = os.path.join(self.dir, 'index.sqlite')
+        self.keys = []
+        for n, content in enumerate([self.invoice, self.other]):
+            self.keys.append(self.mbox.add(content))
+            imap2maildir.store_hash(self.db, str(n + 1) * 40, self.keys[-1], n + 1)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def message(self, content):
+        return getattr(email, 'message_from_bytes', email.message_from_string)(content)
+
+    def search(self, query):
+        return [os.path.basename(path).split(':')[0] for path in
+                imap2maildir.search(self.mbox, self.indexfile, query)]
+
+    def testFields(self):
+        sender, recipients, subject, date, body = \
+            imap2maildir.index_fields(self.message(self.invoice))
+        self.assertTrue(u'Bj\xf6rn' in sender)
+        self.assertEqual(subject, u'Invoice for J\xfaly')
+        self.assertEqual(body.split(), ['Fish', 'for', 'the', 'penguins'])
+
+    def testInMemory(self):
+        index = imap2maildir.open_index(':memory:')
+        imap2maildir.store_index(index, '1' * 40, '', 'file1',
+                                 imap2maildir.index_fields(self.message(self.invoice)))
+        imap2maildir.store_index(index, '2' * 40, '', 'file2',
+                                 imap2maildir.index_fields(self.message(self.other)))
+        match = "select mailfile from messages where messages match ? order by rank"
+        self.assertEqual(index.execute(match, ('subject:invoice',)).fetchall(), [('file1',)])
+        self.assertEqual(index.execute(match, ('penguins',)).fetchall(), [('file1',)])
+        self.assertEqual(index.execute(match, ('sender:bjorn',)).fetchall(), [('file1',)])
+        self.assertEqual(len(index.execute(match, ('for',)).fetchall()), 2)
+        index.close()
+
+    def testWorker(self):
+        index = imap2maildir.start_index(self.indexfile)
+        for n, key in enumerate(self.keys):
+            path = os.path.join(self.mbox._path, self.mbox._lookup(key))
+            index.submit(str(n + 1) * 40, '', key, imap2maildir.read_message_file(path))
+        index.close()
+        self.assertEqual(self.search('subject:invoice'), [self.keys[0]])
+        self.assertEqual(self.search('sandwiches'), [self.keys[1]])
+        self.assertEqual(self.search('nothing'), [])
+
+    def testReindex(self):
+        self.assertEqual(imap2maildir.reindex(self.db, self.mbox, self.indexfile,
+                                              processes=1), 2)
+        self.assertEqual(self.search('penguins'), [self.keys[0]])
+        self.assertEqual(self.search('subject:lunch'), [self.keys[1]])
+        # Again, from scratch
+        self.assertEqual(imap2maildir.reindex(self.db, self.mbox, self.indexfile,
+                                              processes=1), 2)
+        self.assertEqual(self.search('penguins'), [self.keys[0]])
+
+class TestRestore(unittest.TestCase):
+    """ Test uploading messages back to the server
+    """
+
+    class Connection(simpleimap.SimpleImap):
+        """ Records what append_messages sends, without a server
+        """
+        def __init__(self, capabilities=(), status='OK'):
+            self.capabilities = capabilities
+            self.status = status
+            self.tagged_commands = {}
+            self.events = []
+            self.tags = 0
+
+        def has_capability(self, capability):
+            return capability in self.capabilities
+
+        def _new_tag(self):
+            self.tags += 1
+            tag = simpleimap._bytes('A%i' % self.tags)
+            self.tagged_commands[tag] = None
+            return tag
+
+        def send(self, data):
+            self.events.append(data)
+
+        def _get_response(self):
+            # A continuation: go ahead and send the literal
+            return None
+
+        def _command_complete(self, name, tag):
+            self.events.append(('done', tag))
+            return self.status, [b'done']
+
+        def append(self, mailbox, flags, date_time, message):
+            self.events.append(('append', mailbox, flags, message))
+            return self.status, [b'done']
+
+    messages = [('\\Seen', None, b'a\nb'), ('', None, b'c')]
+
+    def testMultiappend(self):
+        connection = self.Connection(['MULTIAPPEND'])
+        self.assertEqual(connection.append_messages('INBOX', self.messages), 2)
+        self.assertEqual(b''.join(connection.events[:-1]),
+                         b'A1 APPEND "INBOX" (\\Seen) {4}\r\na\r\nb {1}\r\nc\r\n')
+        self.assertEqual(connection.events[-1], ('done', b'A1'))
+
+    def testLiteralPlus(self):
+        """One APPEND each, all sent before waiting for any of them
+        """
+        connection = self.Connection(['LITERAL+'])
+        self.assertEqual(connection.append_messages('INBOX', self.messages), 2)
+        self.assertEqual(b''.join(connection.events[:-2]),
+                         b'A1 APPEND "INBOX" (\\Seen) {4+}\r\na\r\nb\r\n'
+                         b'A2 APPEND "INBOX" {1+}\r\nc\r\n')
+        self.assertEqual(connection.events[-2:], [('done', b'A1'), ('done', b'A2')])
+
+    def testOneAtATime(self):
+        connection = self.Connection()
+        self.assertEqual(connection.append_messages('INBOX', self.messages), 2)
+        self.assertEqual(connection.events, [('append', '"INBOX"', '\\Seen', b'a\r\nb'),
+                                             ('append', '"INBOX"', '', b'c')])
+
+    def testRefused(self):
+        connection = self.Connection(['LITERAL+'], status='NO')
+        self.assertRaises(Exception, connection.append_messages, 'INBOX', self.messages)
+
+    class Server(object):
+        """ Just enough of a simpleimap.Server for restore
+        """
+        def __init__(self, present=()):
+            self.present = set(present)
+            self.appended = []
+
+        def Clone(self):
+            return self
+
+        def Get(self):
+            return self
+
+        def create(self, mailbox):
+            return 'OK', [b'done']
+
+        def get_msgids_and_sizes_by_folder(self, folder):
+            return set(self.present)
+
+        def append_messages(self, mailbox, messages):
+            self.appended.extend([(mailbox, m[2]) for m in messages])
+            return len(messages)
+
+        def logout(self):
+            pass
+
+    def testRestore(self):
+        """A message the server has already, or we have twice, is skipped
+        """
+        one = b'Message-ID: <1@example.com>\nDate: Wed, 1 Jul 2015 11:30:49 -0400\n\none\n'
+        three = b'Message-ID: <3@example.com>\n\nthree\n'
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = imap2maildir.open_sql_session(os.path.join(tmpdir, 'db.sqlite'))
+            mbox = imap2maildir.open_mailbox_maildir(os.path.join(tmpdir, 'md'), create=True)
+            for n, content in enumerate([one, one, three]):
+                imap2maildir.store_hash(db, 'hash%i' % n, mbox.add(content), n,
+                                        remotefolder='INBOX')
+            server = self.Server([('<3@example.com>', len(three) + 3)])
+            logging.disable(logging.ERROR)
+            try:
+                result = imap2maildir.restore(db, mbox, server, 'INBOX', connections=2)
+            finally:
+                logging.disable(logging.NOTSET)
+            self.assertEqual((result['restored'], result['skipped'], result['failed']),
+                             (1, 2, 0))
+            self.assertEqual(server.appended, [('INBOX', one.replace(b'\n', b'\r\n'))])
+            db.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testUnreadable(self):
+        """A message that can't be read is counted, and the worker carries on
+        """
+        jobs = imap2maildir.queue.Queue()
+        server = self.Server()
+        worker = imap2maildir.RestoreWorker(server, jobs, {})
+        jobs.put(('INBOX', [('/nonexistent/1', None, '', None),
+                            (None, b'Date: not a date\n\nhi\n', '', None)]))
+        jobs.put(None)
+        logging.disable(logging.ERROR)
+        try:
+            worker.run()
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual((worker.outdict['restored'], worker.outdict['failed']), (1, 1))
+
+class TestMirrorDeletes(unittest.TestCase):
+    """ Test removing local copies of messages deleted from the server
+    """
+
+    class Folder(object):
+        """ Just enough of a FolderClass for mirror_deletes
+        """
+        folder = 'INBOX'
+
+        def __init__(self, uids, summaries=()):
+            self.uids = uids
+            self.summaries = summaries
+
+        def UidSet(self, search='ALL'):
+            return simpleimap.UidSet(self.uids)
+
+        def Summaries(self, search='ALL', envelope=True, order='oldest'):
+            wanted = simpleimap.UidSet.from_sequence_set(search.split()[1])
+            return [summ for summ in self.summaries if summ['uid'] in wanted]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = imap2maildir.open_sql_session(os.path.join(self.dir, 'db.sqlite'))
+        self.mbox = imap2maildir.open_mailbox_maildir(os.path.join(self.dir, 'md'), create=True)
+        self.keys = {}
+        for uid in range(1, 11):
+            self.add(uid, 'hash%i' % uid)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def add(self, uid, msghash):
+        self.keys[uid] = self.mbox.add(b'From: a@example.com\nSubject: %i\n\nHello\n' % uid)
+        imap2maildir.store_hash(self.db, msghash, self.keys[uid], uid, remotefolder='INBOX')
+
+    def uids(self):
+        return [row[0] for row in self.db.execute('select uid from seenmessages order by uid')]
+
+    def mirror(self, folder, trash=None):
+        logging.disable(logging.ERROR)
+        try:
+            return imap2maildir.mirror_deletes(self.db, folder, self.mbox, trash)
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def testRemove(self):
+        self.assertEqual(self.mirror(self.Folder(range(2, 11))), 1)
+        self.assertEqual(self.uids(), list(range(2, 11)))
+        self.assertFalse(self.keys[1] in self.mbox)
+        self.assertTrue(self.keys[2] in self.mbox)
+
+    def testThreshold(self):
+        self.assertEqual(self.mirror(self.Folder(range(1, 6))), 0)
+        self.assertEqual(self.uids(), list(range(1, 11)))
+        self.assertEqual(len(self.mbox), 10)
+
+    def testTrash(self):
+        trash = imap2maildir.open_mailbox_maildir(os.path.join(self.dir, 'trash'), create=True)
+        self.assertEqual(self.mirror(self.Folder(range(2, 11)), trash), 1)
+        self.assertFalse(self.keys[1] in self.mbox)
+        self.assertEqual(trash.keys(), [self.keys[1]])
+
+    def testPoison(self):
+        imap2maildir.store_hash(self.db, 'hash11', 'POISON-hash11', 11, remotefolder='INBOX')
+        self.assertEqual(self.mirror(self.Folder(range(1, 11))), 1)
+        self.assertEqual(self.uids(), list(range(1, 11)))
+        self.assertEqual(len(self.mbox), 10)
+
+    def testDuplicate(self):
+        """The server has two copies; the one we recorded goes
+        """
+        summary = {'uid': 12, 'msgid': '<dup@example.com>', 'size': 100,
+                   'date': '01-Jul-2015 11:30:49 -0400'}
+        self.add(11, imap2maildir.summary_hash(summary))
+        self.assertEqual(self.mirror(self.Folder(list(range(1, 11)) + [12], [summary])), 0)
+        self.assertEqual(self.uids(), list(range(1, 11)) + [12])
+        self.assertTrue(self.keys[11] in self.mbox)
+
+    def testMany(self):
+        """More vanished uids than fit in one query
+        """
+        for uid in range(11, 1211):
+            imap2maildir.store_hash(self.db, 'hash%i' % uid, 'file%i' % uid, uid,
+                                    remotefolder='INBOX')
+        folder = self.Folder(range(1, 11))
+        folder.Summaries = None     # nothing new on the server to ask about
+        self.assertEqual(imap2maildir.mirror_deletes(self.db, folder, self.mbox,
+                                                     threshold=100), 1200)
+        self.assertEqual(self.uids(), list(range(1, 11)))
+        self.assertEqual(len(self.mbox), 10)
+
+    def testGmailCopy(self):
+        """A message under two labels shares its file until both have gone
+        """
+        self.db.execute('update seenmessages set gmmsgid = 501 where uid = 1')
+        # Same message, same hash (one maildir for both folders)
+        imap2maildir.store_gmail_copy(self.db, 501, 'hash1', 7, remotefolder='Label')
+        imap2maildir.store_gmail_copy(self.db, 501, 'hash1', 7, remotefolder='Label')
+        self.assertEqual(self.db.execute(
+            'select remotefolder, uid, mailfile from seenmessages where gmmsgid = 501 '
+            'order by remotefolder').fetchall(),
+            [('INBOX', 1, self.keys[1]), ('Label', 7, self.keys[1])])
+        for remotefolder, uids in (('Label', [7]), ('INBOX', list(range(1, 11)))):
+            seencache = imap2maildir.SeenMessagesCache()
+            seencache.select(remotefolder)
+            self.assertEqual(list(imap2maildir.known_uids(self.db, seencache)), uids)
+
+        folder = self.Folder(range(2, 11))
+        self.assertEqual(self.mirror(folder), 1)
+        self.assertTrue(self.keys[1] in self.mbox)
+        folder = self.Folder([])
+        folder.folder = 'Label'
+        self.assertEqual(imap2maildir.mirror_deletes(self.db, folder, self.mbox, threshold=100), 1)
+        self.assertFalse(self.keys[1] in self.mbox)
+        self.assertEqual(self.uids(), list(range(2, 11)))
+
+class TestAllFolders(unittest.TestCase):
+    """ Test syncing every folder on the server
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = imap2maildir.open_sql_session(os.path.join(self.dir, 'db.sqlite'))
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def testFolderName(self):
+        self.assertEqual(imap2maildir.maildir_folder_name('INBOX', '/'), '')
+        self.assertEqual(imap2maildir.maildir_folder_name('[Gmail]/All Mail', '/'),
+                         '[Gmail].All Mail')
+        self.assertEqual(imap2maildir.maildir_folder_name('Lists.python-dev', '.'),
+                         'Lists.python-dev')
+        self.assertEqual(imap2maildir.maildir_folder_name('v1.2/notes', '/'), 'v1_2.notes')
+        self.assertEqual(imap2maildir.maildir_folder_name('a/b.c', None), 'a_b_c')
+
+    def testListResponse(self):
+        mo = simpleimap.ListResponse.match('(\\HasNoChildren) "/" "Lists/\\"quoted\\""')
+        self.assertEqual((mo.group('flags'), mo.group('delimiter'), mo.group('name')),
+                         ('\\HasNoChildren', '/', '"Lists/\\"quoted\\""'))
+        mo = simpleimap.ListResponse.match('() NIL Flat')
+        self.assertEqual((mo.group('delimiter'), mo.group('name')), (None, 'Flat'))
+
+    class Connection(simpleimap.SimpleImap):
+        """ Answers LIST and pipelined STATUS, without a server
+        """
+        def __init__(self, listing=(), statuses=()):
+            self.listing = list(listing)
+            self.statuses = list(statuses)
+            self.untagged_responses = {}
+            self.sent = []
+
+        def has_capability(self, capability):
+            return capability == 'CONDSTORE'
+
+        def list(self, directory, pattern):
+            return 'OK', self.listing
+
+        def _command(self, name, *args):
+            self.sent.append((name,) + args)
+            return 'A%i' % len(self.sent)
+
+        def _command_complete(self, name, tag):
+            # Every answer turns up while waiting for the first
+            if self.statuses:
+                self.untagged_responses['STATUS'] = self.statuses
+                self.statuses = []
+            if tag == 'A3':
+                return 'NO', [b"can't"]
+            return 'OK', [b'done']
+
+    def testFolderList(self):
+        connection = self.Connection([
+            b'(\\HasNoChildren) "/" INBOX',
+            (b'(\\HasNoChildren) "/" {9}', b'Odd "one"'), b'',
+            b'(\\Noselect \\HasChildren) "/" "[Gmail]"',
+            b'(\\HasNoChildren) "/" "[Gmail]/Sent \\"Mail\\""',
+            b'(\\HasNoChildren) NIL Flat'])
+        self.assertEqual(connection.get_folder_list(),
+                         [('INBOX', '/'), ('Odd "one"', '/'), ('[Gmail]/Sent "Mail"', '/'),
+                          ('Flat', None)])
+
+    def testFolderStatus(self):
+        """The answers are matched up by name, whatever order they come in
+        """
+        connection = self.Connection(statuses=[
+            b'"Sent" (MESSAGES 2 UIDNEXT 3 UIDVALIDITY 7 HIGHESTMODSEQ 9)',
+            (b'{9}', b'Odd "one"'), b' (MESSAGES 5 UIDNEXT 6 UIDVALIDITY 8 HIGHESTMODSEQ 1)',
+            b'inbox (MESSAGES 1 UIDNEXT 2 UIDVALIDITY 6 HIGHESTMODSEQ 4)'])
+        result = connection.get_folder_status(['INBOX', 'Odd "one"', 'Trash', 'Sent'])
+        self.assertEqual([sent[1] for sent in connection.sent],
+                         ['"INBOX"', '"Odd \\"one\\""', '"Trash"', '"Sent"'])
+        self.assertEqual(sorted(result), ['INBOX', 'Odd "one"', 'Sent'])
+        self.assertEqual(result['Sent'], {'MESSAGES': 2, 'UIDNEXT': 3, 'UIDVALIDITY': 7,
+                                          'HIGHESTMODSEQ': 9})
+        self.assertEqual(result['Odd "one"']['UIDVALIDITY'], 8)
+        self.assertEqual(result['INBOX']['MESSAGES'], 1)
+
+    def testFolderFails(self):
+        """A folder that fails is logged and left for next time
+        """
+        class Server:
+            reconnects = 0
+
+            def __init__(self, connection):
+                self.connection = connection
+
+            def StartKeepalive(self):
+                pass
+
+            def Get(self):
+                return self.connection
+
+            def Reconnect(self):
+                self.reconnects += 1
+
+        class Folder:
+            summarybatch = chunksizer = None
+
+            def __init__(self, folder):
+                self.folder = folder
+
+            def __reconnector__(self, reconnect):
+                pass
+
+        class Mailbox:
+            def list_folders(self):
+                return ['Lost', 'Broken', 'Good']
+
+        def sync_once(options, db, mbox, imap, folder, *args):
+            if folder.folder == 'Lost':
+                raise simpleimap.ConnectionErrors[0]('gone')
+            if folder.folder == 'Broken':
+                raise ValueError('bad')
+            return {'complete': True}
+
+        connection = self.Connection([b'() "/" ' + name for name in
+                                      (b'Lost', b'Broken', b'Good')],
+                                     [name + b' (MESSAGES 1 UIDNEXT 2 UIDVALIDITY 3)' for name in
+                                      (b'Lost', b'Broken', b'Good')])
+        connection.Folder = Folder
+        server = Server(connection)
+        options = optparse.Values({'mirrordeletes': False, 'fillstubs': False, 'daemon': False})
+        stored = []
+        saved = imap2maildir.sync_once, imap2maildir.store_folder_status
+        imap2maildir.sync_once = sync_once
+        imap2maildir.store_folder_status = lambda db, name, status: stored.append(name)
+        logging.disable(logging.ERROR)
+        try:
+            imap2maildir.sync_all_folders(options, self.db, Mailbox(), server)
+        finally:
+            logging.disable(logging.NOTSET)
+            imap2maildir.sync_once, imap2maildir.store_folder_status = saved
+        self.assertEqual(stored, ['Good'])
+        self.assertEqual(server.reconnects, 1)
+
+    def testSelectQuoted(self):
+        """Folder names with spaces in are quoted, as Python 3's imaplib
+        doesn't do it for us
+        """
+        class Connection(simpleimap.SimpleImap):
+            host = 'imap.example.com'
+
+            def __init__(self):
+                self.selected = []
+
+            def select(self, mailbox='INBOX', readonly=False):
+                self.selected.append(mailbox)
+                return 'OK', [b'2']
+
+            def response(self, code):
+                return code, [b'42']
+
+            def has_capability(self, capability):
+                return False
+
+            def uid(self, command, *args):
+                return 'OK', [b'1 2']
+        connection = Connection()
+        folder = simpleimap.FolderClass(connection, '[Gmail]/Sent Mail')
+        self.assertEqual(len(folder), 2)
+        self.assertEqual(str(folder.UidSet()), '1:2')
+        self.assertEqual(set(connection.selected), set(['"[Gmail]/Sent Mail"']))
+
+    def testFolderHash(self):
+        msghash = imap2maildir.make_hash(100, '01-Jul-2015 11:30:49 -0400', '<1@example.com>')
+        self.assertEqual(imap2maildir.folder_hash(msghash, ''), msghash)
+        self.assertNotEqual(imap2maildir.folder_hash(msghash, 'Sent'), msghash)
+        self.assertNotEqual(imap2maildir.folder_hash(msghash, 'Sent'),
+                            imap2maildir.folder_hash(msghash, 'Drafts'))
+
+    def testUnchanged(self):
+        status = {'MESSAGES': 3, 'UIDNEXT': 4, 'UIDVALIDITY': 42}
+        self.assertFalse(imap2maildir.folder_unchanged(self.db, 'Sent', status))
+        self.db.execute("insert into folderstate (folder, uidvalidity) values ('Sent', 42)")
+        # Not until a pass is complete
+        self.assertFalse(imap2maildir.folder_unchanged(self.db, 'Sent', status))
+        imap2maildir.store_folder_status(self.db, 'Sent', status)
+        self.assertTrue(imap2maildir.folder_unchanged(self.db, 'Sent', status))
+        self.assertFalse(imap2maildir.folder_unchanged(self.db, 'Sent', dict(status, UIDNEXT=5)))
+        self.assertFalse(imap2maildir.folder_unchanged(self.db, 'Sent',
+                                                       dict(status, HIGHESTMODSEQ=7)))
+
+    def testSeenUidsByFolder(self):
+        """Every folder has a uid 1, so turbo mode has to keep them apart
+        """
+        imap2maildir.store_hash(self.db, 'a', 'file1', 1, remotefolder='INBOX')
+        imap2maildir.store_hash(self.db, 'b', 'file2', 2, remotefolder='Sent',
+                                localfolder='Sent')
+        seencache = imap2maildir.SeenMessagesCache()
+        seencache.select('Sent')
+        self.assertEqual(list(imap2maildir.known_uids(self.db, seencache)), [2])
+        seencache.select('INBOX')
+        self.assertEqual(list(imap2maildir.known_uids(self.db, seencache)), [1])
+        seencache.select(None)
+        self.assertEqual(list(imap2maildir.known_uids(self.db, seencache)), [1, 2])
+        self.assertEqual(self.db.execute("select folder from seenmessages where hash = 'b'"
+                                         ).fetchone()[0], 'Sent')
+
+class TestStubs(unittest.TestCase):
+    """ Test saving big messages without their attachments, and filling
+    them in later
+    """
+
+    structure = (b'(("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "7BIT" 5 1 NIL NIL NIL NIL)'
+                 b'("APPLICATION" "PDF" ("NAME" "big.pdf") NIL NIL "BASE64" 3000 NIL '
+                 b'("ATTACHMENT" ("FILENAME" "big.pdf")) NIL NIL) "MIXED" ("BOUNDARY" "XYZ") '
+                 b'NIL NIL NIL)')
+    header = (b'From: a@example.com\r\nSubject: hi\r\n'
+              b'Content-Type: multipart/mixed; boundary="XYZ"\r\n\r\n')
+    sections = [(b'1.MIME', b'Content-Type: text/plain\r\n\r\n'), (b'1', b'Hello'),
+                (b'2.MIME', b'Content-Type: application/pdf; name="big.pdf"\r\n\r\n')]
+
+    class Connection(simpleimap.SimpleImap):
+        """ Answers the FETCHes for a stub, without a server
+        """
+        def __init__(self, structure, header, sections):
+            self.structure = structure
+            self.header = header
+            self.sections = sections
+            self.fetched = []
+
+        def uid(self, command, uid, items):
+            self.fetched.append(items)
+            if 'BODYSTRUCTURE' in items:
+                items = [(b'BODYSTRUCTURE', self.structure), (b'BODY[HEADER]', self.header)]
+            else:
+                items = [(b'BODY[' + section + b']', data) for section, data in self.sections]
+            data = []
+            line = b'1 (UID 7'
+            for name, value in items:
+                if name == b'BODYSTRUCTURE':
+                    line += b' ' + name + b' ' + value
+                else:
+                    data.append((line + b' ' + name + simpleimap._bytes(' {%i}' % len(value)),
+                                 value))
+                    line = b''
+            return 'OK', data + [line + b')']
+
+    def testStub(self):
+        connection = self.Connection(self.structure, self.header, self.sections)
+        message, omitted = connection.get_message_stub_by_uid(7, 1000)
+        self.assertEqual(omitted, 3000)
+        self.assertEqual(connection.fetched[1],
+                         '(BODY.PEEK[1.MIME] BODY.PEEK[1] BODY.PEEK[2.MIME])')
+        self.assertEqual(message['X-Imap2maildir-Stub'], 'uid 7; omitted 2 (3000 bytes)')
+        self.assertEqual(message['Subject'], 'hi')
+        text, attachment = message.get_payload()
+        self.assertEqual(text.get_payload(), 'Hello')
+        self.assertEqual(attachment.get_content_type(), 'text/plain')
+        self.assertEqual(attachment['X-Imap2maildir-Omitted'], '2; application/pdf; 3000 bytes')
+        self.assertTrue('big.pdf' in attachment.get_payload())
+
+    def testSinglePart(self):
+        structure = b'("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "BASE64" 5000 80 NIL NIL NIL NIL)'
+        header = (b'From: a@example.com\r\nContent-Type: text/plain\r\n'
+                  b'Content-Transfer-Encoding: base64\r\n\r\n')
+        connection = self.Connection(structure, header, [])
+        self.assertEqual(connection.get_message_stub_by_uid(7, 10000), None)
+        message, omitted = connection.get_message_stub_by_uid(7, 1000)
+        self.assertEqual(omitted, 5000)
+        self.assertEqual(len(connection.fetched), 2)
+        self.assertEqual(message['X-Imap2maildir-Original-Content-Transfer-Encoding'], 'base64')
+        self.assertEqual(message['Content-Transfer-Encoding'], None)
+        self.assertEqual(message['X-Imap2maildir-Omitted'], '1; text/plain; 5000 bytes')
+
+    def testNestedSections(self):
+        text = ['TEXT', 'PLAIN', None, None, None, '7BIT', 10, 1, None, None, None, None]
+        html = ['TEXT', 'HTML', None, None, None, '7BIT', 20, 1, None, None, None, None]
+        image = ['IMAGE', 'PNG', ['NAME', 'a.png'], None, None, 'BASE64', 9000, None,
+                 ['INLINE', None], None, None]
+        structure = [[text, html, 'ALTERNATIVE', ['BOUNDARY', 'b1']], image, 'RELATED',
+                     ['BOUNDARY', 'b2']]
+        sections, omitted = simpleimap.stub_sections(structure, 100)
+        self.assertEqual(sections, ['1.MIME', '1.1.MIME', '1.1', '1.2.MIME', '1.2', '2.MIME'])
+        self.assertEqual(omitted, [('2', {'type': 'image/png', 'size': 9000,
+                                          'filename': 'a.png', 'attachment': False})])
+
+    whole = b'From: a@example.com\nSubject: hi\n\nthe whole thing\n'
+
+    class Folder(object):
+        """ Just enough of a FolderClass for fill_stubs
+        """
+        folder = 'INBOX'
+        uidvalidity = 42
+
+        def __init__(self, message, sizes):
+            self.message = message
+            self.sizes = sizes
+
+        def Sizes(self, uids):
+            return dict([(uid, self.sizes[uid]) for uid in uids if uid in self.sizes])
+
+        def MessageToFile(self, uid, fileobj, chunksize=None):
+            fileobj.write(self.message)
+            return fileobj.tell()
+
+    def fill(self, folder):
+        """ Fills in a stub of uid 7 from folder; returns (filled, stubs
+        left, the maildir file, files left in tmp/)
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            db = imap2maildir.open_sql_session(os.path.join(tmpdir, 'db.sqlite'))
+            mbox = imap2maildir.open_mailbox_maildir(os.path.join(tmpdir, 'md'), create=True)
+            stub = mailbox.MaildirMessage(b'From: a@example.com\nSubject: hi\n\n[stub]\n')
+            stub.set_flags('S')
+            key = mbox.add(stub)
+            imap2maildir.store_hash(db, 'a', key, 7, remotefolder='INBOX', stub=3000)
+            self.assertEqual(imap2maildir.pending_stubs(db, 'INBOX'), 1)
+            path = os.path.join(mbox._path, mbox._lookup(key))
+
+            logging.disable(logging.ERROR)
+            try:
+                filled = imap2maildir.fill_stubs(db, folder, mbox)
+            finally:
+                logging.disable(logging.NOTSET)
+            result = (filled, imap2maildir.pending_stubs(db, 'INBOX'),
+                      imap2maildir.read_message_file(path, raw=True),
+                      os.listdir(os.path.join(mbox._path, 'tmp')))
+            db.close()
+            return result
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testFill(self):
+        filled, pending, content, tmp = self.fill(self.Folder(self.whole, {7: len(self.whole)}))
+        self.assertEqual((filled, pending, tmp), (1, 0, []))
+        self.assertTrue(b'the whole thing' in content)
+
+    def testFillFails(self):
+        """The stub stays if the message is gone, or doesn't all arrive
+        """
+        for folder in (self.Folder(b'', {7: len(self.whole)}),
+                       self.Folder(self.whole[:20], {7: len(self.whole)}),
+                       self.Folder(b'', {})):
+            filled, pending, content, tmp = self.fill(folder)
+            self.assertEqual((filled, pending, tmp), (0, 1, []))
+            self.assertTrue(b'[stub]' in content)
+
+class TestStartup(unittest.TestCase):
+    """ Test how long it takes to get going
+    """
+
+    def testImportTime(self):
+        """
+        Benchmark: importing imap2maildir, as python -X importtime sees it
+        (where there is one), and making sure the rarely needed modules
+        aren't loaded up front.
+        """
+        code = ('import sys; import imap2maildir; '
+                'print(" ".join(m for m in ("getpass", "json", "multiprocessing", '
+                '"platform", "shutil") if m in sys.modules))')
+        args = [sys.executable]
+        if sys.version_info >= (3, 7):
+            args += ['-X', 'importtime']
+        proc = subprocess.Popen(args + ['-c', code], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        out, err = proc.communicate()
+        self.assertEqual(proc.returncode, 0, err)
+        self.assertEqual(out.strip(), b'')
+        for line in err.decode('latin-1').splitlines():
+            if line.endswith('| imap2maildir'):
+                print('\nimport imap2maildir: %.1fms' %
+                      (int(line.split('|')[1]) / 1000.0))
+
+    def testDefaults(self):
+        """The defaults have to get through ConfigParser, which on Python 3
+        only takes strings (or what str() makes one of)
+        """
+        config, gotconfig = imap2maildir.parse_config_file(
+            imap2maildir.defaults, os.path.join(tempfile.gettempdir(), 'nonexistent.conf'))
+        self.assertFalse(gotconfig)
+        self.assertEqual(str(config.get('DEFAULT', 'restorefolder')), 'False')
+
 if __name__ == '__main__':
     unittest.main()